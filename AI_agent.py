@@ -1,14 +1,68 @@
+import hashlib
 import os
-import io
-import re
-from typing import Dict, Any, Optional
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Any, List, Optional
 
 import streamlit as st
-from PIL import Image
 
-import google.generativeai as genai
-from google.api_core.exceptions import ResourceExhausted, GoogleAPIError
-import docx
+from magi_audio import AudioSegment, format_timestamp
+from magi_cache import is_error_text
+from magi_history import DECISIONS
+from magi_jobs import ACTIVE_STATUSES, STATUS_DONE, STATUS_TIMEOUT, Job
+from magi_media import EncodedImage
+from magi_metrics import collect_trace, start_trace
+from magi_scheduler import PRIORITY_INTERACTIVE, set_scheduler_caller
+from magi_usage import set_usage_session
+
+from magi_core import (
+    ALL_SECTION_KEYS,
+    AGENT_PANEL_TITLES,
+    DEFAULT_MODEL_NAME,
+    MODEL_CHOICES,
+    REPORT_FORMATS,
+    SWOT_PANELS,
+    MagiStreamParser,
+    agent_panel_html,
+    aggregated_html,
+    build_report_cached,
+    call_magi_plain,
+    condense_context,
+    configure_gemini,
+    describe_image_cached,
+    fanout_magi_plain,
+    export_metrics,
+    get_audio_cache,
+    get_report_cache,
+    get_history,
+    get_image_cache,
+    get_job_queue,
+    get_media_cache,
+    get_model_backend,
+    get_metrics,
+    get_model_health,
+    get_rate_limiter,
+    get_scheduler,
+    get_setting,
+    get_single_flight,
+    get_text_spool,
+    get_usage_ledger,
+    get_result_cache,
+    ingest_text_upload,
+    mode_latency_summary,
+    parse_magi_text,
+    prepare_audio_cached,
+    prepare_image_cached,
+    preflight_magi,
+    rate_limits_for,
+    set_settings_source,
+    start_model_warm_up,
+    stream_magi_plain,
+    swot_panel_html,
+    swot_text_to_chips,
+    transcribe_audio_segmented,
+)
 
 # ======================================================
 # ページ設定
@@ -304,7 +358,47 @@ st.markdown(
 # ======================================================
 api_key = st.secrets.get("GEMINI_API_KEY", os.getenv("GEMINI_API_KEY"))
 
-if not api_key:
+
+def _secret_setting(name: str) -> Any:
+    # ジョブのワーカーなど、スクリプトの実行の外のスレッドからも呼ばれる（secrets.toml がなければ環境変数へ）
+    try:
+        return st.secrets.get(name)
+    except FileNotFoundError:
+        return None
+
+
+set_settings_source(_secret_setting)
+
+# トークン使用量をセッション単位で集計するための ID
+if "usage_session_id" not in st.session_state:
+    st.session_state["usage_session_id"] = uuid.uuid4().hex
+set_usage_session(st.session_state["usage_session_id"])
+
+# 分析はバックグラウンドのジョブで実行する。URL の ?job= から、再読み込み後も同じジョブを追いかける
+if "magi_job_checked" not in st.session_state:
+    st.session_state["magi_job_checked"] = True
+    if st.query_params.get("job"):
+        st.session_state["magi_job_id"] = st.query_params["job"]
+
+# 他のセッションの呼び出しで実行枠が埋まっているときの順番待ちをここに出す
+queue_slot = st.empty()
+_script_thread = threading.current_thread()
+
+
+def _on_queue_wait(model: str, position: int) -> None:
+    # 並列モードのワーカースレッドからは画面を更新できないので、スクリプトのスレッドからだけ出す
+    if threading.current_thread() is not _script_thread:
+        return
+    if position:
+        queue_slot.info(f"{model} の実行待ちです（順番待ち {position} 番目）…")
+    else:
+        queue_slot.empty()
+
+
+set_scheduler_caller(st.session_state["usage_session_id"], PRIORITY_INTERACTIVE, _on_queue_wait)
+
+# MAGI_BACKEND=replay（カセット再生・合成応答）のときは API キーなしで動かせる
+if not api_key and get_model_backend().requires_api_key:
     st.error(
         "Gemini の API キーが設定されていません。\n\n"
         "【Streamlit Cloud】Settings → Secrets で：\n"
@@ -313,24 +407,28 @@ if not api_key:
     )
     st.stop()
 
-genai.configure(api_key=api_key)
+# genai.configure はプロセスで1回だけ（同じキーなら何もしない）。モデルの準備は裏で先に済ませておく
+if api_key:
+    configure_gemini(api_key)
+if get_setting("MAGI_WARMUP_ENABLED", True):
+    start_model_warm_up()
+backend = get_model_backend()
+if backend.mode != "live":
+    cassette = backend.cassette
+    st.sidebar.caption(
+        f"バックエンド：{backend.mode}"
+        + (f"（カセット {cassette.path}・{cassette.count}件）" if cassette is not None else "")
+    )
 
 # ======================================================
 # モデル選択（デフォルトは gemini-2.0-flash）
 # ======================================================
-MODEL_CHOICES = {
-    "Gemini 2.0 Flash（デフォルト）": "gemini-2.0-flash",
-    "Gemini 2.5 Flash": "gemini-2.5-flash",
-    "Gemini 2.5 Pro": "gemini-2.5-pro",
-    "Gemini 2.5 Flash Lite": "gemini-2.5-flash-lite",
-}
-
 if "gemini_model_name" not in st.session_state:
-    st.session_state["gemini_model_name"] = "gemini-2.0-flash"
+    st.session_state["gemini_model_name"] = DEFAULT_MODEL_NAME
 
 st.sidebar.markdown("### モデル選択")
 labels = list(MODEL_CHOICES.keys())
-current_model = st.session_state.get("gemini_model_name", "gemini-2.0-flash")
+current_model = st.session_state.get("gemini_model_name", DEFAULT_MODEL_NAME)
 current_label = next(
     (lbl for lbl, mid in MODEL_CHOICES.items() if mid == current_model),
     "Gemini 2.0 Flash（デフォルト）",
@@ -347,554 +445,437 @@ selected_label = st.sidebar.selectbox(
     ),
 )
 st.session_state["gemini_model_name"] = MODEL_CHOICES[selected_label]
-
-
-def get_gemini_model():
-    """
-    どのモデルに対しても「同じ聞き方」を維持するため、
-    呼び出し方は変えず、内部でモデル名だけを切り替える。
-    """
-    model_name = st.session_state.get("gemini_model_name", "gemini-2.0-flash")
-    return genai.GenerativeModel(model_name)
+model_name = st.session_state["gemini_model_name"]
 
 
 # ======================================================
-# ユーティリティ
+# 出力パネル描画（ストリーミング時はセクションごとに差し替え）
 # ======================================================
-def clean_text_for_display(text: str) -> str:
-    if not text:
-        return ""
-    return text.replace("*", "・")
-
-
-def trim_text(s: str, max_chars: int = 600) -> str:
-    if not s:
-        return ""
-    if len(s) <= max_chars:
-        return s
-    return s[:max_chars] + "\n…（長文のためここで省略）"
-
-
-def classify_resource_exhausted(e: ResourceExhausted) -> str:
+def create_output_placeholders(enable_swot: bool) -> Dict[str, Any]:
     """
-    ResourceExhausted のメッセージから、
-    - レートリミット（短時間の叩きすぎ）
-    - 日次／総量クォータ
-    - free tier が 0
-    - その他
-    を日本語で推定。
+    出力エリアの見出しと、各パネル用の st.empty() を先に並べておく。
     """
-    msg = str(e)
-    low = msg.lower()
-
-    if "limit: 0" in msg:
-        return (
-            "カテゴリ推定：free tier クォータが 0\n"
-            "・このプロジェクトの free_tier が 0 に設定されているか、既に使い切っています。\n"
-            "・AI Studio / Cloud Console の Quotas 画面で、対象モデルの free_tier が 0 かどうか確認してください。\n"
-            "・継続利用する場合は、課金の有効化または別プロジェクト／別APIキーの利用を検討してください。"
-        )
-
-    is_per_minute = ("PerMinute" in msg) or ("per minute" in low)
-    is_per_day = ("PerDay" in msg) or ("per day" in low)
+    placeholders: Dict[str, Any] = {}
 
-    if "rate limit" in low or "too many requests" in low or (is_per_minute and not is_per_day):
-        return (
-            "カテゴリ推定：レートリミット（短時間の叩きすぎ）\n"
-            "・短時間に大量のリクエストを送信している可能性があります。\n"
-            "・ボタンの連打を避け、実行間隔をあけてください。\n"
-            "・1回の実行での呼び出し回数や入力サイズを減らすことも有効です。"
-        )
+    st.markdown(
+        '<div class="magi-section-title">OUTPUT · MAGI COMMENTS</div><hr class="magi-divider">',
+        unsafe_allow_html=True,
+    )
+    colL, colR = st.columns(2)
+    # 左側：Logic / Reality
+    with colL:
+        placeholders["logic"] = st.empty()
+        placeholders["reality"] = st.empty()
+    # 右側：Human / Media
+    with colR:
+        placeholders["human"] = st.empty()
+        placeholders["media"] = st.empty()
 
-    if is_per_day:
-        return (
-            "カテゴリ推定：日次／総量クォータ上限\n"
-            "・1日あたり、またはプロジェクト全体の利用上限（無料枠・課金枠）に達している可能性があります。\n"
-            "・AI Studio / Cloud Console の Usage / Quota 画面で、対象モデルの PerDay / PerProject の値を確認してください。"
-        )
+    st.markdown(
+        '<div class="magi-section-title">OUTPUT · MAGI AGGREGATED DECISION</div><hr class="magi-divider">',
+        unsafe_allow_html=True,
+    )
+    placeholders["aggregated"] = st.empty()
 
-    if "exhausted" in low or "resources exhausted" in low:
-        return (
-            "カテゴリ推定：リソース逼迫（モデル側の一時的混雑など）\n"
-            "・アクセス集中などで一時的にリソースが不足している可能性があります。\n"
-            "・しばらく待ってから再実行してみてください。"
+    if enable_swot:
+        st.markdown(
+            '<div class="magi-section-title">SWOT · STRATEGIC VIEW</div><hr class="magi-divider">',
+            unsafe_allow_html=True,
         )
-
-    return (
-        "カテゴリ推定：その他の ResourceExhausted\n"
-        "・詳細は下記の『生メッセージ』を参照してください。"
-    )
+        col_s, col_w = st.columns(2)
+        with col_s:
+            placeholders["strengths"] = st.empty()
+        with col_w:
+            placeholders["weaknesses"] = st.empty()
+        col_o, col_t = st.columns(2)
+        with col_o:
+            placeholders["opportunities"] = st.empty()
+        with col_t:
+            placeholders["threats"] = st.empty()
+        placeholders["swot_note"] = st.empty()
+
+    return placeholders
+
+
+def render_magi_sections(
+    placeholders: Dict[str, Any],
+    keys: List[str],
+    agents: Dict[str, Any],
+    aggregated: Dict[str, str],
+    swot: Dict[str, str],
+) -> None:
+    for key in keys:
+        if key in AGENT_PANEL_TITLES:
+            if key not in agents:
+                continue
+            with placeholders[key].container():
+                st.markdown(f"##### {AGENT_PANEL_TITLES[key]}")
+                st.markdown(agent_panel_html(key, agents[key]), unsafe_allow_html=True)
+        elif key in ("summary", "details"):
+            placeholders["aggregated"].markdown(
+                aggregated_html(aggregated), unsafe_allow_html=True
+            )
+        elif key == "swot" and "strengths" in placeholders:
+            for field, title, chip_class in SWOT_PANELS:
+                chips = swot_text_to_chips(swot.get(field, ""), chip_class)
+                placeholders[field].markdown(
+                    swot_panel_html(title, chips), unsafe_allow_html=True
+                )
 
 
 # ======================================================
-# 媒体のテキスト化（画像・音声）
+# サイドバー：媒体入力
 # ======================================================
-def describe_image_with_gemini(img: Image.Image) -> str:
-    model = get_gemini_model()
-    prompt = (
-        "この画像に何が写っているか、日本語で簡潔に2〜3文で説明してください。\n"
-        "心理的な印象も1文で添えてください。"
-    )
-    try:
-        resp = model.generate_content([prompt, img])
-        return clean_text_for_display((resp.text or "").strip())
-    except ResourceExhausted as e:
-        detail = classify_resource_exhausted(e)
-        return (
-            "【エラー】画像解析中に Gemini のリソース上限エラーが発生しました。\n"
-            f"生メッセージ：{str(e)}\n\n{detail}"
-        )
-    except Exception as e:
-        return f"【エラー】画像解析に失敗しました: {str(e)}"
+st.sidebar.markdown("### 媒体入力（任意）")
 
+input_mode = st.sidebar.radio(
+    "画像・音声の入力方法",
+    ["ファイル／写真ライブラリから選択", "カメラで撮影", "使用しない"],
+    index=2,
+)
 
-def transcribe_audio_with_gemini(uploaded_file) -> str:
-    model = get_gemini_model()
-    audio_bytes = uploaded_file.getvalue()
-    mime_type = uploaded_file.type or "audio/wav"
+uploaded_file: Optional[Any] = None
+image_for_report: Optional[EncodedImage] = None
 
-    prompt = (
-        "この音声の内容を日本語でできるだけ正確に文字起こししてください。\n"
-        "出力は通常の日本語文のみで書いてください。"
+if input_mode == "ファイル／写真ライブラリから選択":
+    file = st.sidebar.file_uploader(
+        "画像 / 音声 / テキストファイル",
+        accept_multiple_files=False,
     )
-    try:
-        resp = model.generate_content(
-            [prompt, {"mime_type": mime_type, "data": audio_bytes}]
-        )
-        return clean_text_for_display((resp.text or "").strip())
-    except ResourceExhausted as e:
-        detail = classify_resource_exhausted(e)
-        return (
-            "【エラー】音声解析中に Gemini のリソース上限エラーが発生しました。\n"
-            f"生メッセージ：{str(e)}\n\n{detail}"
-        )
-    except Exception as e:
-        return f"【エラー】音声解析に失敗しました: {str(e)}"
-
-
-# ======================================================
-# MAGI テキスト生成（SWOT ON/OFF・リミット診断付き）
-# ======================================================
-def call_magi_plain(context: Dict[str, Any], enable_swot: bool) -> str | None:
-    """
-    1回の generate_content で、Magi-Logic/Human/Reality/Media と統合出力を返す。
-    enable_swot=True のときだけ SWOT 分析指示を追加し、
-    リソース上限や MAX_TOKENS などを詳細にエラーハンドリング。
-    """
-    model = get_gemini_model()
-
-    trimmed_context = {
-        "user_question": trim_text(context.get("user_question", "")),
-        "text_input": trim_text(context.get("text_input", "")),
-        "audio_transcript": trim_text(context.get("audio_transcript", "")),
-        "image_description": trim_text(context.get("image_description", "")),
-    }
+    if file:
+        uploaded_file = file
+elif input_mode == "カメラで撮影":
+    cam = st.sidebar.camera_input("カメラで撮影（対応端末のみ）")
+    if cam:
+        uploaded_file = cam
+else:
+    st.sidebar.info("媒体入力を使用しない場合は、このままで構いません。")
 
-    # --- SWOTあり版プロンプト ---
-    sys_prompt_swot = """
-あなたは NERV の MAGI システム全体を模した統合AIです。
-Magi-Logic / Magi-Human / Magi-Reality / Magi-Media の4視点と、統合MAGIとしての結論、
-さらに意思決定に役立つSWOT分析を、以下のフォーマットだけを使って日本語で出力してください。
-
-[重要：出力フォーマット（この通りに出力すること）]
-
-【Magi-Logic】
-判定: 可決 または 保留 または 否決 のいずれか
-要約: 2〜3文、合計120文字以内
-
-【Magi-Human】
-判定: 可決 または 保留 または 否決 のいずれか
-要約: 2〜3文、合計120文字以内
-
-【Magi-Reality】
-判定: 可決 または 保留 または 否決 のいずれか
-要約: 2〜3文、合計120文字以内
-
-【Magi-Media】
-判定: 可決 または 保留 または 否決 のいずれか
-要約: 2〜3文、合計120文字以内
-
-【MAGI-統合サマリー】
-全体としての結論を150文字以内でまとめる
-
-【MAGI-統合詳細】
-統合的な視点から、2〜4段落・合計500文字以内で詳細なコメントと推奨アクションを書く
-
-【SWOT分析】
-Strengths: 強みを5〜7個、日本語で列挙し、読点「、」で区切って1行で書く（合計300文字以内）
-Weaknesses: 弱みを5〜7個、日本語で列挙し、読点「、」で区切って1行で書く（合計300文字以内）
-Opportunities: 機会を5〜7個、日本語で列挙し、読点「、」で区切って1行で書く（合計300文字以内）
-Threats: 脅威を5〜7個、日本語で列挙し、読点「、」で区切って1行で書く（合計300文字以内）
-
-[制約]
-- 箇条書き（・や番号付きリスト）は使わない。
-- 上記の見出し・ラベル以外の文言や飾りは追加しない。
-- 「Strengths:」「Weaknesses:」「Opportunities:」「Threats:」は英語ラベルをそのまま使う。
-- 暴力・自傷・違法行為などの過激な表現は避け、穏当で一般的な表現に言い換える。
-- 出力は必ずこのフォーマットに沿ったプレーンテキストのみとする。
-"""
-
-    # --- SWOTなし（軽量版）プロンプト ---
-    sys_prompt_basic = """
-あなたは NERV の MAGI システム全体を模した統合AIです。
-Magi-Logic / Magi-Human / Magi-Reality / Magi-Media の4視点と、統合MAGIとしての結論を、
-以下のフォーマットだけを使って日本語で出力してください。
-
-[重要：出力フォーマット（この通りに出力すること）]
-
-【Magi-Logic】
-判定: 可決 または 保留 または 否決 のいずれか
-要約: 2〜3文、合計120文字以内
-
-【Magi-Human】
-判定: 可決 または 保留 または 否決 のいずれか
-要約: 2〜3文、合計120文字以内
-
-【Magi-Reality】
-判定: 可決 または 保留 または 否決 のいずれか
-要約: 2〜3文、合計120文字以内
-
-【Magi-Media】
-判定: 可決 または 保留 または 否決 のいずれか
-要約: 2〜3文、合計120文字以内
-
-【MAGI-統合サマリー】
-全体としての結論を150文字以内でまとめる
-
-【MAGI-統合詳細】
-統合的な視点から、2〜3段落・合計400文字以内で詳細なコメントと推奨アクションを書く
-
-[制約]
-- 箇条書き（・や番号付きリスト）は使わない。
-- 上記の見出し・ラベル以外の文言や飾りは追加しない。
-- 出力は必ずこのフォーマットに沿ったプレーンテキストのみとする。
-"""
-
-    ctx_text = (
-        "【ユーザーからの情報】\n"
-        + f"質問: {trimmed_context['user_question']}\n"
-        + (
-            f"テキスト入力: {trimmed_context['text_input']}\n"
-            if trimmed_context["text_input"]
-            else ""
-        )
-        + (
-            f"音声文字起こし: {trimmed_context['audio_transcript']}\n"
-            if trimmed_context["audio_transcript"]
-            else ""
-        )
+with st.sidebar.expander("キャッシュ状況", expanded=False):
+    media_stats = get_media_cache().stats()
+    result_stats = get_result_cache().stats()
+    st.caption(
+        f"媒体キャッシュ：{media_stats['entries']}件 / "
+        f"ヒット {media_stats['hits']} / ミス {media_stats['misses']}"
+    )
+    st.caption(
+        f"分析結果キャッシュ：{result_stats['entries']}件 "
+        f"({result_stats['bytes'] // 1024} KB) / "
+        f"ヒット {result_stats['hits']} / ミス {result_stats['misses']}"
+    )
+    image_stats = get_image_cache().stats()
+    st.caption(
+        f"画像キャッシュ：{image_stats['entries']}件 "
+        f"({image_stats['bytes'] // 1024} KB) / "
+        f"ヒット {image_stats['hits']} / ミス {image_stats['misses']}"
+    )
+    report_stats = get_report_cache().stats()
+    report_builds = [
+        row for row in get_metrics().summary() if row["stage"] == "report.build" and row["status"] == "ok"
+    ]
+    st.caption(
+        f"レポート：{report_stats['entries']}件 "
+        f"({report_stats['bytes'] // 1024} KB) / "
+        f"ヒット {report_stats['hits']} / ミス {report_stats['misses']}"
         + (
-            f"画像説明: {trimmed_context['image_description']}\n"
-            if trimmed_context["image_description"]
+            f" ／ 作成 p50 {report_builds[0]['p50']:.2f} 秒・p95 {report_builds[0]['p95']:.2f} 秒"
+            if report_builds
             else ""
         )
     )
+    audio_stats = get_audio_cache().stats()
+    st.caption(
+        f"音声キャッシュ：{audio_stats['entries']}件 "
+        f"({audio_stats['bytes'] // 1024} KB) / "
+        f"ヒット {audio_stats['hits']} / ミス {audio_stats['misses']}"
+    )
+    spool_stats = get_text_spool().stats()
+    st.caption(
+        f"テキストファイル：{spool_stats['files']}件 "
+        f"({spool_stats['bytes'] // 1024} KB・一時ファイル) / "
+        f"ヒット {spool_stats['hits']} / ミス {spool_stats['misses']}"
+    )
 
-    def _call_internal(use_swot: bool, attempt: int) -> str | None:
-        sys_prompt = sys_prompt_swot if use_swot else sys_prompt_basic
-        max_tokens = 640 if use_swot else 480
-
-        try:
-            resp = model.generate_content(
-                [sys_prompt, ctx_text],
-                generation_config={"max_output_tokens": max_tokens},
+with st.sidebar.expander("レート制御・モデルの状況", expanded=False):
+    rpm, tpm = rate_limits_for(model_name)
+    st.caption(
+        f"{model_name} の上限：{rpm:g} リクエスト/分 ・ {tpm:,.0f} トークン/分"
+        if rpm or tpm
+        else "クライアント側のレート制御は無効です。"
+    )
+    for name, stats in get_rate_limiter().stats().items():
+        st.caption(
+            f"{name}：呼び出し {stats['calls']:.0f} 回 / 待機 {stats['throttled']:.0f} 回"
+            f"（計 {stats['wait_sec']:.1f} 秒） / 再試行 {stats['retries']:.0f} 回"
+            f" / 見送り {stats['rejected']:.0f} 回"
+        )
+    for name, stats in get_scheduler().stats().items():
+        average = stats["wait_sec"] / stats["queued"] if stats["queued"] else 0.0
+        st.caption(
+            f"{name}：実行中 {stats['running']}"
+            + (f"/{stats['limit']}" if stats["limit"] > 0 else "")
+            + f" / 順番待ち {stats['waiting']} 件（最大 {stats['max_depth']} 件）"
+            f" / 待たされた呼び出し {stats['queued']:.0f} 回（平均 {average:.1f} 秒・最長 {stats['max_wait_sec']:.1f} 秒）"
+            + (f" / 待ち切れず {stats['timeouts']:.0f} 回" if stats["timeouts"] else "")
+        )
+    flight_stats = get_single_flight().stats()
+    if flight_stats:
+        st.caption(
+            "同じ問い合わせの集約："
+            + " ／ ".join(
+                f"{group} 実行 {stats['calls']} 回・相乗り {stats['coalesced']} 回"
+                for group, stats in sorted(flight_stats.items())
             )
+        )
+    client_stats = get_model_backend().stats()
+    st.caption(
+        f"モデルの準備：{client_stats['models']} 個 / 作成 {client_stats['created']} 回"
+        f" / 使い回し {client_stats['reused']} 回"
+    )
+    for name, health in sorted(get_model_health().snapshot().items()):
+        cooldown = health["cooldown_remaining"]
+        st.caption(
+            f"{name}：p50 {health['p50']:.2f} 秒 / p95 {health['p95']:.2f} 秒"
+            f" / エラー率 {health['error_rate']:.0%}（直近 {health['samples']:.0f} 件）"
+            + (f" / 休止中（残り {cooldown:.0f} 秒）" if cooldown > 0 else "")
+        )
 
-            if not getattr(resp, "candidates", None):
-                if attempt == 1 and use_swot:
-                    # SWOTありで失敗した場合は、1回だけSWOTなし軽量モードで再試行
-                    return _call_internal(False, 2)
-                return None
-
-            first = resp.candidates[0]
-            content = getattr(first, "content", None)
-            parts = getattr(content, "parts", None)
-
-            if not content or not parts:
-                # finish_reason から原因を推定
-                reason = getattr(first, "finish_reason", None)
-                reason_str = str(reason).upper() if reason is not None else ""
-
-                if attempt == 1 and use_swot:
-                    # まずはSWOTなしに落として再チャレンジ
-                    return _call_internal(False, 2)
-
-                if "SAFETY" in reason_str:
-                    return (
-                        "【エラー】Gemini の安全ポリシーにより回答がブロックされました。\n"
-                        "・特定の個人攻撃、自傷行為、違法行為などに関する内容が含まれていないか確認してください。\n"
-                        "・表現をもっと一般的で穏やかなものに言い換えて再実行してみてください。"
-                    )
-                if "MAX_TOKENS" in reason_str or "TOKENS" in reason_str:
-                    return (
-                        "【エラー】Gemini の出力トークン上限に達し、回答を最後まで生成できませんでした。\n"
-                        "・質問や補足テキストをさらに短くしてください。\n"
-                        "・必要なポイントだけに絞って問い直してみてください。"
-                    )
-
-                return (
-                    "【エラー】Gemini が有効なテキストを返しませんでした。\n"
-                    "・入力内容が長すぎるか、安全ポリシーに抵触した可能性があります。\n"
-                    "・質問を短くし、刺激的な表現を避けて再実行してみてください。"
-                )
 
-            text = (getattr(resp, "text", "") or "").strip()
-            if not text:
-                if attempt == 1 and use_swot:
-                    # 空テキスト → SWOTなしで再試行
-                    return _call_internal(False, 2)
-                return (
-                    "【エラー】Gemini が統合MAGIのテキストを返しませんでした。\n"
-                    "内容が長すぎるか、一部が安全フィルタにかかった可能性があります。"
-                )
-
-            return text
+def render_trace_table(trace: List[Dict[str, Any]]) -> None:
+    st.dataframe(
+        [
+            {
+                "段階": span["stage"],
+                "モデル": span["model"],
+                "状態": span["status"],
+                "秒": round(span["sec"], 3),
+            }
+            for span in trace
+        ],
+        hide_index=True,
+    )
 
-        except ResourceExhausted as e:
-            if attempt == 1 and use_swot:
-                # まずはSWOTなしで軽く投げ直し
-                return _call_internal(False, 2)
 
-            detail = classify_resource_exhausted(e)
-            return (
-                "【エラー】Gemini で ResourceExhausted が発生しました。\n\n"
-                f"生メッセージ：{str(e)}\n\n"
-                f"{detail}"
-            )
-        except GoogleAPIError as e:
-            return f"【エラー】Gemini API で問題が発生しました: {str(e)}"
-        except Exception as e:
-            return f"【エラー】MAGI複合分析中に想定外のエラーが発生しました: {str(e)}"
+def _usage_line(label: str, totals: Dict[str, Dict[str, float]]) -> str:
+    if not totals:
+        return f"{label}：まだ使用していません。"
+    prompt = sum(t["prompt_tokens"] for t in totals.values())
+    output = sum(t["output_tokens"] for t in totals.values())
+    cost = sum(t["cost_usd"] for t in totals.values())
+    return f"{label}：入力 {prompt:,} / 出力 {output:,} トークン（推定 ${cost:.4f}）"
 
-    return _call_internal(enable_swot, 1)
 
+with st.sidebar.expander("トークン使用量", expanded=False):
+    usage_ledger = get_usage_ledger()
+    st.caption(
+        _usage_line("このセッション", usage_ledger.totals(session_id=st.session_state["usage_session_id"]))
+    )
+    today_usage = usage_ledger.today()
+    st.caption(_usage_line("本日（全セッション）", today_usage))
+    for name, t in sorted(today_usage.items()):
+        st.caption(
+            f"{name}：{t['calls']:.0f} 回 / 入力 {t['prompt_tokens']:,} / 出力 {t['output_tokens']:,}"
+            f"（推定 ${t['cost_usd']:.4f}）"
+        )
 
-# ======================================================
-# テキスト → 擬似エージェント構造＋SWOTへのパース
-# ======================================================
-def parse_magi_text(text: str) -> tuple[Dict[str, Any], Dict[str, str], Dict[str, str]]:
-    agents: Dict[str, Any] = {}
-    aggregated: Dict[str, str] = {"summary": "", "details": ""}
-    swot: Dict[str, str] = {
-        "strengths": "",
-        "weaknesses": "",
-        "opportunities": "",
-        "threats": "",
-    }
 
-    pattern = r"^【(Magi-Logic|Magi-Human|Magi-Reality|Magi-Media|MAGI-統合サマリー|MAGI-統合詳細|SWOT分析)】"
-    parts = re.split(pattern, text, flags=re.MULTILINE)
-
-    it = iter(parts[1:])  # 最初の要素は前置き
-
-    for name, body in zip(it, it):
-        body = body.strip()
-        if name == "Magi-Logic":
-            agents["logic"] = parse_agent_block("Magi-Logic（論理・構造担当）", body)
-        elif name == "Magi-Human":
-            agents["human"] = parse_agent_block("Magi-Human（感情・人間面担当）", body)
-        elif name == "Magi-Reality":
-            agents["reality"] = parse_agent_block("Magi-Reality（現実運用・リスク担当）", body)
-        elif name == "Magi-Media":
-            agents["media"] = parse_agent_block("Magi-Media（表現・印象担当）", body)
-        elif name == "MAGI-統合サマリー":
-            aggregated["summary"] = body.replace("\n", " ").strip()
-        elif name == "MAGI-統合詳細":
-            aggregated["details"] = body.strip()
-        elif name == "SWOT分析":
-            swot = parse_swot_block(body)
-
-    return agents, aggregated, swot
-
-
-def parse_agent_block(name_jp: str, body: str) -> Dict[str, Any]:
-    lines = [l.strip() for l in body.splitlines() if l.strip()]
-    decision_jp = "保留"
-    summary = ""
-
-    for line in lines:
-        if line.startswith("判定"):
-            if "可決" in line:
-                decision_jp = "可決"
-            elif "否決" in line:
-                decision_jp = "否決"
-            elif "保留" in line:
-                decision_jp = "保留"
-        elif line.startswith("要約"):
-            summary = line.replace("要約", "").replace(":", "").replace("：", "").strip()
-        else:
-            if summary:
-                summary += " " + line
+def _record_history(result: Dict[str, Any], session_id: str) -> Optional[int]:
+    """分析結果を履歴に保存する（媒体は media_ref のハッシュだけ）。"""
+    context = result["context"]
+    return get_history().record(
+        question=context.get("user_question", ""),
+        model=result["model_name"],
+        answered_model=result["answered_model"],
+        mode=result["execution_mode"],
+        enable_swot=result["enable_swot"],
+        raw_text=result["magi_text"],
+        votes={key: agent.get("decision_jp", "保留") for key, agent in result["agents"].items()},
+        summary=result["aggregated"].get("summary", ""),
+        swot=result["swot"] if result["enable_swot"] else None,
+        inputs={
+            "text_input": context.get("text_input", ""),
+            "audio_transcript": context.get("audio_transcript", ""),
+            "image_description": context.get("image_description", ""),
+            "long_input": bool(context.get("long_input")),
+            "media": result.get("media_ref"),
+        },
+        timings=result["timings"],
+        usage=result["run_usage"],
+        meta={
+            "answered": result["answered"],
+            "preflight": result["preflight"],
+            "long_input": result["long_input"],
+            "stream_mode": result["stream_mode"],
+        },
+        session_id=session_id,
+    )
 
-    decision_code = {
-        "可決": "Go",
-        "否決": "No-Go",
-        "保留": "Hold",
-    }.get(decision_jp, "Hold")
 
+def _result_from_history(entry: Dict[str, Any]) -> Dict[str, Any]:
+    """履歴の1件を、render_magi_result でそのまま描ける形に戻す（Gemini は呼ばない）。"""
+    inputs = entry["inputs"] or {}
+    meta = entry["meta"] or {}
+    agents, aggregated, swot = parse_magi_text(entry["raw_text"])
     return {
-        "name_jp": name_jp,
-        "summary": summary,
-        "decision_jp": decision_jp,
-        "decision_code": decision_code,
+        "inputs": None,
+        "warnings": [],
+        "history_id": entry["id"],
+        "opened_from_history": entry["created_at"],
+        "context": {
+            "user_question": entry["question"],
+            "text_input": inputs.get("text_input", ""),
+            "audio_transcript": inputs.get("audio_transcript", ""),
+            "image_description": inputs.get("image_description", ""),
+        },
+        # 画像そのものは保存していないので、レポートには貼られない
+        "image_for_report": None,
+        "media_ref": inputs.get("media"),
+        "magi_text": entry["raw_text"],
+        "agents": agents,
+        "aggregated": aggregated,
+        "swot": swot,
+        "enable_swot": entry["enable_swot"],
+        "execution_mode": entry["mode"],
+        "stream_mode": meta.get("stream_mode", False),
+        "model_name": entry["model"],
+        "answered_model": entry["answered_model"],
+        "answered": meta.get("answered") or {},
+        "timings": entry["timings"] or {"total": 0.0},
+        "preflight": meta.get("preflight") or {"prompt_tokens": 0, "source": "estimate"},
+        "long_input": meta.get("long_input") or {},
+        "run_usage": entry["usage"] or {},
+        "reports": {},
     }
 
 
-def parse_swot_block(body: str) -> Dict[str, str]:
-    swot = {
-        "strengths": "",
-        "weaknesses": "",
-        "opportunities": "",
-        "threats": "",
-    }
-    lines = [l.strip() for l in body.splitlines() if l.strip()]
-    for line in lines:
-        if line.startswith("Strengths"):
-            swot["strengths"] = line.split(":", 1)[-1].strip()
-        elif line.startswith("Weaknesses"):
-            swot["weaknesses"] = line.split(":", 1)[-1].strip()
-        elif line.startswith("Opportunities"):
-            swot["opportunities"] = line.split(":", 1)[-1].strip()
-        elif line.startswith("Threats"):
-            swot["threats"] = line.split(":", 1)[-1].strip()
-    return swot
-
-
-def decision_to_css(decision_code: str) -> Dict[str, str]:
-    code = (decision_code or "Hold").strip()
-    if code == "Go":
-        return {"css": "approve", "en": "APPROVE", "jp": "可決"}
-    if code == "No-Go":
-        return {"css": "reject", "en": "REJECT", "jp": "否決"}
-    return {"css": "hold", "en": "HOLD", "jp": "保留"}
-
-
-def swot_text_to_chips(text: str, chip_class: str) -> str:
-    if not text:
-        return ""
-    items = [x.strip() for x in text.replace("。", "、").split("、") if x.strip()]
-    html_items = "".join(
-        f'<span class="swot-chip {chip_class}">{clean_text_for_display(item)}</span>'
-        for item in items
-    )
-    count_label = f'<div class="swot-count-label">項目数: {len(items)}</div>'
-    return count_label + html_items
-
+def _open_history(entry_id: int) -> None:
+    entry = get_history().get(entry_id)
+    if entry is None:
+        st.session_state["history_missing"] = True
+        return
+    st.session_state["magi_result"] = _result_from_history(entry)
+    st.query_params.pop("job", None)
+
+
+if get_setting("MAGI_HISTORY_ENABLED", True):
+    with st.sidebar.expander("分析履歴", expanded=False):
+        history = get_history()
+        history_query = st.text_input("キーワード（質問・サマリー）", key="history_query")
+        col_model, col_decision = st.columns(2)
+        with col_model:
+            history_model = st.selectbox("モデル", ["すべて"] + history.models(), key="history_model")
+        with col_decision:
+            history_decision = st.selectbox("総合判定", ["すべて", *DECISIONS], key="history_decision")
+        entries = history.search(
+            history_query,
+            model=None if history_model == "すべて" else history_model,
+            decision=None if history_decision == "すべて" else history_decision,
+            limit=get_setting("MAGI_HISTORY_LIST_LIMIT", 20),
+        )
+        if st.session_state.pop("history_missing", False):
+            st.warning("この履歴は保存期間・件数の上限により削除されました。")
+        for entry in entries:
+            question = entry["question"] or "（質問なし）"
+            st.button(
+                f"{time.strftime('%m/%d %H:%M', time.localtime(entry['created_at']))}"
+                f" ｜ {entry['decision']} ｜ {question[:24]}{'…' if len(question) > 24 else ''}",
+                key=f"history_open_{entry['id']}",
+                on_click=_open_history,
+                args=(entry["id"],),
+                help=entry["summary"][:200] or None,
+                use_container_width=True,
+            )
+        if not entries:
+            st.caption("該当する履歴はありません。" if history_query else "まだ履歴がありません。")
+        history_stats = history.stats()
+        st.caption(
+            f"保存件数：{history_stats['entries']}件（{history_stats['bytes'] // 1024} KB）"
+            + ("" if history_stats["fts"] else " ／ 全文検索は使えないため部分一致で検索します")
+        )
 
-# ======================================================
-# Word レポート生成（SWOT ON のときだけ第4章を追加）
-# ======================================================
-def build_word_report(
-    context: Dict[str, Any],
-    agents: Dict[str, Any],
-    aggregated: Dict[str, Any],
-    magi_raw_text: str,
-    image: Optional[Image.Image] = None,
-    swot: Optional[Dict[str, str]] = None,
-    enable_swot: bool = False,
-) -> bytes:
-    doc = docx.Document()
-    title = "MAGI風マルチAI分析レポート（テキスト簡易版"
-    if enable_swot:
-        title += "＋SWOT"
-    title += "）"
-    doc.add_heading(title, level=1)
-
-    # 第1章 入力情報
-    doc.add_heading("第1章 入力情報", level=2)
-    doc.add_paragraph(f"■ ユーザー質問：{context.get('user_question', '')}")
-    if context.get("text_input"):
-        doc.add_paragraph("■ テキスト入力：")
-        doc.add_paragraph(context["text_input"])
-    if context.get("audio_transcript"):
-        doc.add_paragraph("■ 音声文字起こし：")
-        doc.add_paragraph(context["audio_transcript"])
-    if context.get("image_description"):
-        doc.add_paragraph("■ 画像の説明：")
-        doc.add_paragraph(context["image_description"])
-
-    if image is not None:
-        img_stream = io.BytesIO()
-        image.save(img_stream, format="PNG")
-        img_stream.seek(0)
-        doc.add_picture(img_stream, width=docx.shared.Inches(3))
-
-    # 第2章 各MAGIエージェントの要約
-    doc.add_heading("第2章 各MAGIエージェントの要約と判定", level=2)
-    if agents:
-        for key in ["logic", "human", "reality", "media"]:
-            if key not in agents:
-                continue
-            a = agents[key]
-            name = a.get("name_jp", key)
-            doc.add_heading(name, level=3)
-            doc.add_paragraph(f"判定：{a.get('decision_jp', '')}")
-            doc.add_paragraph(f"要約：{clean_text_for_display(a.get('summary', ''))}")
-    else:
-        doc.add_paragraph("今回の実行では、MAGIエージェントの詳細出力は取得できませんでした。")
-
-    # 第3章 MAGI統合AIの結論
-    doc.add_heading("第3章 MAGI統合AIの結論・アクションプラン", level=2)
-    agg_summary = clean_text_for_display(aggregated.get("summary", ""))
-    agg_details = clean_text_for_display(aggregated.get("details", ""))
-    if agg_summary:
-        doc.add_paragraph("【サマリー】")
-        doc.add_paragraph(agg_summary)
-    if agg_details:
-        doc.add_paragraph("【詳細】")
-        for line in agg_details.splitlines():
-            doc.add_paragraph(line)
-
-    # 第4章 SWOT分析（ON のときだけ）
-    if enable_swot and swot:
-        if any(swot.values()):
-            doc.add_heading("第4章 SWOT分析", level=2)
-            doc.add_paragraph(f"Strengths（強み）：{swot.get('strengths', '')}")
-            doc.add_paragraph(f"Weaknesses（弱み）：{swot.get('weaknesses', '')}")
-            doc.add_paragraph(f"Opportunities（機会）：{swot.get('opportunities', '')}")
-            doc.add_paragraph(f"Threats（脅威）：{swot.get('threats', '')}")
-        else:
-            doc.add_heading("第4章 SWOT分析", level=2)
-            doc.add_paragraph("今回の実行では、SWOT分析は生成されませんでした。")
 
-    # 付録：生テキスト
-    doc.add_heading("付録：MAGI生テキスト", level=2)
-    for line in magi_raw_text.splitlines():
-        doc.add_paragraph(line)
+JOB_STATUS_LABELS = {
+    "queued": "待機中",
+    "running": "実行中",
+    "done": "完了",
+    "error": "失敗",
+    "cancelled": "取り消し",
+    "timeout": "時間切れ",
+}
 
-    buf = io.BytesIO()
-    doc.save(buf)
-    buf.seek(0)
-    return buf.getvalue()
 
+def _open_job(job_id: str) -> None:
+    job_id = job_id.strip()
+    if not job_id:
+        return
+    st.session_state["magi_job_id"] = job_id
+    st.query_params["job"] = job_id
 
-# ======================================================
-# サイドバー：媒体入力
-# ======================================================
-st.sidebar.markdown("### 媒体入力（任意）")
 
-input_mode = st.sidebar.radio(
-    "画像・音声の入力方法",
-    ["ファイル／写真ライブラリから選択", "カメラで撮影", "使用しない"],
-    index=2,
-)
+with st.sidebar.expander("バックグラウンドジョブ", expanded=False):
+    job_queue = get_job_queue()
+    st.text_input("ジョブ ID", key="job_id_input", help="別のタブ・セッションで実行したジョブの結果も開けます。")
+    st.button(
+        "このジョブを開く",
+        on_click=lambda: _open_job(st.session_state.get("job_id_input", "")),
+        use_container_width=True,
+    )
+    for job_entry in job_queue.recent(st.session_state["usage_session_id"], limit=5):
+        st.button(
+            f"{time.strftime('%H:%M:%S', time.localtime(job_entry['created_at']))}"
+            f" ｜ {JOB_STATUS_LABELS.get(job_entry['status'], job_entry['status'])}"
+            f" ｜ {job_entry['label'] or '（質問なし）'}",
+            key=f"job_open_{job_entry['id']}",
+            on_click=_open_job,
+            args=(job_entry["id"],),
+            help=f"ジョブ ID：{job_entry['id']}",
+            use_container_width=True,
+        )
+    job_counts = job_queue.stats()
+    st.caption(
+        " ／ ".join(f"{JOB_STATUS_LABELS[status]} {count}" for status, count in job_counts.items())
+    )
 
-uploaded_file: Optional[Any] = None
-image_for_report: Optional[Image.Image] = None
 
-if input_mode == "ファイル／写真ライブラリから選択":
-    file = st.sidebar.file_uploader(
-        "画像 / 音声 / テキストファイル",
-        accept_multiple_files=False,
-    )
-    if file:
-        uploaded_file = file
-elif input_mode == "カメラで撮影":
-    cam = st.sidebar.camera_input("カメラで撮影（対応端末のみ）")
-    if cam:
-        uploaded_file = cam
-else:
-    st.sidebar.info("媒体入力を使用しない場合は、このままで構いません。")
+# 処理段階ごとの所要時間（この実行分は分析完了後に追記する）
+perf_panel = None
+if get_setting("MAGI_SHOW_PERFORMANCE_PANEL", True):
+    perf_panel = st.sidebar.expander("パフォーマンス", expanded=False)
+    with perf_panel:
+        rows = [r for r in get_metrics().summary() if r["count"]]
+        if rows:
+            st.caption("全セッションの集計（p50 / p95 は直近の値から算出）")
+            st.dataframe(
+                [
+                    {
+                        "段階": r["stage"],
+                        "モデル": r["model"],
+                        "状態": r["status"],
+                        "回数": r["count"],
+                        "p50秒": round(r["p50"], 3),
+                        "p95秒": round(r["p95"], 3),
+                    }
+                    for r in rows
+                ],
+                hide_index=True,
+            )
+            st.download_button(
+                "Prometheus 形式でダウンロード",
+                data=get_metrics().prometheus_text(),
+                file_name="magi_metrics.prom",
+                mime="text/plain",
+            )
+            st.download_button(
+                "JSON Lines 形式でダウンロード",
+                data=get_metrics().jsonl_text(),
+                file_name="magi_metrics.jsonl",
+                mime="application/x-ndjson",
+            )
+        else:
+            st.caption("まだ計測データがありません。")
+        if st.session_state.get("last_trace"):
+            st.caption("前回の実行")
+            render_trace_table(st.session_state["last_trace"])
 
 
 # ======================================================
@@ -925,258 +906,529 @@ enable_swot = st.checkbox(
     value=False,
 )
 
-if not user_question and not uploaded_file and not text_input:
+stream_mode = st.checkbox(
+    "ストリーミング表示（完成したセクションから順に表示）",
+    value=True,
+)
+
+long_input_mode = st.checkbox(
+    "長文入力モード（長いテキスト・文字起こしは分割して要約してから MAGI に渡す）",
+    value=get_setting("MAGI_LONG_INPUT_MODE", False),
+    help="オフのときは各入力欄を 600 文字で切り詰めます。要約はチャンクごとにキャッシュされます。",
+)
+
+EXECUTION_MODES = {
+    "一括（1回の呼び出しで全視点を生成）": "single",
+    "並列（エージェントごとに同時実行して統合）": "fanout",
+}
+execution_mode = EXECUTION_MODES[
+    st.radio(
+        "実行モード",
+        list(EXECUTION_MODES.keys()),
+        index=0,
+        horizontal=True,
+        help="並列モードは各エージェントを短いリクエストで同時に実行し、最後に統合MAGIがまとめます。",
+    )
+]
+
+if (
+    not user_question
+    and not uploaded_file
+    and not text_input
+    and "magi_result" not in st.session_state
+    and "magi_job_id" not in st.session_state
+):
     st.info("質問か、媒体（画像・音声など）、または補足テキストのいずれかを入力してください。")
     st.stop()
 
 # ======================================================
 # 媒体の前処理（テキスト化）
 # ======================================================
+# ここから分析完了までのスパン（媒体の前処理・Gemini 呼び出し・パース・描画・レポート）を集める
+run_trace = start_trace()
+
 context: Dict[str, Any] = {
     "user_question": user_question,
     "text_input": text_input,
     "audio_transcript": "",
     "image_description": "",
+    "long_input": long_input_mode,
 }
 
+def _media_state(uploaded: Any) -> Dict[str, Any]:
+    """
+    アップロードごとの前処理結果（画像の説明・文字起こし・取り込んだテキストなど）。
+    ボタンやダウンロードによる再実行では、同じアップロード・モデルなら前処理をやり直さない。
+    """
+    key = (uploaded.file_id, uploaded.size, model_name)
+    state = st.session_state.get("media_state")
+    if state is None or state["key"] != key:
+        # 履歴には中身ではなくハッシュだけを残す
+        state = {
+            "key": key,
+            "ref": {
+                "name": uploaded.name,
+                "mime_type": uploaded.type,
+                "bytes": uploaded.size,
+                "sha256": hashlib.sha256(uploaded.getvalue()).hexdigest(),
+            },
+        }
+        st.session_state["media_state"] = state
+    return state
+
+
 if uploaded_file is not None:
+    media = _media_state(uploaded_file)
     if uploaded_file.type and uploaded_file.type.startswith("image/"):
-        try:
-            image = Image.open(uploaded_file).convert("RGB")
-        except Exception:
+        if "image_for_report" not in media:
+            upload_bytes = uploaded_file.getvalue()
+            try:
+                # 向き補正・縮小・再エンコード（アップロードごとにキャッシュ）
+                media["image_for_model"] = prepare_image_cached(upload_bytes, "model")
+                media["image_for_report"] = prepare_image_cached(upload_bytes, "report")
+            except Exception:
+                media["image_for_report"] = None
+        image_for_report = media["image_for_report"]
+
+        if image_for_report is None:
             st.error("この画像形式には対応していません。JPEG または PNG 形式の画像を使用してください。")
-            image = None
-
-        if image is not None:
-            image_for_report = image
-            st.image(image, caption="入力画像", use_column_width=True)
+        else:
+            image_for_model = media["image_for_model"]
+            st.image(image_for_report.data, caption="入力画像", use_column_width=True)
+            st.caption(
+                f"画像サイズ：元 {image_for_model.original_bytes / 1024:,.0f} KB"
+                f"（{image_for_model.original_size[0]}×{image_for_model.original_size[1]}）"
+                f" → 送信 {len(image_for_model.data) / 1024:,.0f} KB"
+                f"（{image_for_model.size[0]}×{image_for_model.size[1]}）"
+                f" ／ レポート {len(image_for_report.data) / 1024:,.0f} KB"
+            )
 
-            with st.spinner("画像内容を解析中（Gemini）..."):
-                img_desc = describe_image_with_gemini(image)
-            context["image_description"] = img_desc
+            image_description = media.get("image_description")
+            if image_description is None:
+                with st.spinner("画像内容を解析中（Gemini）..."):
+                    image_description = describe_image_cached(
+                        uploaded_file.getvalue(), uploaded_file.type, model_name
+                    )
+                # 【エラー】〜 は覚えず、次の再実行で解析し直す
+                if not is_error_text(image_description):
+                    media["image_description"] = image_description
+            context["image_description"] = image_description
 
     elif uploaded_file.type and uploaded_file.type.startswith("audio/"):
         st.audio(uploaded_file)
-        with st.spinner("音声を文字起こし中（Gemini）..."):
-            transcript = transcribe_audio_with_gemini(uploaded_file)
-        context["audio_transcript"] = transcript
+        if "audio_transcript" not in media:
+            progress_slot = st.empty()
+            audio_meta: Dict[str, Any] = {}
+
+            def _on_segment(done: int, total: int, segment: AudioSegment, ok: bool) -> None:
+                progress_slot.progress(
+                    done / total,
+                    text=(
+                        f"音声を区間ごとに文字起こし中… {done}/{total} 区間"
+                        f"（{format_timestamp(segment.start_sec)}–{format_timestamp(segment.end_sec)}"
+                        + (" 完了）" if ok else " 失敗）")
+                    ),
+                )
+
+            # モノラル化・リサンプリング・前後の無音除去（アップロードごとにキャッシュ）
+            audio = prepare_audio_cached(uploaded_file.getvalue(), uploaded_file.type)
+            t_transcribe = time.perf_counter()
+            with st.spinner("音声を文字起こし中（Gemini）..."):
+                transcript = transcribe_audio_segmented(
+                    audio.data,
+                    audio.mime_type,
+                    model_name,
+                    on_progress=_on_segment,
+                    meta=audio_meta,
+                )
+            progress_slot.empty()
+            media.update(
+                audio=audio,
+                audio_meta=audio_meta,
+                transcribe_sec=time.perf_counter() - t_transcribe,
+                audio_transcript=transcript,
+            )
+        audio = media["audio"]
+        audio_meta = media["audio_meta"]
+        transcribe_sec = media["transcribe_sec"]
+        if audio.processed:
+            st.caption(
+                f"音声サイズ：元 {audio.original_bytes / 1024:,.0f} KB"
+                f"（{audio.original_sample_rate / 1000:g} kHz・{audio.original_channels}ch・"
+                f"{format_timestamp(audio.original_duration_sec)}）"
+                f" → 送信 {len(audio.data) / 1024:,.0f} KB"
+                f"（{audio.sample_rate / 1000:g} kHz・モノラル・{format_timestamp(audio.duration_sec)}"
+                + (f"・前後の無音 {audio.trimmed_sec:.1f} 秒を除去" if audio.trimmed_sec >= 0.1 else "")
+                + f"） ／ 文字起こし {transcribe_sec:.2f} 秒"
+            )
+        else:
+            st.caption(
+                f"音声サイズ：{audio.original_bytes / 1024:,.0f} KB（WAV 以外のため未加工）"
+                f" ／ 文字起こし {transcribe_sec:.2f} 秒"
+            )
+        context["audio_transcript"] = media["audio_transcript"]
+        if audio_meta.get("failed_segments"):
+            st.warning(
+                f"{audio_meta['segments']} 区間のうち {audio_meta['failed_segments']} 区間の文字起こしに失敗しました。"
+                "もう一度実行すると、失敗した区間だけを文字起こしし直します。"
+            )
+            # 次の再実行で失敗した区間を文字起こしし直す
+            del media["audio_transcript"]
+        elif audio_meta.get("segments"):
+            st.caption(f"音声を {audio_meta['segments']} 区間に分けて並列に文字起こししました。")
 
     else:
         if (uploaded_file.type == "text/plain") or (
             isinstance(uploaded_file.name, str)
             and uploaded_file.name.lower().endswith(".txt")
         ):
-            text_bytes = uploaded_file.read()
-            context["text_input"] += "\n\n[ファイル内容]\n" + text_bytes.decode(
-                "utf-8", errors="ignore"
+            # 文字コードを判定しながら一時ファイルへ取り込み、本文はプロンプトに必要な分だけ読む
+            # 一時ファイルが消えていたら（プロセスの再起動など）取り込み直す
+            if "text_file" not in media or not media["text_file"].exists():
+                media["text_file"] = ingest_text_upload(uploaded_file)
+            text_file = media["text_file"]
+            context["text_file"] = text_file
+            st.caption(
+                f"テキストファイル：{text_file.bytes_read / 1024:,.0f} KB"
+                f"（{text_file.encoding}・{text_file.chars:,} 文字）を取り込みました。"
             )
+            if text_file.truncated:
+                st.warning(
+                    f"ファイルが大きいため、先頭 {text_file.bytes_read / 1024 / 1024:,.1f} MB だけを取り込みました"
+                    f"（全体 {text_file.total_bytes / 1024 / 1024:,.1f} MB）。"
+                )
+            if text_file.lossy:
+                st.warning("文字コードを判定できなかったため、読めない文字は置き換えて取り込みました。")
         else:
             st.warning("対応していないファイル形式です。画像・音声・テキストファイルを使用してください。")
 
 # ======================================================
-# MAGI 分析実行（コメントを問の近くに表示）
+# MAGI 分析実行（結果は session_state に残し、再実行では描画だけやり直す）
 # ======================================================
-run_analysis = st.button("🔎 MAGI による分析を実行", type="primary")
+# 前回の結果がどの入力に対するものか（入力が変わったら、その旨を表示する）
+run_inputs = (
+    user_question,
+    text_input,
+    st.session_state["media_state"]["key"] if uploaded_file is not None else None,
+    enable_swot,
+    execution_mode,
+    long_input_mode,
+    model_name,
+)
 
-if run_analysis:
-    if not user_question and not text_input and not any(
-        [context["audio_transcript"], context["image_description"]]
-    ):
-        st.warning("最低でも質問・テキスト・媒体のいずれかが必要です。")
-        st.stop()
 
-    with st.spinner("MAGI 分析を実行中..."):
-        magi_text = call_magi_plain(context, enable_swot=enable_swot)
+def _active_job_id() -> Optional[str]:
+    """このセッションで追いかけている、まだ終わっていないジョブの ID。"""
+    job_id = st.session_state.get("magi_job_id")
+    if job_id is None:
+        return None
+    entry = get_job_queue().get(job_id, with_result=False)
+    return job_id if entry is not None and entry["status"] in ACTIVE_STATUSES else None
+
+
+def _request_run(refresh: bool) -> None:
+    # 同じセッションの分析が実行中なら受け付けない（ボタンの連打で Gemini を二重に呼ばない）
+    if _active_job_id() is not None:
+        st.session_state["magi_run_rejected"] = True
+        return
+    st.session_state["magi_run_request"] = {"refresh": refresh}
+
+
+def analyze_magi(job: Job, params: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    ジョブのワーカーで分析して、画面の再描画とレポート作成に必要なものを dict で返す。
+    Streamlit の画面には触らず、途中経過は job.progress() でジョブ表に書く（画面は render_job_progress が読む）。
+    """
+    context = params["context"]
+    model_name = params["model_name"]
+    enable_swot = params["enable_swot"]
+    session_id = params["session_id"]
+    result: Dict[str, Any] = {"inputs": params["inputs"], "warnings": []}
+
+    def _on_queue(model: str, position: int) -> None:
+        job.progress(f"{model} の実行待ちです（順番待ち {position} 番目）" if position else "MAGI 分析を実行中")
+
+    set_usage_session(session_id)
+    set_scheduler_caller(session_id, PRIORITY_INTERACTIVE, _on_queue)
+
+    with collect_trace() as trace:
+        # 長文入力モード：予算を超える入力欄を先に要約しておく（以降の呼び出しではそのまま使われる）
+        long_input_stats: Dict[str, Any] = {}
+        magi_context = context
+        if params["long_input_mode"]:
+            job.progress("長い入力を要約中")
+            magi_context = condense_context(context, model_name, long_input_stats)
+
+        # 呼び出し前の見積もり（count_tokens の結果はキャッシュされる）
+        preflight = preflight_magi(magi_context, enable_swot, model_name)
+        result["warnings"] = list(preflight["warnings"])
+        usage_before = get_usage_ledger().totals(session_id=session_id)
+
+        timings: Dict[str, float] = {}
+        received: List[str] = []
+        t_start = time.perf_counter()
+
+        def _on_sections(keys: List[str], parser: MagiStreamParser) -> None:
+            if "first_panel" not in timings:
+                timings["first_panel"] = time.perf_counter() - t_start
+            received.extend(k for k in keys if k not in received)
+            job.progress(
+                f"MAGI 分析を実行中（{len(received)}/{len(ALL_SECTION_KEYS)} セクション受信）",
+                partial={
+                    "enable_swot": enable_swot,
+                    "keys": received,
+                    "agents": parser.agents,
+                    "aggregated": parser.aggregated,
+                    "swot": parser.swot,
+                },
+            )
+
+        answered: Dict[str, Any] = {}
+        job.progress("MAGI 分析を実行中")
+        if params["execution_mode"] == "fanout":
+            magi_text = fanout_magi_plain(
+                magi_context,
+                enable_swot=enable_swot,
+                on_sections=_on_sections,
+                model_name=model_name,
+                meta=answered,
+                refresh=params["refresh"],
+            )
+        elif params["stream_mode"]:
+            magi_text = stream_magi_plain(
+                magi_context,
+                enable_swot=enable_swot,
+                on_sections=_on_sections,
+                model_name=model_name,
+                meta=answered,
+                refresh=params["refresh"],
+            )
+        else:
+            magi_text = call_magi_plain(
+                magi_context,
+                enable_swot=enable_swot,
+                model_name=model_name,
+                meta=answered,
+                refresh=params["refresh"],
+            )
+        timings["total"] = time.perf_counter() - t_start
+        get_metrics().observe("run.total", timings["total"], model_name)
+    result["trace"] = trace
 
     if magi_text is None:
         # 本当にテキストが返らなかった場合だけ、共通の案内を出す
-        st.error(
+        result["error"] = (
             "【エラー】Gemini が有効なテキストを返しませんでした。\n"
             "・内容が極端に長い\n・安全フィルタにかかる表現が含まれている\nなどの可能性があります。\n\n"
             "一度、質問やテキストを短く・穏やかな表現にして再実行してみてください。"
         )
-        st.stop()
-
+        return result
     if isinstance(magi_text, str) and magi_text.startswith("【エラー】"):
         # ResourceExhausted / Safety / MAX_TOKENS など、詳細メッセージをそのまま表示
-        st.error(magi_text)
-        st.stop()
+        result["error"] = magi_text
+        return result
 
     agents, aggregated, swot = parse_magi_text(magi_text)
 
-    st.success("MAGI の分析が完了しました。")
-
-    # ▼ 質問のすぐ下にコメント欄を配置
-    st.markdown(
-        '<div class="magi-section-title">OUTPUT · MAGI COMMENTS</div><hr class="magi-divider">',
-        unsafe_allow_html=True,
+    usage_after = get_usage_ledger().totals(session_id=session_id)
+    result.update(
+        context=context,
+        image_for_report=params["image_for_report"],
+        media_ref=params["media_ref"],
+        magi_text=magi_text,
+        agents=agents,
+        aggregated=aggregated,
+        swot=swot,
+        enable_swot=enable_swot,
+        execution_mode=params["execution_mode"],
+        stream_mode=params["stream_mode"],
+        model_name=model_name,
+        answered_model=answered.get("model") or model_name,
+        answered=answered,
+        timings=timings,
+        preflight={k: preflight[k] for k in ("prompt_tokens", "source")},
+        long_input=long_input_stats.get("long_input", {}),
+        run_usage={
+            name: {
+                key: value - usage_before.get(name, {}).get(key, 0)
+                for key, value in totals.items()
+            }
+            for name, totals in usage_after.items()
+            if totals["calls"] != usage_before.get(name, {}).get("calls", 0)
+        },
+        # ダウンロードされた形式のレポート（形式 → bytes）
+        reports={},
     )
+    if get_setting("MAGI_HISTORY_ENABLED", True):
+        result["history_id"] = _record_history(result, session_id)
+    export_metrics()
+    return result
 
-    colL, colR = st.columns(2)
 
-    # 左側：Logic / Reality
-    with colL:
-        if "logic" in agents:
-            a = agents["logic"]
-            dec = decision_to_css(a.get("decision_code", "Hold"))
-            st.markdown("##### Magi-Logic")
-            st.markdown(
-                f'''
-                <div class="magi-panel magi-panel-logic">
-                  <div class="magi-vote magi-vote-{dec["css"]}">
-                    <div class="magi-vote-label-en">{dec["en"]}</div>
-                    <div class="magi-vote-label-jp">{dec["jp"]}</div>
-                  </div>
-                  <div class="magi-panel-summary">
-                    {clean_text_for_display(a.get("summary", "")).replace("\\n", "<br>")}
-                  </div>
-                </div>
-                ''',
-                unsafe_allow_html=True,
-            )
+# ジョブ表に保存しない値（別のプロセスで開いた結果では、レポートにも含まれない）
+JOB_RESULT_OMITTED_LABELS = {"image_for_report": "画像", "text_file": "添付テキストファイル"}
 
-        if "reality" in agents:
-            a = agents["reality"]
-            dec = decision_to_css(a.get("decision_code", "Hold"))
-            st.markdown("##### Magi-Reality")
-            st.markdown(
-                f'''
-                <div class="magi-panel magi-panel-reality">
-                  <div class="magi-vote magi-vote-{dec["css"]}">
-                    <div class="magi-vote-label-en">{dec["en"]}</div>
-                    <div class="magi-vote-label-jp">{dec["jp"]}</div>
-                  </div>
-                  <div class="magi-panel-summary">
-                    {clean_text_for_display(a.get("summary", "")).replace("\\n", "<br>")}
-                  </div>
-                </div>
-                ''',
-                unsafe_allow_html=True,
-            )
 
-    # 右側：Human / Media
-    with colR:
-        if "human" in agents:
-            a = agents["human"]
-            dec = decision_to_css(a.get("decision_code", "Hold"))
-            st.markdown("##### Magi-Human")
-            st.markdown(
-                f'''
-                <div class="magi-panel magi-panel-human">
-                  <div class="magi-vote magi-vote-{dec["css"]}">
-                    <div class="magi-vote-label-en">{dec["en"]}</div>
-                    <div class="magi-vote-label-jp">{dec["jp"]}</div>
-                  </div>
-                  <div class="magi-panel-summary">
-                    {clean_text_for_display(a.get("summary", "")).replace("\\n", "<br>")}
-                  </div>
-                </div>
-                ''',
-                unsafe_allow_html=True,
-            )
+def _job_result_for_table(result: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    ジョブ表に保存する結果。画像と添付テキストファイル（一時ファイル）は保存せず、
+    落としたものを "omitted" に残す。入力の比較（inputs）・作成済みのレポートは同じセッションでしか使わない。
+    """
+    stored = dict(result, inputs=None, reports={}, image_for_report=None, omitted=[])
+    if result.get("image_for_report") is not None:
+        stored["omitted"].append("image_for_report")
+    if "context" in result:
+        stored["context"] = {k: v for k, v in result["context"].items() if k != "text_file"}
+        if result["context"].get("text_file") is not None:
+            stored["omitted"].append("text_file")
+    return stored
+
+
+def _finish_job(entry: Dict[str, Any]) -> None:
+    """終わったジョブの結果を session_state に移す（失敗・取り消しは次の描画で知らせる）。"""
+    st.session_state.pop("magi_job_id", None)
+    if entry["status"] != STATUS_DONE:
+        if entry["status"] == STATUS_TIMEOUT:
+            notice = ("warning", f"分析が制限時間（{entry['timeout_sec']:.0f} 秒）を超えたため打ち切りました。")
+        elif entry["status"] == "cancelled":
+            notice = ("info", "分析を取り消しました。")
+        else:
+            notice = ("error", f"分析ジョブが失敗しました：{entry['error']}")
+        st.session_state["magi_job_notice"] = notice
+        return
+    result = entry["result"]
+    if result is None:
+        st.session_state["magi_job_notice"] = ("error", f"ジョブ {entry['id']} の結果を読み出せません：{entry['error']}")
+        return
+    if not entry["in_memory"]:
+        # ジョブ表（JSON）から戻した結果。omitted の値はレポートに含まれない
+        result.update(opened_from_job=entry["finished_at"])
+    result["job_id"] = entry["id"]
+    st.session_state["magi_result"] = result
+    st.session_state["last_trace"] = st.session_state.pop("magi_job_trace", []) + result.get("trace", [])
+
+
+@st.fragment(run_every=get_setting("MAGI_JOB_POLL_SEC", 1.0))
+def render_job_progress(job_id: str) -> None:
+    """実行中のジョブの進捗と途中経過を定期的に描き直し、終わったら画面全体を再実行する。"""
+    entry = get_job_queue().get(job_id)
+    if entry is None:
+        st.session_state.pop("magi_job_id", None)
+        st.session_state["magi_job_notice"] = ("warning", f"ジョブ {job_id} は見つかりませんでした（保存期間を過ぎた可能性があります）。")
+        st.rerun()
+    if entry["status"] not in ACTIVE_STATUSES:
+        _finish_job(entry)
+        st.rerun()
+
+    started = entry["started_at"] or entry["created_at"]
+    st.info(
+        f"{entry['progress'] or 'ワーカーの空きを待っています'}…（{time.time() - started:.0f} 秒経過）"
+        f"\n\nジョブ ID：{job_id}（画面を再読み込みしても、このジョブの結果を表示します）"
+    )
+    st.button("⏹ 分析を取り消す", on_click=get_job_queue().cancel, args=(job_id,), key="job_cancel")
+    partial = entry["partial"]
+    if partial:
+        placeholders = create_output_placeholders(partial["enable_swot"])
+        render_magi_sections(
+            placeholders, partial["keys"], partial["agents"], partial["aggregated"], partial["swot"]
+        )
 
-        if "media" in agents:
-            a = agents["media"]
-            dec = decision_to_css(a.get("decision_code", "Hold"))
-            st.markdown("##### Magi-Media")
-            st.markdown(
-                f'''
-                <div class="magi-panel magi-panel-media">
-                  <div class="magi-vote magi-vote-{dec["css"]}">
-                    <div class="magi-vote-label-en">{dec["en"]}</div>
-                    <div class="magi-vote-label-jp">{dec["jp"]}</div>
-                  </div>
-                  <div class="magi-panel-summary">
-                    {clean_text_for_display(a.get("summary", "")).replace("\\n", "<br>")}
-                  </div>
-                </div>
-                ''',
-                unsafe_allow_html=True,
-            )
 
-    # 統合コメント
-    agg_html = clean_text_for_display(
-        aggregated.get("details", "") or aggregated.get("summary", "")
+def render_magi_result(result: Dict[str, Any]) -> None:
+    """session_state に残した分析結果を描画する（Gemini は呼ばない）。"""
+    for warning in result["warnings"]:
+        st.warning(warning)
+    if "error" in result:
+        st.error(result["error"])
+        return
+
+    enable_swot = result["enable_swot"]
+    model_name = result["model_name"]
+    placeholders = create_output_placeholders(enable_swot)
+    with get_metrics().span("render"):
+        render_magi_sections(
+            placeholders, ALL_SECTION_KEYS, result["agents"], result["aggregated"], result["swot"]
+        )
+    if enable_swot and not any(result["swot"].values()):
+        placeholders["swot_note"].info(
+            "今回の実行では、SWOT分析は生成されませんでした。入力内容をもう少し具体的にして再実行してみてください。"
+        )
+
+    st.success("MAGI の分析が完了しました。")
+    answered = result["answered"]
+    answered_model = result["answered_model"]
+    if answered_model != model_name:
+        st.info(
+            f"選択したモデル（{model_name}）が混雑・上限などで使えなかったため、"
+            f"{answered_model} で回答しました。"
+        )
+    if answered.get("partial"):
+        st.warning(
+            "回答の受信が途中で途切れたため、受け取れた部分までを表示しています。"
+            "「キャッシュを使わずに再実行」で全文を取得し直せます。"
+        )
+    fallback_agents = sorted(
+        {m for m in answered.get("agent_models", {}).values() if m != answered_model}
     )
-    st.markdown(
-        '<div class="magi-section-title">OUTPUT · MAGI AGGREGATED DECISION</div><hr class="magi-divider">',
-        unsafe_allow_html=True,
+    st.caption(
+        f"回答モデル：{answered_model}"
+        + (f"（一部エージェント：{', '.join(fallback_agents)}）" if fallback_agents else "")
+        + ("（キャッシュ）" if answered.get("cached") else "")
+        + ("（同時に実行中だった同じ問い合わせの結果を共有）" if answered.get("coalesced") else "")
     )
-    st.markdown(
-        f'<div class="magi-aggregator">{agg_html.replace("\\n", "<br>")}</div>',
-        unsafe_allow_html=True,
+    for stats in result["long_input"].values():
+        st.caption(
+            f"長文入力：{stats['label']} 約 {stats['input_tokens']:,} → "
+            f"{stats['output_tokens']:,} トークンに要約（チャンク {stats['chunks']} 件・{stats['levels']} 段"
+            + (f"・要約失敗 {stats['failed_chunks']} 件は切り詰め" if stats["failed_chunks"] else "")
+            + "）"
+        )
+    if result["execution_mode"] == "fanout":
+        mode_label = "（並列）"
+    else:
+        mode_label = "（ストリーミング）" if result["stream_mode"] else "（一括）"
+    timings = result["timings"]
+    st.caption(
+        f"最初のパネル表示まで {timings.get('first_panel', timings['total']):.2f} 秒"
+        f" ／ 分析全体 {timings['total']:.2f} 秒" + mode_label
     )
-
-    # ==================================================
-    # SWOT 表示（SWOT ON のときだけ／生成されていれば）
-    # ==================================================
-    if enable_swot:
-        st.markdown(
-            '<div class="magi-section-title">SWOT · STRATEGIC VIEW</div><hr class="magi-divider">',
-            unsafe_allow_html=True,
+    preflight = result["preflight"]
+    run_usage = result["run_usage"]
+    st.caption(
+        f"事前見積もり：入力 約 {preflight['prompt_tokens']:,} トークン"
+        + ("（count_tokens）" if preflight["source"] == "count_tokens" else "（概算）")
+        + " ／ "
+        + (_usage_line("今回の実際の使用量", run_usage) if run_usage else "今回の使用量は記録されていません（キャッシュ利用など）。")
+    )
+    latency = mode_latency_summary()
+    if latency:
+        mode_names = {"single": "一括", "fanout": "並列"}
+        st.caption(
+            "モード別の平均所要時間（キャッシュ除く・直近50回）："
+            + " ／ ".join(
+                f"{mode_names.get(mode, mode)} {avg:.2f} 秒（{count}回）"
+                for mode, (avg, count) in sorted(latency.items())
+            )
         )
 
-        if any(swot.values()):
-            col_s, col_w = st.columns(2)
-            with col_s:
-                s_html = swot_text_to_chips(swot.get("strengths", ""), "swot-chip-s")
-                st.markdown(
-                    f'''
-                    <div class="magi-panel-swot">
-                      <b>Strengths（強み）</b><br>
-                      {s_html}
-                    </div>
-                    ''',
-                    unsafe_allow_html=True,
-                )
-            with col_w:
-                w_html = swot_text_to_chips(swot.get("weaknesses", ""), "swot-chip-w")
-                st.markdown(
-                    f'''
-                    <div class="magi-panel-swot">
-                      <b>Weaknesses（弱み）</b><br>
-                      {w_html}
-                    </div>
-                    ''',
-                    unsafe_allow_html=True,
+    # レポート出力（ダウンロードが押されたときに初めて作り、結果と一緒に残す）
+    def _report_bytes(fmt: str) -> Callable[[], bytes]:
+        def _build() -> bytes:
+            if fmt not in result["reports"]:
+                result["reports"][fmt] = build_report_cached(
+                    fmt,
+                    context=result["context"],
+                    agents=result["agents"],
+                    aggregated=result["aggregated"],
+                    magi_raw_text=result["magi_text"],
+                    image=result["image_for_report"],
+                    swot=result["swot"],
+                    enable_swot=enable_swot,
+                    answered_model=answered_model,
                 )
+            return result["reports"][fmt]
 
-            col_o, col_t = st.columns(2)
-            with col_o:
-                o_html = swot_text_to_chips(swot.get("opportunities", ""), "swot-chip-o")
-                st.markdown(
-                    f'''
-                    <div class="magi-panel-swot">
-                      <b>Opportunities（機会）</b><br>
-                      {o_html}
-                    </div>
-                    ''',
-                    unsafe_allow_html=True,
-                )
-            with col_t:
-                t_html = swot_text_to_chips(swot.get("threats", ""), "swot-chip-t")
-                st.markdown(
-                    f'''
-                    <div class="magi-panel-swot">
-                      <b>Threats（脅威）</b><br>
-                      {t_html}
-                    </div>
-                    ''',
-                    unsafe_allow_html=True,
-                )
-        else:
-            st.info("今回の実行では、SWOT分析は生成されませんでした。入力内容をもう少し具体的にして再実行してみてください。")
-
-    # レポート出力
-    report_bytes = build_word_report(
-        context=context,
-        agents=agents,
-        aggregated=aggregated,
-        magi_raw_text=magi_text,
-        image=image_for_report,
-        swot=swot,
-        enable_swot=enable_swot,
-    )
+        return _build
 
     st.markdown(
         '<div class="magi-section-title">REPORT · EXPORT</div><hr class="magi-divider">',
@@ -1186,15 +1438,104 @@ if run_analysis:
     file_name = "MAGI分析レポート_テキスト簡易版"
     if enable_swot:
         file_name += "+SWOT"
-    file_name += ".docx"
 
-    st.download_button(
-        "MAGIレポート（Word）をダウンロード",
-        data=report_bytes,
-        file_name=file_name,
-        mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    report_labels = {"docx": "Word", "md": "Markdown", "html": "HTML", "json": "JSON"}
+    for col, (fmt, label) in zip(st.columns(len(report_labels)), report_labels.items()):
+        mime, ext = REPORT_FORMATS[fmt]
+        with col:
+            st.download_button(
+                f"MAGIレポート（{label}）をダウンロード",
+                data=_report_bytes(fmt),
+                file_name=f"{file_name}.{ext}",
+                mime=mime,
+                # ダウンロードで再実行しても結果は session_state から描き直すので、画面はそのままでよい
+                on_click="ignore",
+                key=f"report_download_{fmt}",
+            )
+
+
+run_request = st.session_state.pop("magi_run_request", None)
+active_job_id = _active_job_id()
+last_result: Optional[Dict[str, Any]] = st.session_state.get("magi_result")
+
+col_run, col_rerun = st.columns([3, 2])
+with col_run:
+    st.button(
+        "🔎 MAGI による分析を実行",
+        type="primary",
+        on_click=_request_run,
+        args=(False,),
+        disabled=run_request is not None or active_job_id is not None,
     )
+with col_rerun:
+    st.button(
+        "🔁 キャッシュを使わずに再実行",
+        on_click=_request_run,
+        args=(True,),
+        disabled=run_request is not None or active_job_id is not None or last_result is None,
+        help="前回と同じ入力でも、保存済みの結果を使わずに Gemini に問い合わせ直します。",
+    )
+if st.session_state.pop("magi_run_rejected", False):
+    st.info("前回の分析がまだ実行中です。完了までお待ちください。")
 
+if run_request is not None:
+    if not user_question and not text_input and not any(
+        [context["audio_transcript"], context["image_description"], context.get("text_file")]
+    ):
+        st.warning("最低でも質問・テキスト・媒体のいずれかが必要です。")
+        st.stop()
+
+    # 分析はワーカーで実行する（画面の再実行・再読み込みでは止まらない）
+    job_params = {
+        "inputs": run_inputs,
+        "context": context,
+        "image_for_report": image_for_report,
+        "media_ref": st.session_state["media_state"]["ref"] if uploaded_file is not None else None,
+        "enable_swot": enable_swot,
+        "execution_mode": execution_mode,
+        "stream_mode": stream_mode,
+        "long_input_mode": long_input_mode,
+        "model_name": model_name,
+        "refresh": run_request["refresh"],
+        "session_id": st.session_state["usage_session_id"],
+    }
+    job_id = get_job_queue().submit(
+        lambda job: analyze_magi(job, job_params),
+        session_id=st.session_state["usage_session_id"],
+        label=(user_question or text_input or "")[:24],
+        persist=_job_result_for_table,
+    )
+    st.session_state["magi_job_id"] = job_id
+    # 媒体の前処理までのスパン（分析のスパンはジョブの結果に入る）
+    st.session_state["magi_job_trace"] = list(run_trace)
+    st.query_params["job"] = job_id
+    st.rerun()
+
+job_notice = st.session_state.pop("magi_job_notice", None)
+if job_notice is not None:
+    getattr(st, job_notice[0])(job_notice[1])
+
+if st.session_state.get("magi_job_id"):
+    render_job_progress(st.session_state["magi_job_id"])
+elif last_result is not None:
+    if last_result.get("opened_from_history"):
+        st.info(
+            "履歴から開いた結果です（"
+            + time.strftime("%Y-%m-%d %H:%M", time.localtime(last_result["opened_from_history"]))
+            + " の分析・Gemini は呼び出していません）。"
+        )
+    elif last_result.get("opened_from_job"):
+        omitted = "・".join(JOB_RESULT_OMITTED_LABELS[k] for k in last_result.get("omitted") or [])
+        st.info(
+            f"ジョブ {last_result['job_id']} の保存済みの結果です（"
+            + time.strftime("%Y-%m-%d %H:%M", time.localtime(last_result["opened_from_job"]))
+            + " に完了"
+            + (f"・{omitted}はレポートに含まれません" if omitted else "")
+            + "）。"
+        )
+    elif last_result["inputs"] != run_inputs:
+        st.info("入力が前回の分析から変わっています。下の結果は前回の入力に対するものです。")
+    render_magi_result(last_result)
 else:
     st.info(
         "質問と必要なら補足テキストを入力し、右側のサイドバーで画像・音声・ファイルを指定してから、\n"
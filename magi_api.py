@@ -0,0 +1,656 @@
+"""
+MAGI 分析の HTTP API（ASGI・Starlette）。Streamlit 画面を使わずに、同じプロンプト・パース・レポートで分析する。
+
+使い方:
+    python magi_api.py serve --host 127.0.0.1 --port 8000
+    python magi_api.py bench --requests 200 --concurrency 16       # 合成バックエンドで負荷をかけて req/s を計測
+    uvicorn magi_api:app                                            # 他の ASGI サーバーから使う場合
+
+エンドポイント:
+    GET  /health                           状態（バックエンド・実行中の分析数・上限）
+    POST /analyze                          分析して結果を JSON で返す
+    POST /analyze/stream                   セクションが確定するたびに SSE（event: section）で送り、最後に event: result
+    GET  /analyses/{id}                    分析結果（直近 MAGI_API_RESULT_LIMIT 件をメモリに保持）
+    GET  /analyses/{id}/report?format=docx レポート（docx / md / html / json）
+
+POST の本文は JSON（question, text, swot, mode, model）か、multipart/form-data（同じ項目＋ image / audio ファイル）。
+
+- Gemini の呼び出しは magi_core の同期パイプライン（レート制御・実行枠・フォールバック・キャッシュ）を
+  ワーカースレッドで実行し、同時に走らせる分析は MAGI_API_MAX_CONCURRENCY 件までに抑える
+- 空きを待つ分析が MAGI_API_MAX_QUEUE 件を超えたら 503（Retry-After 付き）を返す
+- X-Session-Id ヘッダーを、使用量の集計と実行枠の順番待ちのセッションとして使う
+- 起動時（どの起動方法でも）に環境変数 GEMINI_API_KEY で Gemini を設定し、モデルを準備してから受け付ける
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from starlette.applications import Starlette
+from starlette.datastructures import UploadFile
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from magi_cache import is_error_text
+from magi_core import (
+    DEFAULT_MODEL_NAME,
+    MODEL_CHOICES,
+    REPORT_FORMATS,
+    MagiStreamParser,
+    build_report_cached,
+    call_magi_plain,
+    configure_gemini,
+    describe_image_cached,
+    fanout_magi_plain,
+    get_metrics,
+    get_model_backend,
+    get_setting,
+    parse_magi_text,
+    prepare_audio_cached,
+    prepare_offline_environment,
+    prepare_image_cached,
+    stream_magi_plain,
+    transcribe_audio_segmented,
+    warm_up_models,
+)
+from magi_media import EncodedImage
+from magi_scheduler import PRIORITY_INTERACTIVE, set_scheduler_caller
+from magi_usage import set_usage_session
+
+MODES = ("single", "fanout")
+
+
+class APIError(Exception):
+    """status と JSON の error メッセージで返す、リクエスト側の問題。"""
+
+    def __init__(self, status: int, message: str, headers: Optional[Dict[str, str]] = None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = headers or {}
+
+
+# ======================================================
+# 同時実行数の制御と結果の保持
+# ======================================================
+class AnalysisGate:
+    """同時に走らせる分析（とレポートの作成）を max_concurrency 件に抑え、待ちが max_queue 件を超えたら断る。"""
+
+    def __init__(self, max_concurrency: int, max_queue: int):
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.max_queue = int(max_queue)
+        self.running = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        # 分析はこのスレッドプールで実行する（既定の to_thread のプールとは分ける）
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="magi-api")
+
+    async def run(self, fn: Callable[[], Any]) -> Any:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        if self._semaphore.locked() and self.max_queue >= 0 and self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise APIError(503, "混雑しています。しばらくしてから再実行してください。", {"Retry-After": "5"})
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        try:
+            loop = asyncio.get_running_loop()
+            # 呼び出し元のコンテキスト（使用量のセッション・実行枠の呼び出し元）をワーカーに引き継ぐ
+            ctx = contextvars.copy_context()
+            return await loop.run_in_executor(self.executor, ctx.run, fn)
+        finally:
+            self.running -= 1
+            self._semaphore.release()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "running": self.running,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+        }
+
+
+class ResultStore:
+    """レポートのダウンロード用に、直近 limit 件の分析結果（画像を含む）をメモリに残す。"""
+
+    def __init__(self, limit: int):
+        self.limit = max(1, int(limit))
+        self._lock = threading.Lock()
+        self._items: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+    def put(self, entry: Dict[str, Any]) -> None:
+        with self._lock:
+            self._items[entry["id"]] = entry
+            while len(self._items) > self.limit:
+                self._items.popitem(last=False)
+
+    def get(self, analysis_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._items.get(analysis_id)
+
+
+# ======================================================
+# リクエストの読み取り
+# ======================================================
+def _as_bool(value: Any) -> bool:
+    if isinstance(value, bool):
+        return value
+    return str(value or "").strip().lower() in ("1", "true", "yes", "on")
+
+
+async def read_analysis_request(request: Request) -> Dict[str, Any]:
+    """JSON か multipart/form-data の本文を、分析の入力（dict）にする。"""
+    files: Dict[str, Tuple[bytes, str]] = {}
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        form = await request.form()
+        fields: Dict[str, Any] = {}
+        for key, value in form.multi_items():
+            if isinstance(value, UploadFile):
+                if key in ("image", "audio"):
+                    files[key] = (await value.read(), value.content_type or "")
+            else:
+                fields[key] = value
+    else:
+        try:
+            fields = await request.json()
+        except ValueError:
+            raise APIError(400, "本文は JSON か multipart/form-data で送ってください。")
+        if not isinstance(fields, dict):
+            raise APIError(400, "本文は JSON のオブジェクトで送ってください。")
+
+    model_name = str(fields.get("model") or DEFAULT_MODEL_NAME)
+    if model_name not in MODEL_CHOICES.values():
+        raise APIError(400, f"使えないモデルです: {model_name}")
+    mode = str(fields.get("mode") or "single")
+    if mode not in MODES:
+        raise APIError(400, f"mode は {' / '.join(MODES)} のいずれかです。")
+    params = {
+        "question": str(fields.get("question") or ""),
+        "text": str(fields.get("text") or ""),
+        "swot": _as_bool(fields.get("swot")),
+        "mode": mode,
+        "model": model_name,
+        "refresh": _as_bool(fields.get("refresh")),
+        "image": files.get("image"),
+        "audio": files.get("audio"),
+    }
+    if not params["question"] and not params["text"] and not files:
+        raise APIError(400, "question・text・媒体（image / audio）のいずれかが必要です。")
+    return params
+
+
+# ======================================================
+# 分析（ワーカースレッドで実行する同期処理）
+# ======================================================
+def build_api_context(params: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[EncodedImage]]:
+    """画面・バッチと同じ context を作る（画像は説明文に、音声は文字起こしにする）。"""
+    model_name = params["model"]
+    context: Dict[str, Any] = {
+        "user_question": params["question"],
+        "text_input": params["text"],
+        "audio_transcript": "",
+        "image_description": "",
+        "long_input": get_setting("MAGI_LONG_INPUT_MODE", False),
+    }
+    image: Optional[EncodedImage] = None
+    if params["image"] is not None:
+        data, mime_type = params["image"]
+        try:
+            image = prepare_image_cached(data, "report")
+        except Exception as e:
+            raise APIError(400, f"画像を読み込めませんでした: {e}")
+        context["image_description"] = describe_image_cached(data, mime_type or "image/jpeg", model_name)
+    if params["audio"] is not None:
+        data, mime_type = params["audio"]
+        audio = prepare_audio_cached(data, mime_type or "audio/wav")
+        context["audio_transcript"] = transcribe_audio_segmented(audio.data, audio.mime_type, model_name)
+    return context, image
+
+
+def run_analysis(
+    params: Dict[str, Any],
+    on_sections: Optional[Callable[[List[str], MagiStreamParser], None]] = None,
+) -> Dict[str, Any]:
+    """1件を分析して、結果（エラーなら "error"）を返す。on_sections を渡すとセクション単位で知らせる。"""
+    t0 = time.perf_counter()
+    context, image = build_api_context(params)
+    answered: Dict[str, Any] = {}
+    model_name = params["model"]
+    if params["mode"] == "fanout":
+        magi_text = fanout_magi_plain(
+            context, params["swot"], on_sections=on_sections, model_name=model_name,
+            meta=answered, refresh=params["refresh"],
+        )
+    elif on_sections is not None:
+        magi_text = stream_magi_plain(
+            context, params["swot"], on_sections=on_sections, model_name=model_name,
+            meta=answered, refresh=params["refresh"],
+        )
+    else:
+        magi_text = call_magi_plain(
+            context, params["swot"], model_name, meta=answered, refresh=params["refresh"]
+        )
+    elapsed = time.perf_counter() - t0
+    get_metrics().observe("api.analyze", elapsed, model_name, "error" if is_error_text(magi_text) else "ok")
+
+    entry: Dict[str, Any] = {
+        "id": uuid.uuid4().hex[:12],
+        "model": model_name,
+        "answered_model": answered.get("model") or model_name,
+        "mode": params["mode"],
+        "enable_swot": params["swot"],
+        "cached": bool(answered.get("cached")),
+        "coalesced": bool(answered.get("coalesced")),
+        "elapsed_sec": round(elapsed, 3),
+    }
+    if magi_text is None or is_error_text(magi_text):
+        entry["error"] = magi_text or "【エラー】Gemini が有効なテキストを返しませんでした。"
+        return entry
+    agents, aggregated, swot = parse_magi_text(magi_text)
+    entry.update(
+        agents=agents,
+        aggregated=aggregated,
+        swot=swot if params["swot"] else None,
+        raw_text=magi_text,
+        # レポート用（JSON では返さない）
+        _context=context,
+        _image=image,
+    )
+    return entry
+
+
+def public_result(entry: Dict[str, Any]) -> Dict[str, Any]:
+    body = {k: v for k, v in entry.items() if not k.startswith("_")}
+    if "error" not in entry:
+        body["reports"] = {fmt: f"/analyses/{entry['id']}/report?format={fmt}" for fmt in REPORT_FORMATS}
+    return body
+
+
+# ======================================================
+# ASGI アプリ
+# ======================================================
+def _error_response(e: APIError) -> JSONResponse:
+    return JSONResponse({"error": e.message}, status_code=e.status, headers=e.headers)
+
+
+def _unexpected_error(e: Exception) -> Dict[str, str]:
+    # 想定外の失敗も、/analyze と /analyze/stream で同じ形の JSON にする
+    return {"error": f"{type(e).__name__}: {e}"}
+
+
+def configure_from_env() -> None:
+    """GEMINI_API_KEY で Gemini を設定する。キーが必要なバックエンドでキーが無ければ RuntimeError。"""
+    api_key = os.getenv("GEMINI_API_KEY")
+    if api_key:
+        configure_gemini(api_key)
+    elif get_model_backend().requires_api_key:
+        raise RuntimeError("環境変数 GEMINI_API_KEY を設定してください。")
+
+
+@asynccontextmanager
+async def _lifespan(app: Starlette) -> AsyncIterator[None]:
+    # uvicorn magi_api:app など CLI 以外で起動したときも、受け付ける前に設定する
+    configure_from_env()
+    if get_setting("MAGI_WARMUP_ENABLED", True):
+        # 最初のリクエストがクライアント・接続の作成を待たないように、受け付ける前に作っておく
+        await asyncio.to_thread(warm_up_models)
+    yield
+
+
+def _bind_caller(request: Request) -> None:
+    # X-Session-Id ごとに使用量を集計し、実行枠ではそのセッション単位で順番に回す
+    session = request.headers.get("x-session-id") or f"api:{request.client.host if request.client else ''}"
+    set_usage_session(session)
+    set_scheduler_caller(session, PRIORITY_INTERACTIVE)
+
+
+def _sse(event: str, data: str) -> bytes:
+    return f"event: {event}\ndata: {data}\n\n".encode("utf-8")
+
+
+def create_app(
+    max_concurrency: Optional[int] = None,
+    max_queue: Optional[int] = None,
+    result_limit: Optional[int] = None,
+) -> Starlette:
+    gate = AnalysisGate(
+        max_concurrency if max_concurrency is not None else get_setting("MAGI_API_MAX_CONCURRENCY", 8),
+        max_queue if max_queue is not None else get_setting("MAGI_API_MAX_QUEUE", 64),
+    )
+    store = ResultStore(result_limit if result_limit is not None else get_setting("MAGI_API_RESULT_LIMIT", 256))
+    # クライアントが切断しても最後まで走らせる分析（タスクが途中で回収されないよう参照を持つ）
+    background: set = set()
+
+    async def health(request: Request) -> JSONResponse:
+        return JSONResponse({"status": "ok", "backend": get_model_backend().mode, **gate.stats()})
+
+    async def analyze(request: Request) -> JSONResponse:
+        try:
+            params = await read_analysis_request(request)
+            _bind_caller(request)
+            entry = await gate.run(lambda: run_analysis(params))
+        except APIError as e:
+            return _error_response(e)
+        except Exception as e:
+            return JSONResponse(_unexpected_error(e), status_code=500)
+        store.put(entry)
+        return JSONResponse(public_result(entry), status_code=502 if "error" in entry else 200)
+
+    async def analyze_stream(request: Request) -> Response:
+        try:
+            params = await read_analysis_request(request)
+        except APIError as e:
+            return _error_response(e)
+        _bind_caller(request)
+        loop = asyncio.get_running_loop()
+        queue: "asyncio.Queue[Optional[bytes]]" = asyncio.Queue()
+
+        def _on_sections(keys: List[str], parser: MagiStreamParser) -> None:
+            # ワーカースレッドから呼ばれるので、その場で JSON にしてイベントループへ渡す
+            data = json.dumps(
+                {"keys": keys, "agents": parser.agents, "aggregated": parser.aggregated, "swot": parser.swot},
+                ensure_ascii=False,
+            )
+            loop.call_soon_threadsafe(queue.put_nowait, _sse("section", data))
+
+        async def _run() -> None:
+            try:
+                entry = await gate.run(lambda: run_analysis(params, _on_sections))
+                store.put(entry)
+                event = "error" if "error" in entry else "result"
+                await queue.put(_sse(event, json.dumps(public_result(entry), ensure_ascii=False)))
+            except APIError as e:
+                await queue.put(_sse("error", json.dumps({"error": e.message}, ensure_ascii=False)))
+            except Exception as e:
+                await queue.put(_sse("error", json.dumps(_unexpected_error(e), ensure_ascii=False)))
+            finally:
+                await queue.put(None)
+
+        async def _events() -> AsyncIterator[bytes]:
+            # 切断されても分析は止めない（結果はキャッシュと /analyses に残る）
+            task = asyncio.ensure_future(_run())
+            background.add(task)
+            task.add_done_callback(background.discard)
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                yield item
+
+        return StreamingResponse(
+            _events(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    async def get_analysis(request: Request) -> JSONResponse:
+        entry = store.get(request.path_params["analysis_id"])
+        if entry is None:
+            return JSONResponse({"error": "分析結果が見つかりません（保持件数を超えた可能性があります）。"}, status_code=404)
+        return JSONResponse(public_result(entry))
+
+    async def get_report(request: Request) -> Response:
+        entry = store.get(request.path_params["analysis_id"])
+        if entry is None or "error" in entry:
+            return JSONResponse({"error": "分析結果が見つかりません。"}, status_code=404)
+        fmt = request.query_params.get("format", "docx")
+        if fmt not in REPORT_FORMATS:
+            return JSONResponse({"error": f"format は {' / '.join(REPORT_FORMATS)} のいずれかです。"}, status_code=400)
+
+        def _build() -> bytes:
+            return build_report_cached(
+                fmt,
+                context=entry["_context"],
+                agents=entry["agents"],
+                aggregated=entry["aggregated"],
+                magi_raw_text=entry["raw_text"],
+                image=entry["_image"],
+                swot=entry["swot"],
+                enable_swot=entry["enable_swot"],
+                answered_model=entry["answered_model"],
+            )
+
+        mime, ext = REPORT_FORMATS[fmt]
+        # レポートの作成も分析と同じ枠で数える（gate.stats() に出ない作業でスレッドを使わない）
+        try:
+            data = await gate.run(_build)
+        except APIError as e:
+            return _error_response(e)
+        except Exception as e:
+            return JSONResponse(_unexpected_error(e), status_code=500)
+        return Response(
+            data,
+            media_type=mime,
+            headers={"Content-Disposition": f'attachment; filename="magi_report_{entry["id"]}.{ext}"'},
+        )
+
+    return Starlette(
+        routes=[
+            Route("/health", health),
+            Route("/analyze", analyze, methods=["POST"]),
+            Route("/analyze/stream", analyze_stream, methods=["POST"]),
+            Route("/analyses/{analysis_id}", get_analysis),
+            Route("/analyses/{analysis_id}/report", get_report),
+        ],
+        lifespan=_lifespan,
+    )
+
+
+# ======================================================
+# 負荷試験（合成バックエンドで req/s とレイテンシを計測）
+# ======================================================
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def run_load(
+    base_url: str,
+    total: int,
+    concurrency: int,
+    stream: bool = False,
+    swot: bool = False,
+    mode: str = "single",
+    unique: bool = True,
+) -> Dict[str, Any]:
+    """total 件の分析を concurrency 本の接続から投げ、req/s・レイテンシ（p50 / p95）・ステータスを集計する。"""
+    import requests
+
+    path = "/analyze/stream" if stream else "/analyze"
+    latencies: List[float] = []
+    first_events: List[float] = []
+    statuses: Dict[str, int] = {}
+    lock = threading.Lock()
+    counter = iter(range(total))
+    local = threading.local()
+
+    def _one(index: int) -> None:
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        payload = {
+            "question": f"負荷試験の問い {index if unique else 0}",
+            "text": "API の応答性能を確認するための補足テキストです。",
+            "swot": swot,
+            "mode": mode,
+        }
+        t0 = time.perf_counter()
+        first = None
+        try:
+            with session.post(base_url + path, json=payload, stream=stream, timeout=300) as resp:
+                if stream:
+                    status = "200"
+                    for line in resp.iter_lines(decode_unicode=True):
+                        if line.startswith("event: ") and first is None:
+                            first = time.perf_counter() - t0
+                        if line in ("event: error",):
+                            status = "error"
+                else:
+                    resp.content
+                    status = str(resp.status_code)
+        except Exception as e:
+            status = type(e).__name__
+        elapsed = time.perf_counter() - t0
+        with lock:
+            statuses[status] = statuses.get(status, 0) + 1
+            latencies.append(elapsed)
+            if first is not None:
+                first_events.append(first)
+
+    def _worker() -> None:
+        while True:
+            with lock:
+                index = next(counter, None)
+            if index is None:
+                return
+            _one(index)
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=_worker) for _ in range(max(1, concurrency))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - t0
+    result = {
+        "requests": total,
+        "concurrency": concurrency,
+        "endpoint": path,
+        "wall_sec": round(wall, 3),
+        "requests_per_sec": round(total / wall, 2) if wall > 0 else 0.0,
+        "latency_p50_ms": round(statistics.median(latencies) * 1000, 1) if latencies else 0.0,
+        "latency_p95_ms": round(_percentile(latencies, 0.95) * 1000, 1),
+        "statuses": statuses,
+    }
+    if stream:
+        result["first_event_p50_ms"] = round(statistics.median(first_events) * 1000, 1) if first_events else 0.0
+    return result
+
+
+def _serve_in_thread(app: Starlette, host: str = "127.0.0.1", port: int = 0):
+    """負荷試験用に uvicorn を別スレッドで起動し、(server, スレッド, URL) を返す。"""
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError("API サーバーを起動できませんでした。")
+        time.sleep(0.05)
+    bound_port = server.servers[0].sockets[0].getsockname()[1]
+    return server, thread, f"http://{host}:{bound_port}"
+
+
+def _prepare_offline_backend(work_dir: str, latency_sec: float, max_concurrency: int) -> None:
+    # 引数で指定した値を、既にある環境変数より優先する（計測結果が引数と食い違わないように）
+    for name in [n for n in os.environ if n.startswith("MAGI_MAX_CONCURRENT_")]:
+        # モデルごとの上限は MAGI_MAX_CONCURRENT より優先されるので外す
+        del os.environ[name]
+    prepare_offline_environment(
+        work_dir,
+        {
+            "MAGI_FAKE_LATENCY_SEC": str(latency_sec),
+            # モデルごとの実行枠ではなく、API の同時実行数の上限が効くようにする
+            "MAGI_MAX_CONCURRENT": str(max_concurrency),
+        },
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="MAGI 分析の HTTP API")
+    sub = parser.add_subparsers(dest="command", required=True)
+    serve = sub.add_parser("serve", help="API サーバーを起動する")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8000)
+    bench = sub.add_parser("bench", help="合成バックエンド（MAGI_BACKEND=replay）で負荷をかけて計測する")
+    bench.add_argument("--requests", type=int, default=200, help="投げる分析の件数")
+    bench.add_argument("--concurrency", type=int, default=16, help="クライアント側の同時接続数")
+    bench.add_argument("--max-concurrency", type=int, default=8, help="API 側の同時実行数の上限")
+    bench.add_argument("--latency", type=float, default=0.2, help="合成バックエンドの1呼び出しあたりの遅延（秒）")
+    bench.add_argument("--stream", action="store_true", help="/analyze/stream（SSE）を計測する")
+    bench.add_argument("--swot", action="store_true", help="SWOT 分析を有効にする")
+    bench.add_argument("--mode", choices=list(MODES), default="single", help="一括 / 並列モード")
+    bench.add_argument("--same-question", action="store_true", help="全件同じ問いにする（キャッシュ・集約の効果を見る）")
+    bench.add_argument("-o", "--output", help="結果を書き出す JSON ファイル（省略時は標準出力）")
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        import uvicorn
+
+        try:
+            # 設定・モデルの準備はアプリの起動時（_lifespan）にも行うが、キーが無いことは先に知らせる
+            configure_from_env()
+        except RuntimeError as e:
+            print(str(e), file=sys.stderr)
+            return 2
+        uvicorn.run(app, host=args.host, port=args.port)
+        return 0
+
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        _prepare_offline_backend(work_dir, args.latency, args.max_concurrency)
+        server, thread, base_url = _serve_in_thread(
+            create_app(max_concurrency=args.max_concurrency, max_queue=args.requests)
+        )
+        try:
+            result = run_load(
+                base_url,
+                args.requests,
+                args.concurrency,
+                stream=args.stream,
+                swot=args.swot,
+                mode=args.mode,
+                unique=not args.same_question,
+            )
+        finally:
+            server.should_exit = True
+            thread.join()
+    result.update(
+        max_concurrency=args.max_concurrency,
+        backend_latency_sec=args.latency,
+        mode=args.mode,
+        swot=args.swot,
+    )
+    print(
+        f"{result['requests_per_sec']:.1f} req/s ／ p50 {result['latency_p50_ms']:.0f} ms"
+        f" ／ p95 {result['latency_p95_ms']:.0f} ms ／ {result['statuses']}",
+        file=sys.stderr,
+    )
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+# uvicorn magi_api:app で起動するときのアプリ（同時実行数などは import 時の設定で決まる）
+app = create_app()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
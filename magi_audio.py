@@ -0,0 +1,354 @@
+"""
+音声の前処理（正規化・長い録音の区間分割）。
+
+- normalize_wav: モノラル化・音声向けのサンプルレートへの変換・前後の無音の除去をして、
+  16bit PCM の WAV にする（ブラウザ録音の高ビットレートのステレオ WAV を小さくする）
+- NormalizedAudioCache: 正規化結果をアップロード内容のハッシュごとに保持する
+- read_wav / pcm_to_mono: PCM の WAV を読み、無音判定用のモノラル波形（-1〜1）にする
+- find_split_points: 目標の長さ付近で、なるべく無音の位置に区切りを置く
+- split_wav: 区切りごとに元と同じ形式の WAV を切り出す（Gemini には区間ごとに送る）
+- stitch_transcripts: 区間ごとの文字起こしを、タイムスタンプ付きで元の順に連結する
+
+WAV 以外（mp3 / m4a など）はデコードできないので、normalize_wav は元のまま、
+split_wav は空リストを返す（呼び出し側で一括処理）。
+"""
+import hashlib
+import io
+import threading
+import wave
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+@dataclass(frozen=True)
+class WavInfo:
+    channels: int
+    sample_width: int
+    sample_rate: int
+    frames: int
+
+    @property
+    def duration_sec(self) -> float:
+        return self.frames / self.sample_rate if self.sample_rate else 0.0
+
+
+@dataclass(frozen=True)
+class AudioSegment:
+    index: int
+    start_sec: float
+    end_sec: float
+    data: bytes
+    mime_type: str = "audio/wav"
+
+
+def is_wav(data: bytes) -> bool:
+    return len(data) >= 12 and data[:4] == b"RIFF" and data[8:12] == b"WAVE"
+
+
+def read_wav(data: bytes) -> Optional[Tuple[WavInfo, bytes]]:
+    """PCM の WAV なら (形式, 生のフレーム列) を返す。読めなければ None。"""
+    if not is_wav(data):
+        return None
+    try:
+        with wave.open(io.BytesIO(data), "rb") as wav:
+            info = WavInfo(
+                channels=wav.getnchannels(),
+                sample_width=wav.getsampwidth(),
+                sample_rate=wav.getframerate(),
+                frames=wav.getnframes(),
+            )
+            raw = wav.readframes(info.frames)
+    except (wave.Error, EOFError):
+        return None
+    return info, raw
+
+
+def write_wav(raw: bytes, channels: int, sample_width: int, sample_rate: int) -> bytes:
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(sample_width)
+        wav.setframerate(sample_rate)
+        wav.writeframes(raw)
+    return buf.getvalue()
+
+
+def pcm_to_mono(raw: bytes, info: WavInfo) -> np.ndarray:
+    """生のフレーム列を、チャンネル平均のモノラル float32（-1〜1）に変換する。"""
+    width = info.sample_width
+    usable = len(raw) - len(raw) % (width * info.channels)
+    buf = np.frombuffer(raw[:usable], dtype=np.uint8)
+    if width == 1:
+        samples = buf.astype(np.float32) - 128.0
+    elif width == 3:
+        # 24bit は下位バイトに 0 を足して int32 として読む
+        padded = np.zeros((len(buf) // 3, 4), dtype=np.uint8)
+        padded[:, 1:] = buf.reshape(-1, 3)
+        samples = padded.view("<i4").reshape(-1).astype(np.float32) / 256.0
+    else:
+        samples = buf.view(f"<i{width}").astype(np.float32)
+    scale = float(2 ** (8 * width - 1))
+    return samples.reshape(-1, info.channels).mean(axis=1) / scale
+
+
+def resample(mono: np.ndarray, rate: int, target_rate: int) -> np.ndarray:
+    """
+    target_rate へ変換する（上げる方向には変換しない）。
+    折り返し雑音を防ぐため、窓付き sinc の低域通過フィルタをかけてから線形補間で間引く。
+    """
+    if target_rate <= 0 or rate <= target_rate or len(mono) == 0:
+        return mono.astype(np.float32)
+    cutoff = 0.45 * target_rate / rate
+    taps = np.arange(-32, 33)
+    kernel = np.sinc(2 * cutoff * taps) * np.hamming(len(taps))
+    kernel /= kernel.sum()
+    filtered = np.convolve(mono, kernel, mode="same")
+    count = int(len(mono) * target_rate / rate)
+    positions = np.arange(count) * (rate / target_rate)
+    return np.interp(positions, np.arange(len(filtered)), filtered).astype(np.float32)
+
+
+def levels_db(mono: np.ndarray, sample_rate: int, window_sec: float = 0.05) -> np.ndarray:
+    """window_sec ごとの RMS（dBFS）。"""
+    window = max(1, int(sample_rate * window_sec))
+    count = len(mono) // window
+    if count == 0:
+        return np.zeros(0, dtype=np.float32)
+    frames = mono[: count * window].reshape(count, window)
+    rms = np.sqrt(np.mean(frames * frames, axis=1))
+    return 20.0 * np.log10(rms + 1e-9)
+
+
+def silence_threshold_db(levels: np.ndarray, silence_db: float = -40.0) -> float:
+    """
+    無音とみなす音量。静かな録音では silence_db、雑音の多い録音では
+    その録音の小さいほうから1割の音量より少し上を使う。
+    """
+    if len(levels) == 0:
+        return silence_db
+    return max(silence_db, float(np.percentile(levels, 10)) + 3.0)
+
+
+def trim_silence(
+    mono: np.ndarray,
+    sample_rate: int,
+    silence_db: float = -40.0,
+    padding_sec: float = 0.25,
+    window_sec: float = 0.05,
+) -> Tuple[np.ndarray, float]:
+    """前後の無音を padding_sec だけ残して削る。(削った波形, 削った秒数) を返す。"""
+    levels = levels_db(mono, sample_rate, window_sec)
+    voiced = np.nonzero(levels >= silence_threshold_db(levels, silence_db))[0]
+    if len(voiced) == 0:
+        return mono, 0.0
+    window = max(1, int(sample_rate * window_sec))
+    padding = int(sample_rate * padding_sec)
+    begin = max(0, int(voiced[0]) * window - padding)
+    end = min(len(mono), (int(voiced[-1]) + 1) * window + padding)
+    return mono[begin:end], (len(mono) - (end - begin)) / sample_rate
+
+
+@dataclass(frozen=True)
+class NormalizedAudio:
+    data: bytes
+    mime_type: str
+    sample_rate: int
+    channels: int
+    duration_sec: float
+    original_bytes: int
+    original_sample_rate: int = 0
+    original_channels: int = 0
+    original_duration_sec: float = 0.0
+    trimmed_sec: float = 0.0
+    # False なら WAV として読めなかったので元のまま
+    processed: bool = True
+
+
+def passthrough_audio(data: bytes, mime_type: str) -> NormalizedAudio:
+    return NormalizedAudio(
+        data=data,
+        mime_type=mime_type,
+        sample_rate=0,
+        channels=0,
+        duration_sec=0.0,
+        original_bytes=len(data),
+        processed=False,
+    )
+
+
+def normalize_wav(
+    data: bytes,
+    mime_type: str = "audio/wav",
+    target_rate: int = 16000,
+    trim: bool = True,
+    silence_db: float = -40.0,
+) -> NormalizedAudio:
+    """
+    PCM の WAV をモノラル・target_rate・16bit にし、trim=True なら前後の無音を削る。
+    WAV として読めなければ元のバイト列をそのまま返す（processed=False）。
+    """
+    parsed = read_wav(data)
+    if parsed is None or parsed[0].frames == 0:
+        return passthrough_audio(data, mime_type)
+    info, raw = parsed
+    mono = resample(pcm_to_mono(raw, info), info.sample_rate, target_rate)
+    rate = min(info.sample_rate, target_rate) if target_rate > 0 else info.sample_rate
+    trimmed_sec = 0.0
+    if trim:
+        mono, trimmed_sec = trim_silence(mono, rate, silence_db)
+    pcm = (np.clip(mono, -1.0, 1.0) * 32767).astype("<i2").tobytes()
+    return NormalizedAudio(
+        data=write_wav(pcm, 1, 2, rate),
+        mime_type="audio/wav",
+        sample_rate=rate,
+        channels=1,
+        duration_sec=len(mono) / rate,
+        original_bytes=len(data),
+        original_sample_rate=info.sample_rate,
+        original_channels=info.channels,
+        original_duration_sec=info.duration_sec,
+        trimmed_sec=trimmed_sec,
+    )
+
+
+class NormalizedAudioCache:
+    """正規化済み音声の LRU（合計バイト数の上限つき・スレッドセーフ）。"""
+
+    def __init__(self, max_bytes: int = 128 * 1024 * 1024):
+        self.max_bytes = max(1, int(max_bytes))
+        self._data: "OrderedDict[str, NormalizedAudio]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(data: bytes, signature: str) -> str:
+        return f"{signature}|{hashlib.sha256(data).hexdigest()}"
+
+    def get(self, key: str) -> Optional[NormalizedAudio]:
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: NormalizedAudio) -> None:
+        # 元のままのもの（processed=False）は保持しても得が無い
+        if not value.processed or len(value.data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old.data)
+            self._data[key] = value
+            self._bytes += len(value.data)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self._bytes -= len(evicted.data)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def find_split_points(
+    levels: np.ndarray,
+    window_sec: float,
+    target_sec: float,
+    silence_db: float = -40.0,
+) -> List[float]:
+    """
+    区切り位置（秒）のリストを返す（先頭 0 と末尾は含まない）。
+    各区間は target_sec の 0.5〜1.5 倍の範囲で、target_sec に最も近い無音の位置で切る。
+    範囲内に無音が無ければ、範囲内で最も静かな位置で切る。
+    """
+    total = len(levels)
+    target = max(1, int(target_sec / window_sec))
+    if total <= target * 1.5:
+        return []
+    threshold = silence_threshold_db(levels, silence_db)
+    points: List[float] = []
+    start = 0
+    while total - start > target * 1.5:
+        lo, hi = start + target // 2, min(total, start + target * 3 // 2)
+        candidates = np.arange(lo, hi)
+        silent = candidates[levels[lo:hi] < threshold]
+        if len(silent):
+            cut = int(silent[np.argmin(np.abs(silent - (start + target)))])
+        else:
+            cut = lo + int(np.argmin(levels[lo:hi]))
+        # 窓の中央で切る
+        points.append((cut + 0.5) * window_sec)
+        start = cut
+    return points
+
+
+def split_wav(
+    data: bytes,
+    target_sec: float = 90.0,
+    silence_db: float = -40.0,
+    window_sec: float = 0.05,
+) -> List[AudioSegment]:
+    """
+    PCM の WAV を、無音の位置を優先して約 target_sec ごとの区間に分ける。
+    WAV として読めなければ空リスト、分ける必要が無ければ1区間を返す。
+    """
+    parsed = read_wav(data)
+    if parsed is None:
+        return []
+    info, raw = parsed
+    if info.frames == 0:
+        return []
+    frame_bytes = info.channels * info.sample_width
+    points = find_split_points(
+        levels_db(pcm_to_mono(raw, info), info.sample_rate, window_sec),
+        window_sec,
+        target_sec,
+        silence_db,
+    )
+    bounds = [0] + [int(p * info.sample_rate) for p in points] + [info.frames]
+    segments: List[AudioSegment] = []
+    for index, (begin, end) in enumerate(zip(bounds, bounds[1:])):
+        segments.append(
+            AudioSegment(
+                index=index,
+                start_sec=begin / info.sample_rate,
+                end_sec=end / info.sample_rate,
+                data=write_wav(
+                    raw[begin * frame_bytes : end * frame_bytes],
+                    info.channels,
+                    info.sample_width,
+                    info.sample_rate,
+                ),
+            )
+        )
+    return segments
+
+
+def format_timestamp(seconds: float) -> str:
+    seconds = int(round(seconds))
+    hours, rest = divmod(seconds, 3600)
+    minutes, secs = divmod(rest, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{secs:02d}"
+    return f"{minutes:02d}:{secs:02d}"
+
+
+def stitch_transcripts(segments: Sequence[AudioSegment], texts: Sequence[str]) -> str:
+    """区間ごとの文字起こしを「[開始–終了] 本文」の形で、元の順に連結する。"""
+    return "\n".join(
+        f"[{format_timestamp(seg.start_sec)}–{format_timestamp(seg.end_sec)}] {text.strip()}"
+        for seg, text in zip(segments, texts)
+    )
@@ -0,0 +1,534 @@
+"""
+Gemini 呼び出しのバックエンド切り替え（get_gemini_model の裏側）。
+
+- live:   google.generativeai をそのまま使う（通常運用）
+- record: 実際に呼び出しつつ、リクエストと応答（finish_reason・usage_metadata・例外）を
+          カセットファイル（JSONL）に追記する
+- replay: カセットの応答を API キーなし・クォータ消費なしで返す。
+          カセットに無いリクエストには、プロンプトの見出しに沿った合成テキストを返す。
+          遅延・ResourceExhausted・SAFETY / MAX_TOKENS を指定した確率で注入できる
+"""
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from google.api_core import exceptions as api_exceptions
+
+from magi_cache import result_cache_key
+
+BACKEND_MODES = ("live", "record", "replay")
+
+
+# ======================================================
+# リクエストの正規化（カセットの照合キー）
+# ======================================================
+def _content_fingerprint(part: Any) -> Any:
+    if isinstance(part, str):
+        return part
+    if isinstance(part, dict) and "data" in part:
+        data = part["data"]
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        return {"mime_type": part.get("mime_type"), "sha256": hashlib.sha256(data).hexdigest()}
+    tobytes = getattr(part, "tobytes", None)
+    if callable(tobytes):
+        # PIL.Image はピクセル列で照合する
+        return {"image": hashlib.sha256(tobytes()).hexdigest(), "size": list(part.size)}
+    return repr(part)
+
+
+def request_key(model_name: Optional[str], contents: Any, generation_config: Any = None) -> str:
+    """モデル名（None なら問わない）・入力内容・生成設定から照合キーを作る。"""
+    if not isinstance(contents, (list, tuple)):
+        contents = [contents]
+    config = dict(generation_config) if isinstance(generation_config, dict) else None
+    return result_cache_key(
+        model=model_name,
+        contents=[_content_fingerprint(p) for p in contents],
+        generation_config=config,
+    )
+
+
+def _prompt_text(contents: Any) -> str:
+    if not isinstance(contents, (list, tuple)):
+        contents = [contents]
+    return "\n".join(p for p in contents if isinstance(p, str))
+
+
+# ======================================================
+# 応答オブジェクト（google.generativeai の応答と同じ読み方ができる最小限の形）
+# ======================================================
+class _Part:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class _Content:
+    def __init__(self, text: str):
+        self.parts = [_Part(text)] if text else []
+
+
+class _Candidate:
+    def __init__(self, text: str, finish_reason: str):
+        self.content = _Content(text)
+        self.finish_reason = finish_reason
+
+
+class _Usage:
+    def __init__(self, usage: Dict[str, int]):
+        self.prompt_token_count = int(usage.get("prompt_token_count", 0))
+        self.candidates_token_count = int(usage.get("candidates_token_count", 0))
+        self.total_token_count = int(
+            usage.get("total_token_count", self.prompt_token_count + self.candidates_token_count)
+        )
+
+
+class ReplayResponse:
+    """
+    stream=False なら全文を持つ応答、stream=True ならチャンクを順に返す反復可能な応答。
+    .text は parts が無いとき ValueError を投げる（SDK と同じ挙動）。
+    """
+
+    def __init__(
+        self,
+        chunks: List[str],
+        finish_reason: str = "STOP",
+        usage: Optional[Dict[str, int]] = None,
+        chunk_delays: Optional[List[float]] = None,
+    ):
+        self._chunks = chunks
+        self._chunk_delays = chunk_delays or []
+        self.finish_reason = finish_reason
+        text = "".join(chunks)
+        self.candidates = [_Candidate(text, finish_reason)]
+        self._usage = usage or {}
+        self.usage_metadata = _Usage(self._usage)
+        self.prompt_feedback = None
+
+    @property
+    def text(self) -> str:
+        parts = self.candidates[0].content.parts
+        if not parts:
+            raise ValueError(f"応答にテキストがありません（finish_reason={self.finish_reason}）")
+        return "".join(p.text for p in parts)
+
+    def __iter__(self) -> Iterator["ReplayResponse"]:
+        last = len(self._chunks) - 1
+        for index, piece in enumerate(self._chunks):
+            if index < len(self._chunk_delays) and self._chunk_delays[index] > 0:
+                time.sleep(self._chunk_delays[index])
+            # SDK と同様に、使用量は最後のチャンクにだけ載せる
+            yield ReplayResponse(
+                [piece],
+                self.finish_reason if index == last else "STOP",
+                self._usage if index == last else None,
+            )
+
+
+# ======================================================
+# カセットファイル
+# ======================================================
+class Cassette:
+    """
+    1行1件の JSONL。同じキーに複数件あるときは、記録順に繰り返し返す。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._entries: Dict[str, List[Dict[str, Any]]] = {}
+        self._cursor: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.count = 0
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        self._index(json.loads(line))
+
+    def _index(self, entry: Dict[str, Any]) -> None:
+        self.count += 1
+        for key in (entry.get("key"), entry.get("content_key")):
+            if key:
+                self._entries.setdefault(key, []).append(entry)
+
+    def lookup(self, *keys: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            for key in keys:
+                entries = self._entries.get(key)
+                if entries:
+                    index = self._cursor.get(key, 0)
+                    self._cursor[key] = index + 1
+                    return entries[index % len(entries)]
+        return None
+
+    def append(self, entry: Dict[str, Any]) -> None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        line = json.dumps(entry, ensure_ascii=False)
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+            self._index(entry)
+
+
+# ======================================================
+# record モード
+# ======================================================
+def _finish_reason_name(reason: Any) -> str:
+    if reason is None:
+        return ""
+    return str(getattr(reason, "name", reason))
+
+
+def _usage_dict(resp: Any) -> Dict[str, int]:
+    usage = getattr(resp, "usage_metadata", None)
+    if usage is None:
+        return {}
+    return {
+        name: int(getattr(usage, name, 0) or 0)
+        for name in ("prompt_token_count", "candidates_token_count", "total_token_count")
+    }
+
+
+def _response_text(resp: Any) -> str:
+    # parts が空の応答（SAFETY など）でも例外にしない
+    try:
+        return resp.text or ""
+    except Exception:
+        return ""
+
+
+def _first_finish_reason(resp: Any) -> str:
+    candidates = getattr(resp, "candidates", None) or []
+    return _finish_reason_name(getattr(candidates[0], "finish_reason", None)) if candidates else ""
+
+
+class _RecordingStream:
+    """ストリーミング応答を呼び出し元へ流しつつ、最後まで読み終えたらカセットに書く。"""
+
+    def __init__(self, resp: Any, on_done):
+        self._resp = resp
+        self._on_done = on_done
+
+    def __iter__(self):
+        chunks: List[str] = []
+        delays: List[float] = []
+        finish_reason = ""
+        usage: Dict[str, int] = {}
+        last = time.perf_counter()
+        for chunk in self._resp:
+            now = time.perf_counter()
+            delays.append(round(now - last, 4))
+            last = now
+            chunks.append(_response_text(chunk))
+            finish_reason = _first_finish_reason(chunk) or finish_reason
+            usage = _usage_dict(chunk) or usage
+            yield chunk
+        self._on_done(chunks, delays, finish_reason, usage)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._resp, name)
+
+
+class RecordingModel:
+    def __init__(self, inner: Any, model_name: str, cassette: Cassette):
+        self._inner = inner
+        self.model_name = model_name
+        self._cassette = cassette
+
+    def count_tokens(self, contents: Any, **kwargs):
+        return self._inner.count_tokens(contents, **kwargs)
+
+    def generate_content(self, contents: Any, **kwargs):
+        stream = bool(kwargs.get("stream"))
+        base = {
+            "key": request_key(self.model_name, contents, kwargs.get("generation_config")),
+            "content_key": request_key(None, contents, kwargs.get("generation_config")),
+            "model": self.model_name,
+            "stream": stream,
+            "recorded_at": time.time(),
+        }
+        t0 = time.perf_counter()
+        try:
+            resp = self._inner.generate_content(contents, **kwargs)
+        except api_exceptions.GoogleAPIError as e:
+            self._cassette.append(
+                dict(
+                    base,
+                    error={"type": type(e).__name__, "message": getattr(e, "message", str(e))},
+                    latency_sec=round(time.perf_counter() - t0, 4),
+                )
+            )
+            raise
+
+        if stream:
+            def _done(chunks, delays, finish_reason, usage):
+                self._cassette.append(
+                    dict(
+                        base,
+                        chunks=chunks,
+                        chunk_delays=delays,
+                        finish_reason=finish_reason,
+                        usage=usage,
+                        latency_sec=round(time.perf_counter() - t0, 4),
+                    )
+                )
+
+            return _RecordingStream(resp, _done)
+
+        text = _response_text(resp)
+        self._cassette.append(
+            dict(
+                base,
+                chunks=[text] if text else [],
+                finish_reason=_first_finish_reason(resp),
+                usage=_usage_dict(resp),
+                latency_sec=round(time.perf_counter() - t0, 4),
+            )
+        )
+        return resp
+
+
+# ======================================================
+# replay モード
+# ======================================================
+@dataclass
+class FaultProfile:
+    """replay モードで注入する遅延と失敗（確率は 0〜1）。"""
+
+    latency_sec: float = 0.0
+    latency_jitter_sec: float = 0.0
+    use_recorded_latency: bool = False
+    resource_exhausted_rate: float = 0.0
+    safety_rate: float = 0.0
+    max_tokens_rate: float = 0.0
+    strict: bool = False
+    seed: int = 0
+
+
+_VERDICTS = ("可決", "保留", "否決")
+
+
+def synthetic_reply(prompt: str, rng: random.Random) -> str:
+    """
+    プロンプト中の出力フォーマット（【見出し】・判定:・要約:・Strengths: など）に沿った
+    それらしいテキストを作る。フォーマット指定が無ければ短い説明文を返す。
+    """
+    body = prompt.split("[制約]")[0]
+    out: List[str] = []
+    started = False
+    after_heading = False
+    for raw in body.splitlines():
+        line = raw.strip()
+        if line.startswith("【") and line.endswith("】"):
+            started = True
+            after_heading = True
+            out.append(line)
+            continue
+        label = line.split(":", 1)[0] if ":" in line else ""
+        if label == "判定":
+            started = True
+            out.append(f"判定: {rng.choice(_VERDICTS)}")
+        elif label == "要約":
+            started = True
+            out.append("要約: 入力内容を踏まえると一定の妥当性があります。前提条件の確認が必要です。")
+        elif label in ("Strengths", "Weaknesses", "Opportunities", "Threats"):
+            started = True
+            out.append(f"{label}: " + "、".join(f"{label[0]}項目{i}" for i in range(1, 6)))
+        elif started and line and after_heading:
+            out.append("全体として条件付きで進めるのが妥当です。段階的に検証しながら判断してください。")
+        elif started and not line:
+            out.append("")
+        after_heading = False
+    text = "\n".join(out).strip()
+    return text or "入力内容についての簡潔な説明です。全体として落ち着いた印象を受けます。"
+
+
+def _split_for_stream(text: str) -> List[str]:
+    lines = text.splitlines(keepends=True)
+    return lines or [text]
+
+
+class ReplayModel:
+    def __init__(
+        self,
+        model_name: str,
+        cassette: Optional[Cassette],
+        faults: FaultProfile,
+        rng: random.Random,
+        rng_lock: threading.Lock,
+    ):
+        self.model_name = model_name
+        self._cassette = cassette
+        self._faults = faults
+        self._rng = rng
+        self._rng_lock = rng_lock
+
+    def _draw(self) -> Tuple[float, float, float]:
+        with self._rng_lock:
+            return self._rng.random(), self._rng.random(), self._rng.uniform(0.0, 1.0)
+
+    def generate_content(self, contents: Any, **kwargs):
+        faults = self._faults
+        config = kwargs.get("generation_config")
+        entry = None
+        if self._cassette is not None:
+            entry = self._cassette.lookup(
+                request_key(self.model_name, contents, config), request_key(None, contents, config)
+            )
+        if entry is None and faults.strict:
+            raise LookupError(f"カセットに一致する記録がありません（{self.model_name}）")
+
+        failure_draw, kind_draw, jitter_draw = self._draw()
+        latency = faults.latency_sec + faults.latency_jitter_sec * jitter_draw
+        if entry is not None and faults.use_recorded_latency:
+            latency += float(entry.get("latency_sec", 0.0))
+
+        timeout = (kwargs.get("request_options") or {}).get("timeout")
+        if timeout and latency > float(timeout):
+            time.sleep(float(timeout))
+            raise api_exceptions.DeadlineExceeded(f"fake backend: {latency:.1f}s > timeout {timeout}s")
+
+        if failure_draw < faults.resource_exhausted_rate:
+            time.sleep(latency)
+            raise api_exceptions.ResourceExhausted(
+                "fake backend: Resource has been exhausted. "
+                "Quota exceeded for metric: generate_content_requests PerMinute. Please retry in 2s."
+            )
+
+        if entry is not None and "error" in entry:
+            time.sleep(latency)
+            error = entry["error"]
+            exc_type = getattr(api_exceptions, error.get("type", ""), None)
+            if not (isinstance(exc_type, type) and issubclass(exc_type, api_exceptions.GoogleAPIError)):
+                exc_type = api_exceptions.GoogleAPIError
+            raise exc_type(error.get("message", ""))
+
+        if entry is not None:
+            chunks = list(entry.get("chunks") or [])
+            finish_reason = entry.get("finish_reason") or "STOP"
+            usage = entry.get("usage") or {}
+        else:
+            prompt = _prompt_text(contents)
+            with self._rng_lock:
+                text = synthetic_reply(prompt, self._rng)
+            chunks = _split_for_stream(text)
+            finish_reason = "STOP"
+            usage = {
+                "prompt_token_count": len(prompt) // 2,
+                "candidates_token_count": len(text) // 2,
+            }
+
+        # 失敗注入：SAFETY / MAX_TOKENS で parts なしの応答にする
+        if kind_draw < faults.safety_rate:
+            chunks, finish_reason = [], "SAFETY"
+        elif kind_draw < faults.safety_rate + faults.max_tokens_rate:
+            chunks, finish_reason = [], "MAX_TOKENS"
+
+        if kwargs.get("stream"):
+            per_chunk = latency / max(1, len(chunks))
+            return ReplayResponse(
+                chunks or [""], finish_reason, usage, [per_chunk] * max(1, len(chunks))
+            )
+        time.sleep(latency)
+        return ReplayResponse(chunks, finish_reason, usage)
+
+
+# ======================================================
+# バックエンド
+# ======================================================
+class ModelBackend:
+    """
+    mode に応じて、get_gemini_model が返すモデルオブジェクトを作り分ける。
+    作ったモデルは (モデル名, 生成設定) ごとにプロセス内で使い回す（SDK のクライアント・接続も共有される）。
+    """
+
+    def __init__(
+        self,
+        mode: str = "live",
+        cassette_path: Optional[str] = None,
+        faults: Optional[FaultProfile] = None,
+        live_factory=None,
+    ):
+        if mode not in BACKEND_MODES:
+            raise ValueError(f"未対応のバックエンドです: {mode}（{' / '.join(BACKEND_MODES)}）")
+        self.mode = mode
+        self.faults = faults or FaultProfile()
+        self.cassette = Cassette(cassette_path) if cassette_path and mode != "live" else None
+        self._live_factory = live_factory
+        self._rng = random.Random(self.faults.seed or None)
+        self._rng_lock = threading.Lock()
+        self._models: Dict[Tuple[str, Any], Any] = {}
+        self._models_lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def _create(self, model_name: str, generation_config: Optional[Dict[str, Any]]):
+        if self.mode == "replay":
+            # 合成応答は呼び出しごとの generation_config で作るので、作成時の設定は使わない
+            return ReplayModel(model_name, self.cassette, self.faults, self._rng, self._rng_lock)
+        if generation_config:
+            inner = self._live_factory(model_name, generation_config=generation_config)
+        else:
+            inner = self._live_factory(model_name)
+        if self.mode == "record" and self.cassette is not None:
+            return RecordingModel(inner, model_name, self.cassette)
+        return inner
+
+    @staticmethod
+    def _model_key(model_name: str, generation_config: Optional[Dict[str, Any]]) -> Tuple[str, Any]:
+        if not generation_config:
+            return (model_name, ())
+        try:
+            key = (model_name, tuple(sorted(generation_config.items())))
+            hash(key)
+            return key
+        except TypeError:
+            # 値にリストなどハッシュできないものがあるときだけ文字列にする
+            return (model_name, json.dumps(generation_config, sort_keys=True, default=str))
+
+    def model(
+        self,
+        model_name: str,
+        generation_config: Optional[Dict[str, Any]] = None,
+        meta: Optional[Dict[str, Any]] = None,
+    ):
+        """キャッシュ済みのモデルを返す（無ければ作る）。meta には新しく作ったかどうか（created）を書き込む。"""
+        key = self._model_key(model_name, generation_config)
+        # 使い回しはロックを取らずに読む（dict.get は GIL の下で安全。reused は目安の回数）
+        model = self._models.get(key)
+        fresh = False
+        if model is not None:
+            self.reused += 1
+        else:
+            created = self._create(model_name, generation_config)
+            with self._models_lock:
+                # 同時に作られたときは先に入った方を使う
+                model = self._models.setdefault(key, created)
+                fresh = model is created
+                if fresh:
+                    self.created += 1
+                else:
+                    self.reused += 1
+        if meta is not None:
+            meta["created"] = fresh
+        return model
+
+    def clear_models(self) -> None:
+        """API キーを設定し直したときなど、作ったモデルを捨てる（次の呼び出しで作り直す）。"""
+        with self._models_lock:
+            self._models.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._models_lock:
+            return {"models": len(self._models), "created": self.created, "reused": self.reused}
+
+    @property
+    def requires_api_key(self) -> bool:
+        return self.mode != "replay"
@@ -0,0 +1,480 @@
+"""
+MAGI バッチ実行（Streamlit 画面を使わずに、大量の問いをまとめて分析する）。
+
+使い方（例）:
+    python magi_batch.py questions.csv -o results.jsonl --workers 4 --rpm 30 --swot --reports reports.zip
+
+入力（CSV または JSONL）の列:
+    id（任意）, question, text（任意・補足テキスト）, image（任意・画像パス）, audio（任意・音声パス）
+
+- 出力 JSONL は1行1件で、書き込むたびに flush する。
+- 同じ出力ファイルを指定して再実行すると、status が ok の id はスキップする（チェックポイント）。
+- 最後に処理件数とスループット（件/分）を表示する。
+"""
+import argparse
+import csv
+import json
+import mimetypes
+import os
+import re
+import sys
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from magi_core import (
+    DEFAULT_MODEL_NAME,
+    REPORT_FORMATS,
+    ReportBuilderPool,
+    call_magi_plain,
+    configure_gemini,
+    describe_image_cached,
+    export_metrics,
+    fanout_magi_plain,
+    get_metrics,
+    get_model_backend,
+    get_setting,
+    get_single_flight,
+    get_usage_ledger,
+    parse_magi_text,
+    prepare_audio_cached,
+    prepare_image_cached,
+    transcribe_audio_segmented,
+)
+from magi_backend import BACKEND_MODES
+from magi_cache import is_error_text
+from magi_media import EncodedImage
+from magi_scheduler import PRIORITY_BATCH, set_scheduler_caller
+from magi_usage import set_usage_session
+
+# 入力列名の別名（画面の項目名に合わせたものも受け付ける）
+FIELD_ALIASES = {
+    "question": ("question", "user_question", "問い"),
+    "text": ("text", "text_input", "補足"),
+    "image": ("image", "image_path"),
+    "audio": ("audio", "audio_path"),
+}
+
+
+# ======================================================
+# 入力・チェックポイント
+# ======================================================
+def _pick(row: Dict[str, Any], field: str) -> str:
+    for name in FIELD_ALIASES[field]:
+        value = row.get(name)
+        if value:
+            return str(value).strip()
+    return ""
+
+
+def load_rows(path: str) -> List[Dict[str, Any]]:
+    """
+    CSV（拡張子 .csv）または JSONL を読み込み、
+    id / question / text / image / audio を持つ dict のリストに正規化する。
+    画像・音声の相対パスは入力ファイルのあるディレクトリ基準で解決する。
+    """
+    base_dir = os.path.dirname(os.path.abspath(path))
+    raw_rows: List[Dict[str, Any]] = []
+    if path.lower().endswith(".csv"):
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            raw_rows = list(csv.DictReader(f))
+    else:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    raw_rows.append(json.loads(line))
+
+    rows = []
+    for index, raw in enumerate(raw_rows, start=1):
+        row = {
+            "id": str(raw.get("id") or index),
+            "question": _pick(raw, "question"),
+            "text": _pick(raw, "text"),
+            "image": _pick(raw, "image"),
+            "audio": _pick(raw, "audio"),
+        }
+        for field in ("image", "audio"):
+            if row[field] and not os.path.isabs(row[field]):
+                row[field] = os.path.join(base_dir, row[field])
+        rows.append(row)
+    return rows
+
+
+def load_checkpoint(output_path: str) -> Set[str]:
+    """出力 JSONL から、すでに成功している id の集合を返す（最後の行を優先）。"""
+    status: Dict[str, str] = {}
+    if not os.path.exists(output_path):
+        return set()
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 中断時に途中まで書かれた行は無視する
+                continue
+            status[str(record.get("id"))] = record.get("status", "")
+    return {rid for rid, st in status.items() if st == "ok"}
+
+
+# ======================================================
+# レート制御
+# ======================================================
+class RequestPacer:
+    """
+    全ワーカー共通で、1分あたりのリクエスト数（rpm）を超えないよう開始時刻を割り当てる。
+    レートリミットを受けたら penalize() で全体の次回開始を後ろにずらす。
+    """
+
+    def __init__(self, rpm: float = 0):
+        self.interval = 60.0 / rpm if rpm and rpm > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self, cost: int = 1) -> None:
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval * cost
+        delay = start - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def penalize(self, seconds: float) -> None:
+        with self._lock:
+            self._next = max(self._next, time.monotonic() + seconds)
+
+
+def is_retryable_error(text: Optional[str]) -> bool:
+    """
+    レートリミット・一時的な混雑だけを再試行対象にする。
+    日次クォータや free tier 0 は待っても回復しないので即失敗とする。
+    """
+    if not text or not is_error_text(text):
+        return False
+    return ("レートリミット" in text) or ("リソース逼迫" in text)
+
+
+# ======================================================
+# 1件分の分析
+# ======================================================
+def build_context(
+    row: Dict[str, Any], model_name: str, pacer: RequestPacer
+) -> Tuple[Dict[str, Any], Optional[EncodedImage]]:
+    context: Dict[str, Any] = {
+        "user_question": row["question"],
+        "text_input": row["text"],
+        "audio_transcript": "",
+        "image_description": "",
+        "long_input": get_setting("MAGI_LONG_INPUT_MODE", False),
+    }
+    image: Optional[EncodedImage] = None
+
+    if row["image"]:
+        with open(row["image"], "rb") as f:
+            data = f.read()
+        mime_type = mimetypes.guess_type(row["image"])[0] or "image/jpeg"
+        image = prepare_image_cached(data, "report")
+        pacer.wait()
+        context["image_description"] = describe_image_cached(data, mime_type, model_name)
+
+    if row["audio"]:
+        with open(row["audio"], "rb") as f:
+            data = f.read()
+        mime_type = mimetypes.guess_type(row["audio"])[0] or "audio/wav"
+        pacer.wait()
+        audio = prepare_audio_cached(data, mime_type)
+        context["audio_transcript"] = transcribe_audio_segmented(
+            audio.data, audio.mime_type, model_name
+        )
+
+    return context, image
+
+
+def analyze_row(
+    row: Dict[str, Any],
+    model_name: str,
+    enable_swot: bool,
+    mode: str,
+    pacer: RequestPacer,
+    max_retries: int = 3,
+    usage_session: str = "",
+) -> Tuple[Dict[str, Any], Dict[str, Any], Optional[EncodedImage]]:
+    """
+    1件を分析し、(出力レコード, context, 画像) を返す。
+    例外は投げず、失敗は status="error" のレコードとして返す。
+    record["usage"] には、この1件で使ったトークン数と推定費用が入る。
+    """
+    t0 = time.perf_counter()
+    usage_session = usage_session or f"batch:{row['id']}"
+    set_usage_session(usage_session)
+    # 実行枠は画面からの呼び出しを優先し、バッチ全体を1つのセッションとして順番に回す
+    set_scheduler_caller(usage_session.split(":", 1)[0], PRIORITY_BATCH)
+    record: Dict[str, Any] = {
+        "id": row["id"],
+        "question": row["question"],
+        "model": model_name,
+        "mode": mode,
+        "enable_swot": enable_swot,
+    }
+    try:
+        context, image = build_context(row, model_name, pacer)
+    except Exception as e:
+        record.update(status="error", error=f"入力の読み込みに失敗しました: {e}")
+        record["elapsed_sec"] = round(time.perf_counter() - t0, 3)
+        record["usage"] = session_usage(usage_session)
+        return record, {}, None
+
+    magi_text: Optional[str] = None
+    answered: Dict[str, Any] = {}
+    for attempt in range(max_retries + 1):
+        if mode == "fanout":
+            pacer.wait(cost=5)
+            magi_text = fanout_magi_plain(
+                context, enable_swot, model_name=model_name, meta=answered
+            )
+        else:
+            pacer.wait()
+            magi_text = call_magi_plain(context, enable_swot, model_name, meta=answered)
+        if not is_retryable_error(magi_text) or attempt == max_retries:
+            break
+        # 指数バックオフ（全ワーカー共通で待つ）
+        pacer.penalize(min(60.0, 2.0 ** (attempt + 1)))
+        record["retries"] = attempt + 1
+
+    record["elapsed_sec"] = round(time.perf_counter() - t0, 3)
+    record["usage"] = session_usage(usage_session)
+    if magi_text is None or is_error_text(magi_text):
+        record.update(
+            status="error",
+            error=magi_text or "【エラー】Gemini が有効なテキストを返しませんでした。",
+        )
+        return record, context, image
+
+    agents, aggregated, swot = parse_magi_text(magi_text)
+    record.update(
+        status="ok",
+        agents=agents,
+        aggregated=aggregated,
+        swot=swot if enable_swot else None,
+        raw_text=magi_text,
+        answered_model=answered.get("model") or model_name,
+    )
+    if answered.get("long_input"):
+        record["long_input"] = answered["long_input"]
+    return record, context, image
+
+
+def session_usage(session_id: str) -> Dict[str, Any]:
+    totals = get_usage_ledger().totals(session_id=session_id).values()
+    return {
+        "prompt_tokens": sum(t["prompt_tokens"] for t in totals),
+        "output_tokens": sum(t["output_tokens"] for t in totals),
+        "cost_usd": round(sum(t["cost_usd"] for t in totals), 6),
+    }
+
+
+def _report_name(record_id: str, fmt: str = "docx") -> str:
+    safe = re.sub(r"[^\w\-]+", "_", record_id).strip("_") or "report"
+    return f"MAGI分析レポート_{safe}.{REPORT_FORMATS[fmt][1]}"
+
+
+# ======================================================
+# バッチ本体
+# ======================================================
+def run_batch(
+    rows: Iterable[Dict[str, Any]],
+    output_path: str,
+    model_name: str = DEFAULT_MODEL_NAME,
+    enable_swot: bool = False,
+    mode: str = "single",
+    workers: int = 4,
+    rpm: float = 0,
+    report_zip: Optional[str] = None,
+    max_retries: int = 3,
+    progress: Optional[Callable[[int, int, Dict[str, Any]], None]] = None,
+    report_workers: int = 2,
+    report_processes: bool = False,
+    report_format: str = "docx",
+) -> Dict[str, Any]:
+    """
+    rows を並列に分析して output_path（JSONL）へ逐次追記する。
+    report_zip を指定すると、成功分のレポート（report_format 形式）を zip にまとめて追記する。
+    レポートは分析と並行して、report_workers 個のワーカー（report_processes=True ならプロセス）で作る。
+    戻り値は件数・経過時間・スループット（runs_per_minute）の集計。
+    """
+    rows = list(rows)
+    done_ids = load_checkpoint(output_path)
+    pending = [row for row in rows if row["id"] not in done_ids]
+    pacer = RequestPacer(rpm)
+
+    summary: Dict[str, Any] = {
+        "total": len(rows),
+        "skipped": len(rows) - len(pending),
+        "ok": 0,
+        "error": 0,
+        "usage": {"prompt_tokens": 0, "output_tokens": 0, "cost_usd": 0.0},
+    }
+    t0 = time.perf_counter()
+    run_id = time.strftime("%Y%m%d%H%M%S")
+
+    zf = zipfile.ZipFile(report_zip, "a", compression=zipfile.ZIP_DEFLATED) if report_zip else None
+    reports = ReportBuilderPool(report_workers, processes=report_processes) if zf is not None else None
+    try:
+        with open(output_path, "a", encoding="utf-8") as out, ThreadPoolExecutor(
+            max_workers=max(1, workers), thread_name_prefix="magi-batch"
+        ) as executor:
+            futures = [
+                executor.submit(
+                    analyze_row,
+                    row,
+                    model_name,
+                    enable_swot,
+                    mode,
+                    pacer,
+                    max_retries,
+                    f"batch-{run_id}:{row['id']}",
+                )
+                for row in pending
+            ]
+            # ファイル・zip への書き込みはこのスレッドだけで行う
+            for index, fut in enumerate(as_completed(futures), start=1):
+                record, context, image = fut.result()
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+                summary[record["status"]] += 1
+                for key, value in record.get("usage", {}).items():
+                    summary["usage"][key] += value
+
+                if reports is not None:
+                    if record["status"] == "ok":
+                        reports.submit(
+                            _report_name(record["id"], report_format),
+                            report_format,
+                            context=context,
+                            agents=record["agents"],
+                            aggregated=record["aggregated"],
+                            magi_raw_text=record["raw_text"],
+                            image=image,
+                            swot=record["swot"],
+                            enable_swot=enable_swot,
+                            answered_model=record["answered_model"],
+                        )
+                    for name, data in reports.completed():
+                        zf.writestr(name, data)
+                if progress is not None:
+                    progress(index, len(pending), record)
+            if reports is not None:
+                for name, data in reports.completed(wait=True):
+                    zf.writestr(name, data)
+    finally:
+        if reports is not None:
+            reports.close()
+        if zf is not None:
+            zf.close()
+
+    elapsed = time.perf_counter() - t0
+    processed = summary["ok"] + summary["error"]
+    summary["elapsed_sec"] = round(elapsed, 3)
+    summary["runs_per_minute"] = round(processed / elapsed * 60, 2) if elapsed > 0 else 0.0
+    # 同じ内容の行が同時に走ったとき、1回の呼び出しにまとめられた数
+    summary["coalesced"] = sum(s["coalesced"] for s in get_single_flight().stats().values())
+    return summary
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="MAGI 分析をバッチ実行する")
+    parser.add_argument("input", help="入力ファイル（.csv または .jsonl）")
+    parser.add_argument("-o", "--output", required=True, help="結果の JSONL（再実行時はチェックポイントとして使用）")
+    parser.add_argument("--model", default=DEFAULT_MODEL_NAME, help="使用する Gemini モデル")
+    parser.add_argument("--swot", action="store_true", help="SWOT 分析を有効にする")
+    parser.add_argument("--mode", choices=["single", "fanout"], default="single", help="一括 / 並列モード")
+    parser.add_argument("--workers", type=int, default=4, help="同時実行数")
+    parser.add_argument("--rpm", type=float, default=0, help="1分あたりの最大リクエスト数（0 で無制限）")
+    parser.add_argument("--max-retries", type=int, default=3, help="レートリミット時の最大再試行回数")
+    parser.add_argument("--reports", help="レポートをまとめる zip ファイル")
+    parser.add_argument(
+        "--report-format", choices=list(REPORT_FORMATS), default="docx", help="レポートの形式"
+    )
+    parser.add_argument("--report-workers", type=int, default=2, help="レポート作成の同時実行数")
+    parser.add_argument(
+        "--report-processes",
+        action="store_true",
+        help="レポートをスレッドではなく別プロセスで作る（件数が多いとき）",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=list(BACKEND_MODES),
+        help="live / record（カセットに記録）/ replay（カセット再生・API キー不要）",
+    )
+    parser.add_argument("--cassette", help="record / replay で使うカセットファイル（JSONL）")
+    parser.add_argument(
+        "--long-input",
+        action="store_true",
+        help="長文入力モード（600 文字で切らず、長い入力欄を分割要約してから渡す）",
+    )
+    parser.add_argument(
+        "--metrics",
+        help="処理段階ごとの所要時間の集計を書き出すファイル（.jsonl なら JSON Lines、それ以外は Prometheus 形式）",
+    )
+    args = parser.parse_args(argv)
+
+    # バックエンドは最初のモデル取得時に設定から組み立てられるので、先に環境変数へ反映する
+    if args.backend:
+        os.environ["MAGI_BACKEND"] = args.backend
+    if args.cassette:
+        os.environ["MAGI_CASSETTE_PATH"] = args.cassette
+    if args.long_input:
+        os.environ["MAGI_LONG_INPUT_MODE"] = "1"
+
+    api_key = os.getenv("GEMINI_API_KEY")
+    if api_key:
+        configure_gemini(api_key)
+    elif get_model_backend().requires_api_key:
+        print("環境変数 GEMINI_API_KEY を設定してください。", file=sys.stderr)
+        return 2
+
+    def _progress(index: int, total: int, record: Dict[str, Any]) -> None:
+        print(f"[{index}/{total}] {record['id']}: {record['status']}", file=sys.stderr)
+
+    summary = run_batch(
+        load_rows(args.input),
+        args.output,
+        model_name=args.model,
+        enable_swot=args.swot,
+        mode=args.mode,
+        workers=args.workers,
+        rpm=args.rpm,
+        report_zip=args.reports,
+        max_retries=args.max_retries,
+        progress=_progress,
+        report_workers=args.report_workers,
+        report_processes=args.report_processes,
+        report_format=args.report_format,
+    )
+    if args.metrics:
+        get_metrics().export(args.metrics)
+    export_metrics()
+    print(
+        f"完了: {summary['ok']} 件成功 / {summary['error']} 件失敗 / "
+        f"{summary['skipped']} 件スキップ（全 {summary['total']} 件）",
+        file=sys.stderr,
+    )
+    print(
+        f"経過時間 {summary['elapsed_sec']:.1f} 秒 ／ スループット {summary['runs_per_minute']:.1f} 件/分"
+        + (f" ／ 重複呼び出しの集約 {summary['coalesced']} 回" if summary["coalesced"] else ""),
+        file=sys.stderr,
+    )
+    usage = summary["usage"]
+    print(
+        f"トークン 入力 {usage['prompt_tokens']:,} / 出力 {usage['output_tokens']:,}"
+        f"（推定 ${usage['cost_usd']:.4f}）",
+        file=sys.stderr,
+    )
+    return 0 if summary["error"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
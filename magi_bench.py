@@ -0,0 +1,348 @@
+"""
+MAGI のベンチマーク（LLM 呼び出し以外のホットパスと、スタブバックエンドでのエンドツーエンド）。
+
+使い方:
+    python magi_bench.py -o bench.json                      # 計測して、同梱の bench_baseline.json と比較（悪化があれば終了コード 1）
+    python magi_bench.py --baseline other.json              # 別のベースラインと比較
+    python magi_bench.py --no-baseline                      # 比較しない
+    python magi_bench.py --update-baseline                  # 今回の結果で bench_baseline.json を取り直す
+
+- 同梱のベースラインはオフライン（MAGI_BACKEND=replay）で計測したもの。時間はマシンに依存するので、
+  別の環境で比較するときは先に --update-baseline で取り直す
+
+- コーパス: サイズ違い（small / medium / large）の合成 MAGI 出力と、
+  --cassette で指定したカセット（magi_backend の record モードで記録したもの）の実出力
+- 計測: 各ベンチマークの所要時間（中央値・p95・最小、ミリ秒）と、
+  tracemalloc によるピークメモリ（KB、Python 側の確保量。PIL など C 拡張内の確保は含まない）
+- エンドツーエンド: MAGI_BACKEND=replay（API キー不要）で call_magi_plain → パース → HTML → Word レポート
+- モデルの取得: キャッシュ済みモデルの使い回しと GenerativeModel の新規作成（1スレッド・16スレッド）
+"""
+import argparse
+import atexit
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+# 合成コーパスのサイズ（要約・詳細・SWOT 項目の繰り返し倍率）
+CORPUS_SIZES = {"small": 1, "medium": 8, "large": 64}
+IMAGE_SIZES = {"small": (640, 480), "large": (4000, 3000)}
+VERDICTS = ("可決", "保留", "否決")
+
+
+# ======================================================
+# コーパス
+# ======================================================
+def synthetic_magi_text(scale: int, enable_swot: bool = True) -> str:
+    """call_magi_plain と同じフォーマットの MAGI 出力を、scale 倍の分量で作る。"""
+    sentence = "入力内容を踏まえると一定の妥当性があります。前提条件の確認が必要です。"
+    blocks = []
+    for index, name in enumerate(("Magi-Logic", "Magi-Human", "Magi-Reality", "Magi-Media")):
+        blocks.append(
+            f"【{name}】\n判定: {VERDICTS[index % 3]}\n要約: {sentence * scale}\n"
+        )
+    blocks.append(f"【MAGI-統合サマリー】\n{sentence * scale}\n")
+    paragraphs = "\n\n".join(
+        f"第{i + 1}段落：全体として条件付きで進めるのが妥当です。" * scale for i in range(3)
+    )
+    blocks.append(f"【MAGI-統合詳細】\n{paragraphs}\n")
+    if enable_swot:
+        lines = [
+            f"{label}: " + "、".join(f"{label[0]}項目{i}" for i in range(5 * scale))
+            for label in ("Strengths", "Weaknesses", "Opportunities", "Threats")
+        ]
+        blocks.append("【SWOT分析】\n" + "\n".join(lines) + "\n")
+    return "\n".join(blocks)
+
+
+def load_captured_texts(path: str) -> List[str]:
+    """カセットファイルから、MAGI フォーマットの実出力だけを取り出す。"""
+    texts = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            text = "".join(json.loads(line).get("chunks") or [])
+            if "【MAGI-統合サマリー】" in text:
+                texts.append(text)
+    return texts
+
+
+def build_corpus(cassette: Optional[str] = None) -> Dict[str, str]:
+    corpus = {size: synthetic_magi_text(scale) for size, scale in CORPUS_SIZES.items()}
+    if cassette and os.path.exists(cassette):
+        for index, text in enumerate(load_captured_texts(cassette)):
+            corpus[f"captured{index}"] = text
+    return corpus
+
+
+def synthetic_context(scale: int, suffix: str = "") -> Dict[str, Any]:
+    filler = "背景説明のテキストです。関係者の意見や制約条件を含みます。"
+    return {
+        "user_question": f"新規事業に投資すべきか判断したい{suffix}",
+        "text_input": filler * 20 * scale,
+        "audio_transcript": filler * 10 * scale,
+        "image_description": "会議室の写真。落ち着いた雰囲気。",
+    }
+
+
+def synthetic_image(size: Tuple[int, int]) -> Image.Image:
+    # 単色だと圧縮が効きすぎるので、グラデーションにする
+    gradient = Image.linear_gradient("L").resize(size)
+    return Image.merge("RGB", (gradient, gradient.rotate(90, expand=False), gradient))
+
+
+# ======================================================
+# 計測
+# ======================================================
+def _percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def measure(
+    func: Callable[[], Any], repeat: int, min_time_sec: float = 0.2
+) -> Dict[str, float]:
+    """func を repeat 回以上（合計 min_time_sec 秒以上）実行し、時間とピークメモリを返す。"""
+    func()  # ウォームアップ
+    samples: List[float] = []
+    started = time.perf_counter()
+    while len(samples) < repeat or (time.perf_counter() - started < min_time_sec and len(samples) < repeat * 50):
+        t0 = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - t0) * 1000.0)
+
+    # tracemalloc は実行を遅くするので、時間計測とは別に1回だけ測る
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "runs": len(samples),
+        "median_ms": round(statistics.median(samples), 4),
+        "p95_ms": round(_percentile(samples, 0.95), 4),
+        "min_ms": round(min(samples), 4),
+        "peak_kb": round(peak / 1024.0, 1),
+    }
+
+
+def run_benchmarks(
+    repeat: int = 20,
+    cassette: Optional[str] = None,
+    only: Optional[str] = None,
+) -> Dict[str, Dict[str, float]]:
+    work_dir = tempfile.mkdtemp(prefix="magi_bench_")
+    # SQLite は終了まで開いたままなので、作業ディレクトリはプロセスの終了時に消す
+    atexit.register(shutil.rmtree, work_dir, True)
+
+    import magi_core as core
+
+    # 既にある MAGI_BACKEND=live などより優先して replay に固定する（本物の API は呼ばない）
+    core.prepare_offline_environment(work_dir)
+
+    corpus = build_corpus(cassette)
+    benches: Dict[str, Tuple[Callable[[], Any], int]] = {}
+
+    for size, scale in CORPUS_SIZES.items():
+        context = synthetic_context(scale)
+        benches[f"prompt_assembly/{size}"] = (lambda c=context: core.build_magi_ctx_text(c), repeat)
+
+    for name, text in corpus.items():
+        agents, aggregated, swot = core.parse_magi_text(text)
+        benches[f"parse_magi_text/{name}"] = (lambda t=text: core.parse_magi_text(t), repeat)
+
+        agent_body = text.split("【Magi-Human】")[0].split("】", 1)[-1]
+        benches[f"parse_agent_block/{name}"] = (
+            lambda b=agent_body: core.parse_agent_block("Magi-Logic", b), repeat
+        )
+        swot_body = text.split("【SWOT分析】")[-1]
+        benches[f"parse_swot_block/{name}"] = (lambda b=swot_body: core.parse_swot_block(b), repeat)
+        benches[f"swot_text_to_chips/{name}"] = (
+            lambda s=swot: [core.swot_text_to_chips(s[k], k) for k, _, _ in core.SWOT_PANELS],
+            repeat,
+        )
+
+        def _render(a=agents, g=aggregated, s=swot):
+            for key, agent in a.items():
+                core.agent_panel_html(key, agent)
+            core.aggregated_html(g)
+            for key, title, chip_class in core.SWOT_PANELS:
+                core.swot_panel_html(title, core.swot_text_to_chips(s.get(key, ""), chip_class))
+
+        benches[f"render_html/{name}"] = (_render, repeat)
+
+        def _report(t=text, a=agents, g=aggregated, s=swot):
+            return core.build_word_report(
+                context=synthetic_context(1), agents=a, aggregated=g,
+                magi_raw_text=t, swot=s, enable_swot=True,
+            )
+
+        benches[f"build_word_report/{name}"] = (_report, max(3, repeat // 4))
+
+    sample = corpus["medium"]
+    agents, aggregated, swot = core.parse_magi_text(sample)
+    for size, dims in IMAGE_SIZES.items():
+        image = synthetic_image(dims)
+        benches[f"build_word_report_image/{size}"] = (
+            lambda img=image: core.build_word_report(
+                context=synthetic_context(1), agents=agents, aggregated=aggregated,
+                magi_raw_text=sample, image=img, swot=swot, enable_swot=True,
+            ),
+            3,
+        )
+
+    # モデルの取得：キャッシュ済みモデルの使い回しと、呼び出しごとに GenerativeModel を作っていた以前のやり方
+    core.get_gemini_model(core.DEFAULT_MODEL_NAME)
+    benches["model_client/cached"] = (lambda: core.get_gemini_model(core.DEFAULT_MODEL_NAME), repeat)
+    benches["model_client/new_generative_model"] = (
+        lambda: core.genai.GenerativeModel(core.DEFAULT_MODEL_NAME), repeat
+    )
+    pool = ThreadPoolExecutor(max_workers=16)
+
+    def _concurrent(fn: Callable[[], Any], calls: int = 100) -> None:
+        # 16 セッション相当のスレッドから同時に取得する
+        list(pool.map(lambda _: [fn() for _ in range(calls)], range(16)))
+
+    benches["model_client/cached_16threads"] = (
+        lambda: _concurrent(lambda: core.get_gemini_model(core.DEFAULT_MODEL_NAME)), max(3, repeat // 4)
+    )
+    benches["model_client/new_generative_model_16threads"] = (
+        lambda: _concurrent(lambda: core.genai.GenerativeModel(core.DEFAULT_MODEL_NAME)), max(3, repeat // 4)
+    )
+
+    counter = {"n": 0}
+
+    def _end_to_end():
+        # 毎回違う質問にして、結果キャッシュに当たらないようにする
+        counter["n"] += 1
+        context = synthetic_context(1, suffix=f"（{counter['n']}）")
+        text = core.call_magi_plain(context, enable_swot=True)
+        a, g, s = core.parse_magi_text(text)
+        for key, agent in a.items():
+            core.agent_panel_html(key, agent)
+        core.aggregated_html(g)
+        return core.build_word_report(
+            context=context, agents=a, aggregated=g, magi_raw_text=text, swot=s, enable_swot=True
+        )
+
+    benches["end_to_end/replay"] = (_end_to_end, max(3, repeat // 4))
+
+    results: Dict[str, Dict[str, float]] = {}
+    for name, (func, runs) in benches.items():
+        if only and only not in name:
+            continue
+        results[name] = measure(func, runs)
+    return results
+
+
+# ======================================================
+# ベースライン比較
+# ======================================================
+DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+
+def compare_to_baseline(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    tolerance: float = 0.25,
+    min_delta_ms: float = 0.05,
+) -> List[Dict[str, Any]]:
+    """
+    中央値の時間とピークメモリが、ベースラインから tolerance（割合）を超えて悪化したものを返す。
+    ごく短い処理のノイズで誤検知しないよう、min_delta_ms 未満の差は無視する。
+    """
+    regressions = []
+    for name, current in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for metric, floor in (("median_ms", min_delta_ms), ("peak_kb", 1.0)):
+            before, after = base.get(metric), current.get(metric)
+            if before is None or after is None:
+                continue
+            if after > before * (1.0 + tolerance) and after - before > floor:
+                regressions.append(
+                    {
+                        "name": name,
+                        "metric": metric,
+                        "baseline": before,
+                        "current": after,
+                        "ratio": round(after / before, 3) if before else None,
+                    }
+                )
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="MAGI のベンチマーク")
+    parser.add_argument("-o", "--output", help="結果を書き出す JSON ファイル（省略時は標準出力）")
+    parser.add_argument("--repeat", type=int, default=20, help="各ベンチマークの最低実行回数")
+    parser.add_argument("--only", help="名前にこの文字列を含むベンチマークだけ実行する")
+    parser.add_argument("--cassette", help="実出力コーパスとして読み込むカセットファイル")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH, help="比較するベースライン JSON（既定は同梱のもの）")
+    parser.add_argument("--no-baseline", action="store_true", help="ベースラインと比較しない")
+    parser.add_argument("--update-baseline", action="store_true", help="今回の結果でベースラインを上書きする")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="悪化とみなす割合（0.25 = 25%%）")
+    args = parser.parse_args(argv)
+    if args.no_baseline:
+        args.baseline = None
+
+    results = run_benchmarks(repeat=args.repeat, cassette=args.cassette, only=args.only)
+    report: Dict[str, Any] = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+    for name, r in results.items():
+        print(
+            f"{name:45s} median {r['median_ms']:10.3f} ms  p95 {r['p95_ms']:10.3f} ms"
+            f"  peak {r['peak_kb']:10.1f} KB  ({r['runs']} runs)",
+            file=sys.stderr,
+        )
+
+    exit_code = 0
+    if args.baseline and not args.update_baseline and not os.path.exists(args.baseline):
+        print(f"ベースラインがありません（比較しません）: {args.baseline}", file=sys.stderr)
+    elif args.baseline and not args.update_baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f).get("results", {})
+        regressions = compare_to_baseline(results, baseline, tolerance=args.tolerance)
+        report["regressions"] = regressions
+        for reg in regressions:
+            print(
+                f"[悪化] {reg['name']} {reg['metric']}: {reg['baseline']} → {reg['current']}"
+                f"（×{reg['ratio']}）",
+                file=sys.stderr,
+            )
+        exit_code = 1 if regressions else 0
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.baseline and args.update_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        print(f"ベースラインを更新しました: {args.baseline}", file=sys.stderr)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,340 @@
+"""
+MAGI 用キャッシュ層。
+
+- MediaDerivationCache: 画像説明・音声文字起こしなど「媒体 → テキスト」変換結果の
+  プロセス内 LRU キャッシュ（全セッション共有）
+- ResultCache: call_magi_plain の結果を SQLite に圧縮保存する永続キャッシュ
+  （TTL・容量上限つき LRU、プロセス再起動後も有効）
+- ReportCache: 作成済みの Word レポート（bytes）のプロセス内 LRU キャッシュ
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from magi_singleflight import SingleFlight
+
+# Gemini 呼び出し失敗時のメッセージ接頭辞（キャッシュしてはいけない）
+ERROR_PREFIX = "【エラー】"
+
+
+def is_error_text(text: Optional[str]) -> bool:
+    return text is None or text.startswith(ERROR_PREFIX)
+
+
+def media_cache_key(
+    data: bytes, mime_type: str, model_name: str, prompt_version: str
+) -> str:
+    """
+    アップロードされたバイト列そのもののハッシュに、
+    mime type・モデル名・プロンプト版を組み合わせたキーを返す。
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    return f"{model_name}|{prompt_version}|{mime_type or ''}|{digest}"
+
+
+class MediaDerivationCache:
+    """
+    件数上限と合計文字数上限を持つ、スレッドセーフな LRU キャッシュ。
+    エラーメッセージ（【エラー】〜）は保存しない。
+    """
+
+    def __init__(self, max_entries: int = 256, max_chars: int = 2_000_000):
+        self.max_entries = max(1, int(max_entries))
+        self.max_chars = max(1, int(max_chars))
+        self._data: "OrderedDict[str, str]" = OrderedDict()
+        self._chars = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: str) -> None:
+        if is_error_text(value) or len(value) > self.max_chars:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._chars -= len(old)
+            self._data[key] = value
+            self._chars += len(value)
+            while self._data and (
+                len(self._data) > self.max_entries or self._chars > self.max_chars
+            ):
+                _, evicted = self._data.popitem(last=False)
+                self._chars -= len(evicted)
+                self.evictions += 1
+
+    def get_or_compute(
+        self,
+        key: str,
+        compute: Callable[[], str],
+        single_flight: Optional[SingleFlight] = None,
+        group: str = "",
+    ) -> str:
+        """
+        single_flight を渡すと、同じ key の compute が同時に走らないよう1つにまとめる
+        （結果はキャッシュに入れてから、待っていた呼び出しに渡す）。
+        """
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        if single_flight is None:
+            value = compute()
+            self.put(key, value)
+            return value
+
+        def _compute_once() -> str:
+            # 直前に同じ key の呼び出しが終わっていれば、その結果を使う
+            with self._lock:
+                value = self._data.get(key)
+            if value is None:
+                value = compute()
+                self.put(key, value)
+            return value
+
+        return single_flight.do(key, _compute_once, group)[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._chars = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "chars": self._chars,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class ReportCache:
+    """
+    合計バイト数の上限を持つ、作成済みレポート（bytes）のスレッドセーフな LRU キャッシュ。
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max(1, int(max_bytes))
+        self._data: "OrderedDict[str, bytes]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: bytes) -> None:
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._data[key] = value
+            self._bytes += len(value)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def result_cache_key(**parts: Any) -> str:
+    """
+    キーワード引数（モデル名・プロンプト版・正規化済みコンテキストなど）から
+    安定したハッシュキーを作る。
+    """
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def normalize_context_text(text: str) -> str:
+    """
+    キャッシュキー用に、行末の空白と連続する空行を正規化する。
+    """
+    lines = [line.rstrip() for line in (text or "").strip().splitlines()]
+    out = []
+    for line in lines:
+        if not line and out and not out[-1]:
+            continue
+        out.append(line)
+    return "\n".join(out)
+
+
+class ResultCache:
+    """
+    SQLite を使った永続キャッシュ。
+    - 値は zlib 圧縮して保存
+    - ttl_sec を過ぎたエントリはミス扱いで削除
+    - 合計サイズが max_bytes を超えたら、最終アクセスが古いものから削除（LRU）
+    - エラーメッセージ（【エラー】〜）と None は保存しない
+    - 値と一緒に、回答したモデル名などの付帯情報（meta）を JSON で保存できる
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl_sec: float = 24 * 3600,
+        max_bytes: int = 64 * 1024 * 1024,
+        compress_level: int = 6,
+    ):
+        self.path = path
+        self.ttl_sec = float(ttl_sec)
+        self.max_bytes = max(1, int(max_bytes))
+        self.compress_level = compress_level
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS magi_results (
+                    key TEXT PRIMARY KEY,
+                    payload BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL,
+                    meta TEXT
+                )
+                """
+            )
+            columns = [
+                row[1] for row in self._conn.execute("PRAGMA table_info(magi_results)")
+            ]
+            if "meta" not in columns:
+                # meta 列が無い古いキャッシュファイルを移行する
+                self._conn.execute("ALTER TABLE magi_results ADD COLUMN meta TEXT")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_magi_results_accessed "
+                "ON magi_results(accessed_at)"
+            )
+
+    def get(self, key: str) -> Optional[str]:
+        return self.get_with_meta(key)[0]
+
+    def get_with_meta(self, key: str) -> Tuple[Optional[str], Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT payload, created_at, meta FROM magi_results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None, {}
+            payload, created_at, meta = row
+            if self.ttl_sec > 0 and now - created_at > self.ttl_sec:
+                self._conn.execute("DELETE FROM magi_results WHERE key = ?", (key,))
+                self.misses += 1
+                return None, {}
+            self._conn.execute(
+                "UPDATE magi_results SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            self.hits += 1
+        return zlib.decompress(payload).decode("utf-8"), json.loads(meta) if meta else {}
+
+    def put(
+        self, key: str, value: Optional[str], meta: Optional[Dict[str, Any]] = None
+    ) -> None:
+        if is_error_text(value):
+            return
+        payload = zlib.compress(value.encode("utf-8"), self.compress_level)
+        if len(payload) > self.max_bytes:
+            return
+        now = time.time()
+        meta_json = json.dumps(meta, ensure_ascii=False) if meta else None
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO magi_results "
+                "(key, payload, size, created_at, accessed_at, meta) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, payload, len(payload), now, now, meta_json),
+            )
+            self._evict_locked()
+
+    def get_or_compute(
+        self, key: str, compute: Callable[[], Optional[str]]
+    ) -> Optional[str]:
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        value = compute()
+        self.put(key, value)
+        return value
+
+    def _evict_locked(self) -> None:
+        if self.ttl_sec > 0:
+            cur = self._conn.execute(
+                "DELETE FROM magi_results WHERE created_at < ?",
+                (time.time() - self.ttl_sec,),
+            )
+            self.evictions += max(cur.rowcount, 0)
+
+        total = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM magi_results"
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute(
+            "SELECT key, size FROM magi_results ORDER BY accessed_at ASC"
+        ).fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM magi_results WHERE key = ?", (key,))
+            total -= size
+            self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM magi_results")
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            entries, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM magi_results"
+            ).fetchone()
+            return {
+                "entries": entries,
+                "bytes": total,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,2499 @@
+"""
+MAGI 分析の中核ロジック（Streamlit に依存しない部分）。
+
+プロンプト構築・Gemini 呼び出し（一括／ストリーミング／並列）・テキストのパース・
+表示用 HTML・Word レポート生成をまとめたモジュール。
+Streamlit 画面（AI_agent.py）とバッチ実行（magi_batch.py）の両方から利用する。
+"""
+import contextvars
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures import wait as futures_wait
+from functools import lru_cache, wraps
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+from PIL import Image
+
+import google.generativeai as genai
+from google.api_core.exceptions import (
+    DeadlineExceeded,
+    GoogleAPIError,
+    ResourceExhausted,
+    ServiceUnavailable,
+)
+
+from magi_audio import (
+    AudioSegment,
+    NormalizedAudio,
+    NormalizedAudioCache,
+    normalize_wav,
+    passthrough_audio,
+    split_wav,
+    stitch_transcripts,
+)
+from magi_backend import FaultProfile, ModelBackend, request_key
+from magi_fallback import ModelHealthTracker, model_cascade
+from magi_history import AnalysisHistory
+from magi_ingest import IngestedText, TextSpool
+from magi_jobs import JobCancelled, JobQueue, check_cancelled, current_job
+from magi_media import DOCX_IMAGE_FORMATS, EncodedImage, EncodedImageCache, ImageProfile, encode_image
+from magi_metrics import MetricsRegistry
+from magi_ratelimit import (
+    RETRYABLE_CATEGORIES,
+    RateLimiter,
+    RateLimitWaitTooLong,
+    backoff_delay,
+    parse_retry_delay,
+    quota_category,
+)
+from magi_report import (
+    REPORT_FORMATS,
+    SWOT_LABELS,
+    DocxTemplate,
+    default_template_bytes,
+    render_html,
+    render_json,
+    render_markdown,
+)
+from magi_scheduler import (
+    PRIORITY_INTERACTIVE,
+    FairScheduler,
+    SchedulerWaitTooLong,
+    current_scheduler_caller,
+)
+from magi_singleflight import SingleFlight
+from magi_summarize import (
+    allocate_budgets,
+    iter_chunks_from_blocks,
+    map_reduce_summarize,
+    summarize_chunk_stream,
+)
+from magi_usage import (
+    DEFAULT_PRICES_PER_MTOK,
+    FALLBACK_PRICE_PER_MTOK,
+    TokenCountCache,
+    UsageLedger,
+    current_usage_session,
+    estimate_cost,
+    usage_from_response,
+)
+from magi_cache import (
+    MediaDerivationCache,
+    ReportCache,
+    ResultCache,
+    is_error_text,
+    media_cache_key,
+    normalize_context_text,
+    result_cache_key,
+)
+
+# ======================================================
+# 設定値
+# ======================================================
+# 環境変数より優先して参照する設定ソース（Streamlit 画面では st.secrets を登録する）
+_settings_source: Optional[Callable[[str], Any]] = None
+
+
+def set_settings_source(source: Optional[Callable[[str], Any]]) -> None:
+    global _settings_source
+    _settings_source = source
+
+
+def get_setting(name: str, default: Any) -> Any:
+    """
+    登録済み設定ソース（st.secrets など）→ 環境変数 → デフォルト値 の順で設定値を取得する。
+    """
+    value = _settings_source(name) if _settings_source is not None else None
+    if value is None or value == "":
+        value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    if isinstance(default, bool):
+        return str(value).strip().lower() in ("1", "true", "yes", "on")
+    if isinstance(default, int):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return default
+    if isinstance(default, float):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return default
+    return value
+
+
+# ======================================================
+# モデル（デフォルトは gemini-2.0-flash）
+# ======================================================
+DEFAULT_MODEL_NAME = "gemini-2.0-flash"
+
+MODEL_CHOICES = {
+    "Gemini 2.0 Flash（デフォルト）": "gemini-2.0-flash",
+    "Gemini 2.5 Flash": "gemini-2.5-flash",
+    "Gemini 2.5 Pro": "gemini-2.5-pro",
+    "Gemini 2.5 Flash Lite": "gemini-2.5-flash-lite",
+}
+
+
+_configured_api_key: Optional[str] = None
+_configure_lock = threading.Lock()
+
+
+def configure_gemini(api_key: str) -> bool:
+    """
+    genai.configure をプロセスで1回だけ行う（画面の再実行ごとには呼ばない）。
+    API キーが変わったときだけ設定し直し、古いキーで作ったモデルを捨てる。設定したら True。
+    """
+    global _configured_api_key
+    with _configure_lock:
+        if api_key == _configured_api_key:
+            return False
+        with get_metrics().span("gemini.configure"):
+            genai.configure(api_key=api_key)
+        if _configured_api_key is not None:
+            get_model_backend().clear_models()
+        _configured_api_key = api_key
+    return True
+
+
+@lru_cache(maxsize=1)
+def get_model_backend() -> ModelBackend:
+    """
+    MAGI_BACKEND（live / record / replay）に応じたバックエンド。
+    record / replay では MAGI_CASSETTE_PATH のカセットファイルを使い、
+    replay では MAGI_FAKE_* で遅延や失敗を注入できる。
+    """
+    return ModelBackend(
+        mode=str(get_setting("MAGI_BACKEND", "live")).strip().lower(),
+        cassette_path=get_setting("MAGI_CASSETTE_PATH", os.path.join(".magi_cache", "cassette.jsonl")),
+        faults=FaultProfile(
+            latency_sec=get_setting("MAGI_FAKE_LATENCY_SEC", 0.0),
+            latency_jitter_sec=get_setting("MAGI_FAKE_LATENCY_JITTER_SEC", 0.0),
+            use_recorded_latency=get_setting("MAGI_FAKE_USE_RECORDED_LATENCY", False),
+            resource_exhausted_rate=get_setting("MAGI_FAKE_RESOURCE_EXHAUSTED_RATE", 0.0),
+            safety_rate=get_setting("MAGI_FAKE_SAFETY_RATE", 0.0),
+            max_tokens_rate=get_setting("MAGI_FAKE_MAX_TOKENS_RATE", 0.0),
+            strict=get_setting("MAGI_REPLAY_STRICT", False),
+            seed=get_setting("MAGI_FAKE_SEED", 0),
+        ),
+        live_factory=genai.GenerativeModel,
+    )
+
+
+# オフライン計測（magi_bench・magi_api bench）の書き込み先（環境変数 → 作業ディレクトリ内の名前）
+OFFLINE_STATE_PATHS = {
+    "MAGI_RESULT_CACHE_PATH": "results.sqlite3",
+    "MAGI_USAGE_DB_PATH": "usage.sqlite3",
+    "MAGI_HISTORY_DB_PATH": "history.sqlite3",
+    "MAGI_JOBS_DB_PATH": "jobs.sqlite3",
+    "MAGI_TEXT_SPOOL_DIR": "spool",
+}
+
+
+def prepare_offline_environment(work_dir: str, overrides: Optional[Dict[str, str]] = None) -> None:
+    """
+    計測用に、合成バックエンド（replay）・レート制御なし・書き込み先は work_dir の中、に環境変数を固定する。
+    既にある環境変数（MAGI_BACKEND=live など）より優先し、overrides も同じく上書きで固定する。
+    設定ソース（st.secrets など）のせいで replay にならなければ RuntimeError（本物の API に負荷をかけない）。
+    設定はシングルトンの生成時に読まれるので、最初の呼び出しより前に呼ぶ。
+    """
+    os.environ["MAGI_BACKEND"] = "replay"
+    os.environ["MAGI_RATE_LIMIT_ENABLED"] = "false"
+    os.environ.setdefault("MAGI_FAKE_SEED", "1")
+    # カセットは読むだけなので、指定があればそれを使う
+    os.environ.setdefault("MAGI_CASSETTE_PATH", os.path.join(work_dir, "cassette.jsonl"))
+    for name, file_name in OFFLINE_STATE_PATHS.items():
+        os.environ[name] = os.path.join(work_dir, file_name)
+    os.environ["MAGI_METRICS_EXPORT_PATH"] = ""
+    os.environ.update(overrides or {})
+    mode = get_model_backend().mode
+    if mode != "replay":
+        raise RuntimeError(f"オフライン計測は MAGI_BACKEND=replay でしか実行できません（現在: {mode}）")
+
+
+def get_gemini_model(model_name: str = DEFAULT_MODEL_NAME, generation_config: Optional[Dict[str, Any]] = None):
+    """
+    どのモデルに対しても「同じ聞き方」を維持するため、
+    呼び出し方は変えず、モデル名だけを切り替える。
+    （MAGI_BACKEND=replay ならカセット／合成応答を返すモデルになる）
+    モデルは (モデル名, 生成設定) ごとにプロセス内で使い回す（作成・使い回しの回数は
+    get_model_backend().stats() で見られる）。
+    """
+    return get_model_backend().model(model_name, generation_config)
+
+
+def warm_up_models(model_names: Optional[List[str]] = None) -> Dict[str, float]:
+    """
+    起動時にモデルを作っておき、live / record では count_tokens を1回呼んで接続を張っておく
+    （生成はしないのでクォータは使わない）。モデルごとの所要秒数を返す。
+    """
+    if model_names is None:
+        model_names = [
+            m.strip() for m in str(get_setting("MAGI_WARMUP_MODELS", DEFAULT_MODEL_NAME)).split(",") if m.strip()
+        ]
+    connect = get_model_backend().mode != "replay" and get_setting("MAGI_WARMUP_CONNECT", True)
+    timings: Dict[str, float] = {}
+    for name in model_names:
+        t0 = time.perf_counter()
+        status = "ok"
+        model = get_gemini_model(name)
+        if connect:
+            try:
+                model.count_tokens("warm-up")
+            except Exception:
+                status = "error"
+        timings[name] = time.perf_counter() - t0
+        get_metrics().observe("model.warmup", timings[name], name, status)
+    return timings
+
+
+@lru_cache(maxsize=1)
+def start_model_warm_up() -> threading.Thread:
+    """warm_up_models をプロセスで1回だけ、バックグラウンドのスレッドで始める（画面の表示を待たせない）。"""
+    thread = threading.Thread(target=warm_up_models, name="magi-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+# ======================================================
+# 処理段階ごとの計測（全セッション共有のヒストグラム）
+# ======================================================
+@lru_cache(maxsize=1)
+def get_metrics() -> MetricsRegistry:
+    return MetricsRegistry(recent=get_setting("MAGI_METRICS_RECENT_SAMPLES", 1000))
+
+
+def export_metrics() -> None:
+    """MAGI_METRICS_EXPORT_PATH があれば集計結果を書き出す（.jsonl なら JSON Lines、それ以外は Prometheus）。"""
+    path = get_setting("MAGI_METRICS_EXPORT_PATH", "")
+    if path:
+        get_metrics().export(path)
+
+
+def _timed(stage: str):
+    """関数全体の所要時間を stage として記録するデコレータ。"""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with get_metrics().span(stage):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# ======================================================
+# レート制御（モデルごとの RPM / TPM ＋ 指数バックオフ）
+# ======================================================
+# 無料枠を目安にした既定値（rpm, tpm）。MAGI_RPM_<MODEL> / MAGI_TPM_<MODEL> で上書きできる
+DEFAULT_RATE_LIMITS = {
+    "gemini-2.0-flash": (15, 1_000_000),
+    "gemini-2.5-flash": (10, 250_000),
+    "gemini-2.5-pro": (5, 250_000),
+    "gemini-2.5-flash-lite": (15, 250_000),
+}
+FALLBACK_RATE_LIMIT = (10, 250_000)
+
+
+def _model_setting_name(prefix: str, model_name: str) -> str:
+    # gemini-2.5-pro → MAGI_RPM_GEMINI_2_5_PRO
+    return prefix + "_" + re.sub(r"[^A-Za-z0-9]", "_", model_name).upper()
+
+
+def rate_limits_for(model_name: str) -> tuple[float, float]:
+    if not get_setting("MAGI_RATE_LIMIT_ENABLED", True):
+        return (0, 0)
+    default_rpm, default_tpm = DEFAULT_RATE_LIMITS.get(model_name, FALLBACK_RATE_LIMIT)
+    rpm = get_setting(
+        _model_setting_name("MAGI_RPM", model_name), get_setting("MAGI_RPM", float(default_rpm))
+    )
+    tpm = get_setting(
+        _model_setting_name("MAGI_TPM", model_name), get_setting("MAGI_TPM", float(default_tpm))
+    )
+    return (float(rpm), float(tpm))
+
+
+@lru_cache(maxsize=1)
+def get_rate_limiter() -> RateLimiter:
+    """全セッション・全スレッドで共有するレート制御。"""
+    return RateLimiter(
+        rate_limits_for,
+        max_wait_sec=get_setting("MAGI_RATE_LIMIT_MAX_WAIT_SEC", 60.0),
+    )
+
+
+def max_concurrent_for(model_name: str) -> int:
+    """モデルごとの同時実行数の上限（MAGI_MAX_CONCURRENT_<MODEL>。0 なら制限しない）。"""
+    if not get_setting("MAGI_SCHEDULER_ENABLED", True):
+        return 0
+    return int(
+        get_setting(
+            _model_setting_name("MAGI_MAX_CONCURRENT", model_name), get_setting("MAGI_MAX_CONCURRENT", 4)
+        )
+    )
+
+
+@lru_cache(maxsize=1)
+def get_scheduler() -> FairScheduler:
+    """全セッション・全スレッドで共有する実行枠の順番待ち（優先度＋セッションごとのラウンドロビン）。"""
+    return FairScheduler(max_concurrent_for)
+
+
+def _scheduler_caller() -> tuple:
+    # 呼び出し元が設定していなければ、使用量のセッションを対話の優先度で扱う
+    caller = current_scheduler_caller()
+    if caller is None:
+        return (current_usage_session(), PRIORITY_INTERACTIVE, None)
+    return caller
+
+
+def estimate_request_tokens(contents: List[Any], max_output_tokens: int = 0) -> int:
+    """
+    TPM バケット用の大まかな見積もり（日本語は1文字≒1トークンとして安全側に数える）。
+    画像は1枚 258 トークン、バイナリ（音声など）は 1KB ≒ 32 トークンとみなす。
+    """
+    total = max_output_tokens
+    for part in contents:
+        if isinstance(part, str):
+            total += len(part)
+        elif isinstance(part, Image.Image):
+            total += 258
+        elif isinstance(part, dict) and str(part.get("mime_type", "")).startswith("image/"):
+            total += 258
+        elif isinstance(part, dict) and isinstance(part.get("data"), (bytes, bytearray)):
+            total += len(part["data"]) // 1024 * 32
+    return total
+
+
+class CallDeadlineExceeded(TimeoutError):
+    """呼び出し元が決めた締め切り（deadline）までに呼び出しを終えられなかったことを表す。"""
+
+    def __init__(self, model_name: str):
+        super().__init__(f"client-side deadline exceeded for {model_name}")
+        self.model_name = model_name
+
+
+def _time_left(deadline: Optional[float]) -> float:
+    # deadline は time.monotonic() の値。None なら締め切りなし
+    return float("inf") if deadline is None else deadline - time.monotonic()
+
+
+def generate_content_throttled(
+    model_name: str, model, contents: List[Any], deadline: Optional[float] = None, **kwargs
+):
+    """
+    レート制御を通してから generate_content を呼ぶ。
+    分単位のレートリミットや一時的な混雑（ResourceExhausted）は、API が示す待ち時間を尊重しつつ
+    ジッター付き指数バックオフで再試行する。日次クォータや free tier 0 は即座に例外を返す。
+    stream=True のときは最初の呼び出しだけを制御する（チャンク受信中の失敗は呼び出し側で扱う）。
+    同時実行数は get_scheduler() の実行枠で抑える（stream=True では最初の応答が返るまで枠を使う）。
+    バックオフで待つ間は枠を空けて、他の呼び出しに譲る。
+    ジョブの中で呼ばれたときは、呼び出しの前に取り消し・時間切れを確かめる（JobCancelled）。
+    deadline（time.monotonic() の値）を渡すと、順番待ち・レート待ち・バックオフ・リクエストの
+    タイムアウトをすべて締め切りまでに収め、過ぎたら CallDeadlineExceeded を投げる。
+    ジョブの中ではジョブの制限時間も締め切りとして扱う（長い呼び出しがワーカーを握り続けないように）。
+    """
+    job = current_job()
+    if job is not None and job.deadline:
+        deadline = job.deadline if deadline is None else min(deadline, job.deadline)
+    limiter = get_rate_limiter()
+    scheduler = get_scheduler()
+    max_wait = get_setting("MAGI_SCHEDULER_MAX_WAIT_SEC", 120.0)
+    max_retries = get_setting("MAGI_RETRY_MAX", 3)
+    base = get_setting("MAGI_BACKOFF_BASE_SEC", 1.0)
+    cap = get_setting("MAGI_BACKOFF_CAP_SEC", 30.0)
+    max_tokens = (kwargs.get("generation_config") or {}).get("max_output_tokens", 0)
+    tokens = estimate_request_tokens(contents, max_tokens)
+
+    attempt = 0
+    while True:
+        # バックグラウンドジョブが取り消し・時間切れなら、次の呼び出しをせずに止める
+        check_cancelled()
+        if _time_left(deadline) <= 0:
+            raise CallDeadlineExceeded(model_name)
+        session, priority, on_wait = _scheduler_caller()
+        slot_wait = max_wait
+        if deadline is not None:
+            slot_wait = min(max_wait, _time_left(deadline)) if max_wait > 0 else _time_left(deadline)
+        try:
+            with scheduler.slot(model_name, session, priority, on_wait, slot_wait) as waited:
+                get_metrics().observe("scheduler.wait", waited, model_name)
+                check_cancelled()
+                call_kwargs = kwargs
+                try:
+                    with get_metrics().span("ratelimit.wait", model_name):
+                        if deadline is None:
+                            limiter.acquire(model_name, tokens)
+                        else:
+                            limiter.acquire(
+                                model_name, tokens, min(limiter.max_wait_sec, max(0.0, _time_left(deadline)))
+                            )
+                except RateLimitWaitTooLong as e:
+                    if e.wait_sec <= limiter.max_wait_sec:
+                        # 上限内の待ちでも締め切りには間に合わない
+                        raise CallDeadlineExceeded(model_name) from e
+                    raise ResourceExhausted(str(e)) from e
+                if deadline is not None:
+                    left = _time_left(deadline)
+                    if left <= 0:
+                        raise CallDeadlineExceeded(model_name)
+                    # リクエスト自体のタイムアウトも締め切りまでに縮める
+                    options = dict(kwargs.get("request_options") or {})
+                    options["timeout"] = min(float(options.get("timeout") or left), left)
+                    call_kwargs = dict(kwargs, request_options=options)
+                # 再試行も1回ずつ記録する（stream=True では最初の応答が返るまで）
+                with get_metrics().span("gemini.attempt", model_name):
+                    return model.generate_content(contents, **call_kwargs)
+        except SchedulerWaitTooLong as e:
+            if _time_left(deadline) <= 0:
+                raise CallDeadlineExceeded(model_name) from e
+            raise ResourceExhausted(str(e)) from e
+        except ResourceExhausted as e:
+            if (
+                _is_client_side_throttle(e)
+                or quota_category(str(e)) not in RETRYABLE_CATEGORIES
+                or attempt >= max_retries
+            ):
+                raise
+            delay = backoff_delay(attempt, base, cap, parse_retry_delay(str(e)))
+            if delay >= _time_left(deadline):
+                # 待っても締め切りに間に合わないので、元の例外のまま諦める
+                raise
+            # 同じモデルを使う他の呼び出しもしばらく止める
+            limiter.penalize(model_name, delay)
+            limiter.record_retry(model_name)
+            time.sleep(delay)
+            attempt += 1
+
+
+# ======================================================
+# モデルのフォールバック（枯渇・タイムアウト・空応答のとき下位モデルへ）
+# ======================================================
+DEFAULT_FALLBACK_CHAIN = "gemini-2.5-pro,gemini-2.5-flash,gemini-2.0-flash,gemini-2.5-flash-lite"
+
+# この例外のときは次のモデルで再挑戦する
+FALLBACK_EXCEPTIONS = (ResourceExhausted, DeadlineExceeded, ServiceUnavailable, TimeoutError)
+
+
+@lru_cache(maxsize=1)
+def get_model_health() -> ModelHealthTracker:
+    """モデルごとの直近レイテンシ・エラー率・クールダウン（全セッション共有）。"""
+    return ModelHealthTracker(
+        window_sec=get_setting("MAGI_HEALTH_WINDOW_SEC", 300.0),
+        min_samples=get_setting("MAGI_HEALTH_MIN_SAMPLES", 4),
+        error_rate_threshold=get_setting("MAGI_HEALTH_ERROR_RATE", 0.5),
+        cooldown_sec=get_setting("MAGI_FALLBACK_COOLDOWN_SEC", 60.0),
+        slow_latency_sec=get_setting("MAGI_SLOW_LATENCY_SEC", 0.0),
+    )
+
+
+def fallback_models(model_name: str) -> List[str]:
+    """
+    選択モデル → MAGI_FALLBACK_CHAIN 上の後続モデル の順で、クールダウン中でないものを返す。
+    すべてクールダウン中なら、選択モデルだけを返す。
+    """
+    if not get_setting("MAGI_FALLBACK_ENABLED", True):
+        return [model_name]
+    chain = [m.strip() for m in str(get_setting("MAGI_FALLBACK_CHAIN", DEFAULT_FALLBACK_CHAIN)).split(",")]
+    health = get_model_health()
+    available = [m for m in model_cascade(model_name, chain) if health.is_available(m)]
+    return available or [model_name]
+
+
+def _is_client_side_throttle(e: BaseException) -> bool:
+    return isinstance(e, ResourceExhausted) and isinstance(
+        e.__cause__, (RateLimitWaitTooLong, SchedulerWaitTooLong)
+    )
+
+
+def _fallback_cooldown(e: BaseException) -> Tuple[float, int]:
+    """
+    失敗したモデルを休ませる (秒数, 何回続けて失敗したら休ませるか)。
+    日次クォータ切れはすぐに長く休ませ、分単位の枯渇・混雑は MAGI_FALLBACK_COOLDOWN_AFTER 回続いたら休ませる。
+    タイムアウトは1回では休ませず、直近のエラー率（ModelHealthTracker）の判定に任せる。
+    """
+    if isinstance(e, ResourceExhausted) and quota_category(str(e)) in ("daily", "zero"):
+        return get_setting("MAGI_FALLBACK_DAILY_COOLDOWN_SEC", 1800.0), 1
+    if isinstance(e, (DeadlineExceeded, TimeoutError)):
+        return 0.0, 1
+    return get_setting("MAGI_FALLBACK_COOLDOWN_SEC", 60.0), max(1, get_setting("MAGI_FALLBACK_COOLDOWN_AFTER", 2))
+
+
+def generate_with_fallback(
+    model_name: str,
+    contents: List[Any],
+    meta: Optional[Dict[str, Any]] = None,
+    purpose: str = "magi",
+    deadline: Optional[float] = None,
+    **kwargs,
+):
+    """
+    fallback_models(model_name) の順に generate_content_throttled を試す。
+    ResourceExhausted・タイムアウト・候補なし応答なら次のモデルへ進み、
+    実際に回答したモデル名を meta["model"] に書き込む。最後のモデルの失敗はそのまま返す／投げる。
+    stream=False の応答は、usage_metadata を purpose 付きで使用量台帳に記録する。
+    deadline は generate_content_throttled と同じ。締め切りを過ぎたら次のモデルには進まない。
+    """
+    health = get_model_health()
+    cascade = fallback_models(model_name)
+    # stream=True でも同じ上限をかける（応答が止まったストリームを待ち続けない）
+    kwargs.setdefault("request_options", {"timeout": float(get_setting("MAGI_REQUEST_TIMEOUT_SEC", 120))})
+
+    for index, candidate in enumerate(cascade):
+        is_last = index == len(cascade) - 1
+        t0 = time.perf_counter()
+        try:
+            resp = generate_content_throttled(
+                candidate, get_gemini_model(candidate), contents, deadline=deadline, **kwargs
+            )
+        except CallDeadlineExceeded:
+            # ジョブの制限時間で切れたものは、ジョブの時間切れ（JobCancelled）として返す
+            check_cancelled()
+            raise
+        except FALLBACK_EXCEPTIONS as e:
+            check_cancelled()
+            if _time_left(deadline) <= 0:
+                # 締め切りに合わせて縮めたタイムアウトで切れたものは、モデルの不調として数えない
+                raise CallDeadlineExceeded(candidate) from e
+            # 自プロセス側の待ち行列が長いだけならモデルの不調としては数えない
+            if not _is_client_side_throttle(e):
+                cooldown_sec, min_consecutive = _fallback_cooldown(e)
+                health.record_failure(candidate, time.perf_counter() - t0, cooldown_sec, min_consecutive)
+            if is_last:
+                raise
+            continue
+
+        latency = time.perf_counter() - t0
+        if not kwargs.get("stream") and not getattr(resp, "candidates", None) and not is_last:
+            health.record_failure(candidate, latency)
+            continue
+        health.record_success(candidate, latency)
+        if meta is not None:
+            meta["model"] = candidate
+        if not kwargs.get("stream"):
+            record_usage(candidate, purpose, resp)
+        return resp
+
+
+# ======================================================
+# トークン使用量（usage_metadata の記録・費用の見積もり）
+# ======================================================
+@lru_cache(maxsize=1)
+def get_usage_ledger() -> UsageLedger:
+    """呼び出しごとのトークン使用量（全セッション共有・SQLite に永続化）。"""
+    return UsageLedger(
+        get_setting("MAGI_USAGE_DB_PATH", os.path.join(".magi_cache", "usage.sqlite3")),
+        retention_days=get_setting("MAGI_USAGE_RETENTION_DAYS", 90),
+    )
+
+
+@lru_cache(maxsize=1)
+def get_token_count_cache() -> TokenCountCache:
+    return TokenCountCache(get_setting("MAGI_TOKEN_COUNT_CACHE_MAX_ENTRIES", 1024))
+
+
+def model_prices(model_name: str) -> Tuple[float, float]:
+    """(入力, 出力) の単価 USD / 100万トークン。MAGI_PRICE_IN_<MODEL> / MAGI_PRICE_OUT_<MODEL> で上書きできる。"""
+    price_in, price_out = DEFAULT_PRICES_PER_MTOK.get(model_name, FALLBACK_PRICE_PER_MTOK)
+    return (
+        get_setting(_model_setting_name("MAGI_PRICE_IN", model_name), float(price_in)),
+        get_setting(_model_setting_name("MAGI_PRICE_OUT", model_name), float(price_out)),
+    )
+
+
+def daily_token_budget(model_name: str) -> int:
+    """1日あたりのトークン予算（0 なら無制限）。MAGI_DAILY_TOKEN_BUDGET[_<MODEL>] で指定する。"""
+    return get_setting(
+        _model_setting_name("MAGI_DAILY_TOKEN_BUDGET", model_name),
+        get_setting("MAGI_DAILY_TOKEN_BUDGET", 0),
+    )
+
+
+def record_usage(model_name: str, purpose: str, resp) -> Optional[Dict[str, Any]]:
+    if not get_setting("MAGI_USAGE_TRACKING_ENABLED", True):
+        return None
+    prompt_tokens, output_tokens = usage_from_response(resp)
+    if not prompt_tokens and not output_tokens:
+        return None
+    try:
+        return get_usage_ledger().record(
+            model_name,
+            purpose,
+            prompt_tokens,
+            output_tokens,
+            estimate_cost(prompt_tokens, output_tokens, model_prices(model_name)),
+            current_usage_session(),
+        )
+    except sqlite3.Error:
+        # 記録に失敗しても分析自体は止めない
+        return None
+
+
+def count_prompt_tokens(model_name: str, contents: List[Any]) -> Tuple[int, str]:
+    """
+    入力トークン数と、その出どころ（"count_tokens" / "estimate"）を返す。
+    count_tokens の結果は入力内容のハッシュごとにキャッシュし、使えないときは概算に切り替える。
+    """
+    key = request_key(model_name, contents)
+    cache = get_token_count_cache()
+    cached = cache.get(key)
+    if cached is not None:
+        return cached, "count_tokens"
+    if get_setting("MAGI_PREFLIGHT_COUNT_TOKENS", True):
+        counter = getattr(get_gemini_model(model_name), "count_tokens", None)
+        if counter is not None:
+            try:
+                with get_metrics().span("preflight.count_tokens", model_name):
+                    total = int(counter(contents).total_tokens)
+                cache.put(key, total)
+                return total, "count_tokens"
+            except Exception:
+                pass
+    return estimate_request_tokens(contents), "estimate"
+
+
+# ======================================================
+# ユーティリティ
+# ======================================================
+def clean_text_for_display(text: str) -> str:
+    if not text:
+        return ""
+    return text.replace("*", "・")
+
+
+def trim_text(s: str, max_chars: int = 600) -> str:
+    if not s:
+        return ""
+    if len(s) <= max_chars:
+        return s
+    return s[:max_chars] + "\n…（長文のためここで省略）"
+
+
+def classify_resource_exhausted(e: ResourceExhausted) -> str:
+    """
+    ResourceExhausted のメッセージから、
+    - レートリミット（短時間の叩きすぎ）
+    - 日次／総量クォータ
+    - free tier が 0
+    - その他
+    を日本語で推定。
+    """
+    category = quota_category(str(e))
+
+    if category == "zero":
+        return (
+            "カテゴリ推定：free tier クォータが 0\n"
+            "・このプロジェクトの free_tier が 0 に設定されているか、既に使い切っています。\n"
+            "・AI Studio / Cloud Console の Quotas 画面で、対象モデルの free_tier が 0 かどうか確認してください。\n"
+            "・継続利用する場合は、課金の有効化または別プロジェクト／別APIキーの利用を検討してください。"
+        )
+
+    if category == "rate":
+        return (
+            "カテゴリ推定：レートリミット（短時間の叩きすぎ）\n"
+            "・短時間に大量のリクエストを送信している可能性があります。\n"
+            "・ボタンの連打を避け、実行間隔をあけてください。\n"
+            "・1回の実行での呼び出し回数や入力サイズを減らすことも有効です。"
+        )
+
+    if category == "daily":
+        return (
+            "カテゴリ推定：日次／総量クォータ上限\n"
+            "・1日あたり、またはプロジェクト全体の利用上限（無料枠・課金枠）に達している可能性があります。\n"
+            "・AI Studio / Cloud Console の Usage / Quota 画面で、対象モデルの PerDay / PerProject の値を確認してください。"
+        )
+
+    if category == "transient":
+        return (
+            "カテゴリ推定：リソース逼迫（モデル側の一時的混雑など）\n"
+            "・アクセス集中などで一時的にリソースが不足している可能性があります。\n"
+            "・しばらく待ってから再実行してみてください。"
+        )
+
+    return (
+        "カテゴリ推定：その他の ResourceExhausted\n"
+        "・詳細は下記の『生メッセージ』を参照してください。"
+    )
+
+
+# ======================================================
+# 画像の前処理（向き補正・縮小・再エンコード、アップロードごとにキャッシュ）
+# ======================================================
+# 用途ごとの既定値（長辺 px, 形式, 品質）。MAGI_IMAGE_<MODEL|REPORT>_MAX_EDGE / _FORMAT / _QUALITY で変更できる
+IMAGE_PROFILE_DEFAULTS = {
+    # Gemini は 768px 単位のタイルで読むので、それ以上送っても精度はほとんど上がらない
+    "model": (1536, "JPEG", 85),
+    # レポートでは幅 3 インチで貼るので、約 300dpi ぶんあれば十分
+    "report": (1000, "JPEG", 80),
+}
+
+
+def image_profile(kind: str) -> ImageProfile:
+    max_edge, fmt, quality = IMAGE_PROFILE_DEFAULTS[kind]
+    prefix = f"MAGI_IMAGE_{kind.upper()}"
+    fmt = str(get_setting(f"{prefix}_FORMAT", fmt)).upper()
+    if kind == "report" and fmt not in DOCX_IMAGE_FORMATS:
+        fmt = "JPEG"
+    return ImageProfile(
+        max_edge=get_setting(f"{prefix}_MAX_EDGE", max_edge),
+        fmt=fmt,
+        quality=get_setting(f"{prefix}_QUALITY", quality),
+    )
+
+
+@lru_cache(maxsize=1)
+def get_image_cache() -> EncodedImageCache:
+    return EncodedImageCache(max_bytes=get_setting("MAGI_IMAGE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+
+def prepare_image_cached(data: bytes, kind: str = "model") -> EncodedImage:
+    """
+    アップロードされた画像バイト列を、用途（"model" / "report"）のプロファイルでエンコードする。
+    読み込めない画像なら PIL の例外をそのまま投げる。
+    """
+    with get_metrics().span(f"image.prepare.{kind}"):
+        return get_image_cache().get_or_prepare(data, image_profile(kind))
+
+
+# ======================================================
+# 媒体のテキスト化（画像・音声）
+# ======================================================
+# プロンプトを変えたら MEDIA_PROMPT_VERSION を上げて、古いキャッシュを無効化する
+MEDIA_PROMPT_VERSION = "v1"
+
+IMAGE_DESCRIBE_PROMPT = (
+    "この画像に何が写っているか、日本語で簡潔に2〜3文で説明してください。\n"
+    "心理的な印象も1文で添えてください。"
+)
+
+AUDIO_TRANSCRIBE_PROMPT = (
+    "この音声の内容を日本語でできるだけ正確に文字起こししてください。\n"
+    "出力は通常の日本語文のみで書いてください。"
+)
+
+
+@lru_cache(maxsize=1)
+def get_media_cache() -> MediaDerivationCache:
+    """
+    画像説明・音声文字起こしの結果を、全セッション共有の LRU キャッシュに保持する。
+    同じファイルを再アップロード／再実行しても Gemini を呼ばない。
+    """
+    return MediaDerivationCache(
+        max_entries=get_setting("MAGI_MEDIA_CACHE_MAX_ENTRIES", 256),
+        max_chars=get_setting("MAGI_MEDIA_CACHE_MAX_CHARS", 2_000_000),
+    )
+
+
+@lru_cache(maxsize=1)
+def get_single_flight() -> SingleFlight:
+    """
+    同じ内容の Gemini 呼び出し（MAGI 分析・画像説明・文字起こし・チャンク要約）が
+    セッションをまたいで同時に来たとき、1回の呼び出しにまとめて結果を共有する。
+    """
+    # 相乗り元のジョブが取り消されても、待っていた側は自分で呼び出し直す
+    return SingleFlight(
+        wait_timeout=get_setting("MAGI_SINGLE_FLIGHT_WAIT_SEC", 300), local_errors=(JobCancelled,)
+    )
+
+
+def _single_flight() -> Optional[SingleFlight]:
+    return get_single_flight() if get_setting("MAGI_SINGLE_FLIGHT_ENABLED", True) else None
+
+
+@lru_cache(maxsize=1)
+def get_audio_cache() -> NormalizedAudioCache:
+    return NormalizedAudioCache(max_bytes=get_setting("MAGI_AUDIO_CACHE_MAX_BYTES", 128 * 1024 * 1024))
+
+
+def prepare_audio_cached(data: bytes, mime_type: str) -> NormalizedAudio:
+    """
+    文字起こし前の正規化（MAGI_AUDIO_NORMALIZE）。モノラル化・MAGI_AUDIO_SAMPLE_RATE への変換・
+    前後の無音の除去（MAGI_AUDIO_TRIM_SILENCE）をして 16bit PCM の WAV にする。
+    結果はアップロード内容のハッシュごとにキャッシュする。WAV 以外は元のまま返す。
+    """
+    mime_type = mime_type or "audio/wav"
+    if not get_setting("MAGI_AUDIO_NORMALIZE", True):
+        return passthrough_audio(data, mime_type)
+    target_rate = get_setting("MAGI_AUDIO_SAMPLE_RATE", 16000)
+    trim = get_setting("MAGI_AUDIO_TRIM_SILENCE", True)
+    silence_db = float(get_setting("MAGI_AUDIO_SILENCE_DB", -40.0))
+    cache = get_audio_cache()
+    key = cache.key(data, f"{target_rate}-{int(trim)}-{silence_db:g}")
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+    with get_metrics().span("audio.normalize"):
+        value = normalize_wav(data, mime_type, target_rate, trim, silence_db)
+    cache.put(key, value)
+    return value
+
+
+def describe_image_with_gemini(
+    img: Union[Image.Image, Dict[str, Any]], model_name: str = DEFAULT_MODEL_NAME
+) -> str:
+    """img は PIL 画像か、{"mime_type", "data"} のエンコード済み画像。"""
+    prompt = IMAGE_DESCRIBE_PROMPT
+    try:
+        resp = generate_with_fallback(model_name, [prompt, img], purpose="media.describe_image")
+        return clean_text_for_display((resp.text or "").strip())
+    except ResourceExhausted as e:
+        detail = classify_resource_exhausted(e)
+        return (
+            "【エラー】画像解析中に Gemini のリソース上限エラーが発生しました。\n"
+            f"生メッセージ：{str(e)}\n\n{detail}"
+        )
+    except Exception as e:
+        return f"【エラー】画像解析に失敗しました: {str(e)}"
+
+
+def transcribe_audio_with_gemini(
+    audio_bytes: bytes, mime_type: str, model_name: str = DEFAULT_MODEL_NAME
+) -> str:
+    mime_type = mime_type or "audio/wav"
+
+    prompt = AUDIO_TRANSCRIBE_PROMPT
+    try:
+        resp = generate_with_fallback(
+            model_name,
+            [prompt, {"mime_type": mime_type, "data": audio_bytes}],
+            purpose="media.transcribe_audio",
+        )
+        return clean_text_for_display((resp.text or "").strip())
+    except ResourceExhausted as e:
+        detail = classify_resource_exhausted(e)
+        return (
+            "【エラー】音声解析中に Gemini のリソース上限エラーが発生しました。\n"
+            f"生メッセージ：{str(e)}\n\n{detail}"
+        )
+    except Exception as e:
+        return f"【エラー】音声解析に失敗しました: {str(e)}"
+
+
+def describe_image_cached(
+    data: bytes, mime_type: str, model_name: str = DEFAULT_MODEL_NAME
+) -> str:
+    """
+    元のアップロードバイト列 data をキーに、画像説明を媒体キャッシュ経由で取得する。
+    Gemini には原寸ではなく、送信用プロファイルで縮小・再エンコードした画像を送る。
+    """
+    profile = image_profile("model")
+    key = media_cache_key(
+        data, mime_type, model_name, f"{MEDIA_PROMPT_VERSION}|{profile.signature}"
+    )
+    with get_metrics().span("media.describe_image", model_name) as span:
+        text = get_media_cache().get_or_compute(
+            key,
+            lambda: describe_image_with_gemini(
+                prepare_image_cached(data, "model").as_blob(), model_name
+            ),
+            single_flight=_single_flight(),
+            group="media.describe_image",
+        )
+        if is_error_text(text):
+            span["status"] = "error"
+    return text
+
+
+def transcribe_audio_cached(
+    audio_bytes: bytes, mime_type: str, model_name: str = DEFAULT_MODEL_NAME
+) -> str:
+    mime_type = mime_type or "audio/wav"
+    key = media_cache_key(audio_bytes, mime_type, model_name, MEDIA_PROMPT_VERSION)
+    with get_metrics().span("media.transcribe_audio", model_name) as span:
+        text = get_media_cache().get_or_compute(
+            key,
+            lambda: transcribe_audio_with_gemini(audio_bytes, mime_type, model_name),
+            single_flight=_single_flight(),
+            group="media.transcribe_audio",
+        )
+        if is_error_text(text):
+            span["status"] = "error"
+    return text
+
+
+AUDIO_SEGMENT_FAILED_TEXT = "（この区間の文字起こしに失敗しました）"
+
+
+def transcribe_audio_segmented(
+    audio_bytes: bytes,
+    mime_type: str,
+    model_name: str = DEFAULT_MODEL_NAME,
+    on_progress: Optional[Callable[[int, int, AudioSegment, bool], None]] = None,
+    meta: Optional[Dict[str, Any]] = None,
+) -> str:
+    """
+    長い WAV を無音の位置で約 MAGI_AUDIO_SEGMENT_SEC 秒ごとの区間に分けて並列に文字起こしし、
+    「[開始–終了] 本文」の形で元の順に連結する。
+    区間ごとの結果は媒体キャッシュに入るので、失敗した区間だけをその場で再試行
+    （MAGI_AUDIO_SEGMENT_RETRIES 回）でき、再実行しても成功済みの区間は呼び直さない。
+    WAV 以外・分ける必要の無い短さ・MAGI_AUDIO_SEGMENT_ENABLED=False なら transcribe_audio_cached と同じ。
+    on_progress(完了数, 区間数, 区間, 成功したか) は呼び出し元のスレッドで呼ぶ（Streamlit の描画用）。
+    meta には区間数（segments）と失敗した区間数（failed_segments）を書き込む。
+    """
+    mime_type = mime_type or "audio/wav"
+    target_sec = float(get_setting("MAGI_AUDIO_SEGMENT_SEC", 90))
+    segments: List[AudioSegment] = []
+    if get_setting("MAGI_AUDIO_SEGMENT_ENABLED", True):
+        with get_metrics().span("media.split_audio"):
+            segments = split_wav(
+                audio_bytes,
+                target_sec=target_sec,
+                silence_db=float(get_setting("MAGI_AUDIO_SILENCE_DB", -40.0)),
+            )
+    if len(segments) <= 1:
+        return transcribe_audio_cached(audio_bytes, mime_type, model_name)
+
+    key = media_cache_key(
+        audio_bytes, mime_type, model_name, f"{MEDIA_PROMPT_VERSION}|segmented-{target_sec:g}"
+    )
+    cached = get_media_cache().get(key)
+    if cached is not None:
+        if meta is not None:
+            meta.update(segments=len(segments), failed_segments=0)
+        return cached
+
+    retries = max(0, get_setting("MAGI_AUDIO_SEGMENT_RETRIES", 2))
+
+    def _transcribe(segment: AudioSegment) -> str:
+        text = ""
+        for attempt in range(retries + 1):
+            text = transcribe_audio_cached(segment.data, segment.mime_type, model_name)
+            if not is_error_text(text):
+                break
+            if attempt < retries:
+                time.sleep(backoff_delay(attempt))
+        return text
+
+    texts: List[str] = [""] * len(segments)
+    max_workers = max(1, get_setting("MAGI_AUDIO_SEGMENT_MAX_WORKERS", 4))
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="magi-audio") as executor:
+        # 計測中のスパン一覧や使用量セッションをワーカースレッドにも引き継ぐ
+        futures = {
+            executor.submit(contextvars.copy_context().run, _transcribe, segment): segment
+            for segment in segments
+        }
+        for done, fut in enumerate(as_completed(futures), start=1):
+            segment = futures[fut]
+            texts[segment.index] = fut.result()
+            if on_progress is not None:
+                on_progress(done, len(segments), segment, not is_error_text(texts[segment.index]))
+
+    failed = [i for i, text in enumerate(texts) if is_error_text(text)]
+    if meta is not None:
+        meta.update(segments=len(segments), failed_segments=len(failed))
+    if len(failed) == len(segments):
+        return texts[0]
+    stitched = stitch_transcripts(
+        segments, [AUDIO_SEGMENT_FAILED_TEXT if i in failed else text for i, text in enumerate(texts)]
+    )
+    # 一部の区間が失敗した結果はキャッシュしない（次の実行で失敗した区間だけ呼び直す）
+    if not failed:
+        get_media_cache().put(key, stitched)
+    return stitched
+
+
+# ======================================================
+# 長文入力の要約（map-reduce）
+# ======================================================
+# プロンプトを変えたら SUMMARY_PROMPT_VERSION を上げて、古い要約キャッシュを無効化する
+SUMMARY_PROMPT_VERSION = "v1"
+
+SUMMARY_PROMPT = (
+    "次の文章は、長い{label}の一部です。後で意思決定の分析に使うので、"
+    "事実・数値・固有名詞・主張と根拠を落とさずに、日本語で約{target}文字に要約してください。\n"
+    "出力は要約本文のみとし、前置きや箇条書きは使わないでください。"
+)
+
+CONTEXT_FIELD_LABELS = {
+    "user_question": "質問",
+    "text_input": "テキスト入力",
+    "audio_transcript": "音声文字起こし",
+    "image_description": "画像説明",
+}
+TEXT_FILE_LABEL = "添付テキストファイル"
+TEXT_FILE_HEADER = "\n\n[ファイル内容]\n"
+
+
+def estimate_text_tokens(text: str) -> int:
+    return estimate_request_tokens([text])
+
+
+@lru_cache(maxsize=1)
+def get_summary_cache() -> MediaDerivationCache:
+    """
+    チャンク要約の結果を、チャンク本文のハッシュごとに保持する（全セッション共有）。
+    質問だけを変えて再実行しても、同じ文書を要約し直さない。
+    """
+    return MediaDerivationCache(
+        max_entries=get_setting("MAGI_SUMMARY_CACHE_MAX_ENTRIES", 1024),
+        max_chars=get_setting("MAGI_SUMMARY_CACHE_MAX_CHARS", 4_000_000),
+    )
+
+
+def summarize_chunk_cached(
+    chunk: str, target_tokens: int, label: str, model_name: str = DEFAULT_MODEL_NAME
+) -> Optional[str]:
+    """1チャンクを約 target_tokens に要約する。失敗したら None（キャッシュしない）。"""
+    key = media_cache_key(
+        chunk.encode("utf-8"),
+        f"text/plain;target={target_tokens}",
+        model_name,
+        f"{SUMMARY_PROMPT_VERSION}|{label}",
+    )
+
+    def _summarize() -> str:
+        try:
+            resp = generate_with_fallback(
+                model_name,
+                [SUMMARY_PROMPT.format(label=label, target=target_tokens), chunk],
+                purpose="summarize.chunk",
+                # 日本語は1文字≒1トークンで見積もっているので、目標の倍を上限にする
+                generation_config={"max_output_tokens": max(64, target_tokens * 2)},
+            )
+            text = (resp.text or "").strip()
+        except JobCancelled:
+            raise
+        except Exception as e:
+            return f"【エラー】要約に失敗しました: {str(e)}"
+        return text or "【エラー】要約が空でした。"
+
+    with get_metrics().span("summarize.chunk", model_name) as span:
+        text = get_summary_cache().get_or_compute(
+            key, _summarize, single_flight=_single_flight(), group="summarize.chunk"
+        )
+        if is_error_text(text):
+            span["status"] = "error"
+            return None
+    return text
+
+
+@lru_cache(maxsize=1)
+def get_text_spool() -> TextSpool:
+    """
+    .txt アップロードの取り込み先（一時ファイル、全セッション共有）。
+    本文は session_state やメモリには置かず、必要な部分だけをファイルから読む。
+    """
+    return TextSpool(
+        max_bytes=get_setting("MAGI_TEXT_UPLOAD_MAX_BYTES", 20 * 1024 * 1024),
+        max_files=get_setting("MAGI_TEXT_SPOOL_MAX_FILES", 32),
+        directory=get_setting("MAGI_TEXT_SPOOL_DIR", ""),
+    )
+
+
+def ingest_text_upload(stream: Any) -> IngestedText:
+    """アップロードされたテキスト（シーク可能なバイナリ）を、文字コードを判定して取り込む。"""
+    with get_metrics().span("ingest.text"):
+        return get_text_spool().ingest(stream)
+
+
+def long_input_budget_tokens() -> int:
+    """長文入力モードで、4つの入力欄の合計に許すトークン数。"""
+    return max(200, get_setting("MAGI_LONG_INPUT_BUDGET_TOKENS", 2000))
+
+
+def condense_context(
+    context: Dict[str, Any],
+    model_name: str = DEFAULT_MODEL_NAME,
+    meta: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """
+    context["long_input"] が真なら、予算（MAGI_LONG_INPUT_BUDGET_TOKENS）を超える入力欄を
+    map-reduce で要約した新しい context を返す（偽ならそのまま返す）。
+    添付テキストファイル（context["text_file"]）は一時ファイルから少しずつ読んで要約し、
+    テキスト入力の後ろに連結する。
+    予算内の欄は変更しないので、要約済みの context に再度かけても何もしない。
+    meta には欄ごとの要約統計を "long_input" として書き込む。
+    """
+    if not context.get("long_input"):
+        return context
+    text_file: Optional[IngestedText] = context.get("text_file")
+    sizes = {
+        name: estimate_text_tokens(context.get(name, "") or "") for name in CONTEXT_FIELD_LABELS
+    }
+    if text_file is not None:
+        # 日本語は1文字≒1トークンとして数える（estimate_request_tokens と同じ）
+        sizes["text_file"] = text_file.chars
+    budgets = allocate_budgets(sizes, long_input_budget_tokens())
+    options = {
+        "chunk_tokens": get_setting("MAGI_SUMMARY_CHUNK_TOKENS", 4000),
+        "max_workers": get_setting("MAGI_SUMMARY_MAX_WORKERS", 4),
+        "max_levels": get_setting("MAGI_SUMMARY_MAX_LEVELS", 3),
+    }
+
+    def _summarizer(label: str) -> Callable[[str, int], Optional[str]]:
+        return lambda chunk, target: summarize_chunk_cached(chunk, target, label, model_name)
+
+    condensed = dict(context)
+    field_stats: Dict[str, Dict[str, Any]] = {}
+    for name, label in CONTEXT_FIELD_LABELS.items():
+        if sizes[name] <= budgets[name]:
+            continue
+        with get_metrics().span("summarize.field", model_name):
+            condensed[name], field_stats[name] = map_reduce_summarize(
+                context[name], budgets[name], _summarizer(label), estimate_text_tokens, **options
+            )
+        field_stats[name]["label"] = label
+
+    if text_file is not None:
+        if sizes["text_file"] <= budgets["text_file"]:
+            body = text_file.head(text_file.chars)
+        else:
+            with get_metrics().span("summarize.field", model_name):
+                body, field_stats["text_file"] = summarize_chunk_stream(
+                    iter_chunks_from_blocks(
+                        text_file.iter_blocks(), options["chunk_tokens"], estimate_text_tokens
+                    ),
+                    text_file.chars,
+                    budgets["text_file"],
+                    _summarizer(TEXT_FILE_LABEL),
+                    estimate_text_tokens,
+                    **options,
+                )
+            field_stats["text_file"]["label"] = TEXT_FILE_LABEL
+        condensed["text_input"] = (condensed.get("text_input") or "") + TEXT_FILE_HEADER + body
+        del condensed["text_file"]
+
+    if meta is not None and field_stats:
+        meta["long_input"] = field_stats
+    return condensed
+
+
+# ======================================================
+# MAGI テキスト生成（SWOT ON/OFF・リミット診断付き）
+# ======================================================
+# プロンプトや出力上限を変えたら MAGI_PROMPT_VERSION を上げて、結果キャッシュを無効化する
+MAGI_PROMPT_VERSION = "v1"
+MAX_TOKENS_SWOT = 640
+MAX_TOKENS_BASIC = 480
+
+# --- SWOTあり版プロンプト ---
+SYS_PROMPT_SWOT = """
+あなたは NERV の MAGI システム全体を模した統合AIです。
+Magi-Logic / Magi-Human / Magi-Reality / Magi-Media の4視点と、統合MAGIとしての結論、
+さらに意思決定に役立つSWOT分析を、以下のフォーマットだけを使って日本語で出力してください。
+
+[重要：出力フォーマット（この通りに出力すること）]
+
+【Magi-Logic】
+判定: 可決 または 保留 または 否決 のいずれか
+要約: 2〜3文、合計120文字以内
+
+【Magi-Human】
+判定: 可決 または 保留 または 否決 のいずれか
+要約: 2〜3文、合計120文字以内
+
+【Magi-Reality】
+判定: 可決 または 保留 または 否決 のいずれか
+要約: 2〜3文、合計120文字以内
+
+【Magi-Media】
+判定: 可決 または 保留 または 否決 のいずれか
+要約: 2〜3文、合計120文字以内
+
+【MAGI-統合サマリー】
+全体としての結論を150文字以内でまとめる
+
+【MAGI-統合詳細】
+統合的な視点から、2〜4段落・合計500文字以内で詳細なコメントと推奨アクションを書く
+
+【SWOT分析】
+Strengths: 強みを5〜7個、日本語で列挙し、読点「、」で区切って1行で書く（合計300文字以内）
+Weaknesses: 弱みを5〜7個、日本語で列挙し、読点「、」で区切って1行で書く（合計300文字以内）
+Opportunities: 機会を5〜7個、日本語で列挙し、読点「、」で区切って1行で書く（合計300文字以内）
+Threats: 脅威を5〜7個、日本語で列挙し、読点「、」で区切って1行で書く（合計300文字以内）
+
+[制約]
+- 箇条書き（・や番号付きリスト）は使わない。
+- 上記の見出し・ラベル以外の文言や飾りは追加しない。
+- 「Strengths:」「Weaknesses:」「Opportunities:」「Threats:」は英語ラベルをそのまま使う。
+- 暴力・自傷・違法行為などの過激な表現は避け、穏当で一般的な表現に言い換える。
+- 出力は必ずこのフォーマットに沿ったプレーンテキストのみとする。
+"""
+
+# --- SWOTなし（軽量版）プロンプト ---
+SYS_PROMPT_BASIC = """
+あなたは NERV の MAGI システム全体を模した統合AIです。
+Magi-Logic / Magi-Human / Magi-Reality / Magi-Media の4視点と、統合MAGIとしての結論を、
+以下のフォーマットだけを使って日本語で出力してください。
+
+[重要：出力フォーマット（この通りに出力すること）]
+
+【Magi-Logic】
+判定: 可決 または 保留 または 否決 のいずれか
+要約: 2〜3文、合計120文字以内
+
+【Magi-Human】
+判定: 可決 または 保留 または 否決 のいずれか
+要約: 2〜3文、合計120文字以内
+
+【Magi-Reality】
+判定: 可決 または 保留 または 否決 のいずれか
+要約: 2〜3文、合計120文字以内
+
+【Magi-Media】
+判定: 可決 または 保留 または 否決 のいずれか
+要約: 2〜3文、合計120文字以内
+
+【MAGI-統合サマリー】
+全体としての結論を150文字以内でまとめる
+
+【MAGI-統合詳細】
+統合的な視点から、2〜3段落・合計400文字以内で詳細なコメントと推奨アクションを書く
+
+[制約]
+- 箇条書き（・や番号付きリスト）は使わない。
+- 上記の見出し・ラベル以外の文言や飾りは追加しない。
+- 出力は必ずこのフォーマットに沿ったプレーンテキストのみとする。
+"""
+
+
+@lru_cache(maxsize=1)
+def get_result_cache() -> ResultCache:
+    """
+    call_magi_plain の結果を SQLite に保存する永続キャッシュ（全セッション共有）。
+    同じ質問・コンテキスト・モデル・SWOT設定なら Gemini を呼ばずに即座に返す。
+    """
+    return ResultCache(
+        path=get_setting("MAGI_RESULT_CACHE_PATH", os.path.join(".magi_cache", "results.sqlite3")),
+        ttl_sec=get_setting("MAGI_RESULT_CACHE_TTL_SEC", 24 * 3600),
+        max_bytes=get_setting("MAGI_RESULT_CACHE_MAX_BYTES", 64 * 1024 * 1024),
+    )
+
+
+def magi_result_cache_key(
+    model_name: str, ctx_text: str, enable_swot: bool, mode: str = "single"
+) -> str:
+    return result_cache_key(
+        model=model_name,
+        prompt_version=MAGI_PROMPT_VERSION,
+        context=normalize_context_text(ctx_text),
+        enable_swot=enable_swot,
+        max_output_tokens=MAX_TOKENS_SWOT if enable_swot else MAX_TOKENS_BASIC,
+        mode=mode,
+    )
+
+
+@lru_cache(maxsize=1)
+def get_mode_latency_samples() -> Dict[str, Any]:
+    """
+    実行モード（single / fanout）ごとの直近の所要時間（秒）。全セッション共有。
+    キャッシュヒット時は記録しない（実際に Gemini を呼んだ回だけ）。
+    """
+    return {"lock": threading.Lock(), "samples": {}}
+
+
+def record_mode_latency(mode: str, seconds: float) -> None:
+    store = get_mode_latency_samples()
+    with store["lock"]:
+        store["samples"].setdefault(mode, deque(maxlen=50)).append(seconds)
+
+
+def mode_latency_summary() -> Dict[str, tuple[float, int]]:
+    """モードごとの (平均秒, 件数) を返す。"""
+    store = get_mode_latency_samples()
+    with store["lock"]:
+        return {
+            mode: (sum(values) / len(values), len(values))
+            for mode, values in store["samples"].items()
+            if values
+        }
+
+
+def build_magi_ctx_text(context: Dict[str, Any]) -> str:
+    """
+    ユーザー入力（質問・補足テキスト・音声文字起こし・画像説明）を
+    MAGI プロンプトに渡すテキストへ整形する。
+    各欄は 600 文字で切る。長文入力モード（context["long_input"]）では condense_context で
+    要約済みの前提で、予算ぶんまでそのまま通す。
+    """
+    max_chars = long_input_budget_tokens() if context.get("long_input") else 600
+    fields = {name: context.get(name, "") or "" for name in CONTEXT_FIELD_LABELS}
+    if context.get("text_file") is not None:
+        # 添付テキストファイルは、切り詰め後に残るぶんだけをファイルから読む
+        fields["text_input"] += TEXT_FILE_HEADER + context["text_file"].head(max_chars + 1)
+    trimmed_context = {name: trim_text(value, max_chars) for name, value in fields.items()}
+
+    return (
+        "【ユーザーからの情報】\n"
+        + f"質問: {trimmed_context['user_question']}\n"
+        + (
+            f"テキスト入力: {trimmed_context['text_input']}\n"
+            if trimmed_context["text_input"]
+            else ""
+        )
+        + (
+            f"音声文字起こし: {trimmed_context['audio_transcript']}\n"
+            if trimmed_context["audio_transcript"]
+            else ""
+        )
+        + (
+            f"画像説明: {trimmed_context['image_description']}\n"
+            if trimmed_context["image_description"]
+            else ""
+        )
+    )
+
+
+def _preflight_ctx(ctx_text: str, enable_swot: bool, model_name: str) -> Dict[str, Any]:
+    sys_prompt = SYS_PROMPT_SWOT if enable_swot else SYS_PROMPT_BASIC
+    max_tokens = MAX_TOKENS_SWOT if enable_swot else MAX_TOKENS_BASIC
+    prompt_tokens, source = count_prompt_tokens(model_name, [sys_prompt, ctx_text])
+    total = prompt_tokens + max_tokens
+    warnings: List[str] = []
+    suggest_no_swot = False
+
+    _, tpm = rate_limits_for(model_name)
+    if tpm and total > tpm:
+        warnings.append(
+            f"1回の呼び出しで約 {total:,} トークンを使う見込みで、{model_name} の1分あたりの上限"
+            f"（{tpm:,.0f}）を超えています。入力を短くしてください。"
+        )
+
+    budget = daily_token_budget(model_name)
+    if budget:
+        used = get_usage_ledger().today().get(model_name, {})
+        used_tokens = used.get("prompt_tokens", 0) + used.get("output_tokens", 0)
+        if used_tokens + total > budget:
+            warnings.append(
+                f"本日の {model_name} のトークン予算（{budget:,}）を超える見込みです"
+                f"（使用済み {used_tokens:,} ＋ 今回 約 {total:,}）。"
+            )
+            if enable_swot and used_tokens + prompt_tokens + MAX_TOKENS_BASIC <= budget:
+                suggest_no_swot = True
+
+    if prompt_tokens > get_setting("MAGI_PREFLIGHT_PROMPT_WARN_TOKENS", 3000):
+        warnings.append(
+            f"入力が長いため（約 {prompt_tokens:,} トークン）、出力上限（MAX_TOKENS）で"
+            "回答が途中で切れる可能性があります。"
+        )
+        if enable_swot:
+            suggest_no_swot = True
+
+    return {
+        "prompt_tokens": prompt_tokens,
+        "max_output_tokens": max_tokens,
+        "total_tokens": total,
+        "source": source,
+        "estimated_cost_usd": estimate_cost(prompt_tokens, max_tokens, model_prices(model_name)),
+        "warnings": warnings,
+        "suggest_no_swot": suggest_no_swot,
+    }
+
+
+def preflight_magi(
+    context: Dict[str, Any], enable_swot: bool, model_name: str = DEFAULT_MODEL_NAME
+) -> Dict[str, Any]:
+    """
+    呼び出し前に、組み立てたプロンプトの入力トークン数（count_tokens、キャッシュ付き）と
+    出力上限から使用量を見積もり、1分あたりの上限・1日の予算・MAX_TOKENS の危険を警告する。
+    suggest_no_swot=True なら、SWOT なしの軽量プロンプトに切り替えるのが安全。
+    """
+    return _preflight_ctx(
+        build_magi_ctx_text(condense_context(context, model_name)), enable_swot, model_name
+    )
+
+
+def _preflight_use_swot(
+    ctx_text: str, enable_swot: bool, model_name: str, meta: Optional[Dict[str, Any]]
+) -> bool:
+    # MAGI_PREFLIGHT_ADAPT=True なら、危ないと分かっている SWOT ありの呼び出しを最初から省く
+    if not enable_swot or not get_setting("MAGI_PREFLIGHT_ADAPT", True):
+        return enable_swot
+    preflight = _preflight_ctx(ctx_text, enable_swot, model_name)
+    if meta is not None:
+        meta["preflight"] = preflight
+    return not preflight["suggest_no_swot"]
+
+
+def call_magi_plain(
+    context: Dict[str, Any],
+    enable_swot: bool,
+    model_name: str = DEFAULT_MODEL_NAME,
+    meta: Optional[Dict[str, Any]] = None,
+    refresh: bool = False,
+) -> str | None:
+    """
+    1回の generate_content で、Magi-Logic/Human/Reality/Media と統合出力を返す。
+    enable_swot=True のときだけ SWOT 分析指示を追加し、
+    リソース上限や MAX_TOKENS などを詳細にエラーハンドリング。
+    meta を渡すと、実際に回答したモデル名（model）・キャッシュ利用有無（cached）・
+    実際に使ったプロンプトが SWOT ありかどうか（used_swot）を書き込む。
+    refresh=True なら保存済みの結果を使わずに呼び出し直す（結果は上書き保存する）。
+    結果は実際に使ったプロンプトのキーで保存する（SWOT なしに縮退した回答を SWOT ありのキーに入れない）。
+    """
+    ctx_text = build_magi_ctx_text(condense_context(context, model_name, meta))
+    answered: Dict[str, Any] = {}
+
+    def _call_internal(use_swot: bool, attempt: int) -> str | None:
+        sys_prompt = SYS_PROMPT_SWOT if use_swot else SYS_PROMPT_BASIC
+        max_tokens = MAX_TOKENS_SWOT if use_swot else MAX_TOKENS_BASIC
+        answered["used_swot"] = use_swot
+
+        try:
+            resp = generate_with_fallback(
+                model_name,
+                [sys_prompt, ctx_text],
+                meta=answered,
+                purpose="magi.single",
+                generation_config={"max_output_tokens": max_tokens},
+            )
+
+            if not getattr(resp, "candidates", None):
+                if attempt == 1 and use_swot:
+                    # SWOTありで失敗した場合は、1回だけSWOTなし軽量モードで再試行
+                    return _call_internal(False, 2)
+                return None
+
+            first = resp.candidates[0]
+            content = getattr(first, "content", None)
+            parts = getattr(content, "parts", None)
+
+            if not content or not parts:
+                # finish_reason から原因を推定
+                reason = getattr(first, "finish_reason", None)
+                reason_str = str(reason).upper() if reason is not None else ""
+
+                if attempt == 1 and use_swot:
+                    # まずはSWOTなしに落として再チャレンジ
+                    return _call_internal(False, 2)
+
+                if "SAFETY" in reason_str:
+                    return (
+                        "【エラー】Gemini の安全ポリシーにより回答がブロックされました。\n"
+                        "・特定の個人攻撃、自傷行為、違法行為などに関する内容が含まれていないか確認してください。\n"
+                        "・表現をもっと一般的で穏やかなものに言い換えて再実行してみてください。"
+                    )
+                if "MAX_TOKENS" in reason_str or "TOKENS" in reason_str:
+                    return (
+                        "【エラー】Gemini の出力トークン上限に達し、回答を最後まで生成できませんでした。\n"
+                        "・質問や補足テキストをさらに短くしてください。\n"
+                        "・必要なポイントだけに絞って問い直してみてください。"
+                    )
+
+                return (
+                    "【エラー】Gemini が有効なテキストを返しませんでした。\n"
+                    "・入力内容が長すぎるか、安全ポリシーに抵触した可能性があります。\n"
+                    "・質問を短くし、刺激的な表現を避けて再実行してみてください。"
+                )
+
+            text = (getattr(resp, "text", "") or "").strip()
+            if not text:
+                if attempt == 1 and use_swot:
+                    # 空テキスト → SWOTなしで再試行
+                    return _call_internal(False, 2)
+                return (
+                    "【エラー】Gemini が統合MAGIのテキストを返しませんでした。\n"
+                    "内容が長すぎるか、一部が安全フィルタにかかった可能性があります。"
+                )
+
+            return text
+
+        except ResourceExhausted as e:
+            if attempt == 1 and use_swot:
+                # まずはSWOTなしで軽く投げ直し
+                return _call_internal(False, 2)
+
+            detail = classify_resource_exhausted(e)
+            return (
+                "【エラー】Gemini で ResourceExhausted が発生しました。\n\n"
+                f"生メッセージ：{str(e)}\n\n"
+                f"{detail}"
+            )
+        except GoogleAPIError as e:
+            return f"【エラー】Gemini API で問題が発生しました: {str(e)}"
+        except JobCancelled:
+            raise
+        except Exception as e:
+            return f"【エラー】MAGI複合分析中に想定外のエラーが発生しました: {str(e)}"
+
+    cache = get_result_cache()
+    cache_key = magi_result_cache_key(model_name, ctx_text, enable_swot)
+    cached, cached_meta = (None, {}) if refresh else cache.get_with_meta(cache_key)
+    if cached is not None:
+        if meta is not None:
+            meta.update(cached_meta, cached=True)
+        return cached
+
+    def _call_uncached() -> Tuple[str | None, Dict[str, Any]]:
+        if not refresh:
+            # 直前に同じ内容の呼び出しが終わっていれば、その結果を使う
+            again, again_meta = cache.get_with_meta(cache_key)
+            if again is not None:
+                return again, dict(again_meta, cached=True)
+        use_swot = _preflight_use_swot(ctx_text, enable_swot, model_name, answered)
+        t0 = time.perf_counter()
+        with get_metrics().span("magi.single", model_name) as span:
+            text = _call_internal(use_swot, 1)
+            if is_error_text(text):
+                span["status"] = "error"
+        # 【エラー】〜 や None はキャッシュされない（ResultCache 側で除外）
+        if not is_error_text(text):
+            record_mode_latency("single", time.perf_counter() - t0)
+            # 下位モデルが代わりに回答した結果は、選択モデルのキーでは保存しない
+            if answered.get("model", model_name) == model_name:
+                used_swot = answered.get("used_swot", use_swot)
+                cache.put(
+                    magi_result_cache_key(model_name, ctx_text, used_swot),
+                    text,
+                    meta={"model": model_name, "used_swot": used_swot},
+                )
+        return text, dict(answered, cached=False)
+
+    # 同じ内容の呼び出しが他のセッションで進行中なら、その結果を待って共有する
+    # （refresh は保存済み・進行中の結果を使わずに呼び直す指示なので、相乗りしない）
+    flight = None if refresh else _single_flight()
+    if flight is None:
+        text, answered_meta = _call_uncached()
+        coalesced = False
+    else:
+        (text, answered_meta), coalesced = flight.do(
+            f"magi.single|{cache_key}", _call_uncached, group="magi.single"
+        )
+    if meta is not None:
+        meta.update(answered_meta, coalesced=coalesced)
+    return text
+
+
+# ======================================================
+# テキスト → 擬似エージェント構造＋SWOTへのパース
+# ======================================================
+MAGI_SECTION_PATTERN = r"^【(Magi-Logic|Magi-Human|Magi-Reality|Magi-Media|MAGI-統合サマリー|MAGI-統合詳細|SWOT分析)】"
+
+AGENT_SECTIONS = {
+    "Magi-Logic": ("logic", "Magi-Logic（論理・構造担当）"),
+    "Magi-Human": ("human", "Magi-Human（感情・人間面担当）"),
+    "Magi-Reality": ("reality", "Magi-Reality（現実運用・リスク担当）"),
+    "Magi-Media": ("media", "Magi-Media（表現・印象担当）"),
+}
+
+
+def apply_magi_section(
+    name: str,
+    body: str,
+    agents: Dict[str, Any],
+    aggregated: Dict[str, str],
+    swot: Dict[str, str],
+) -> str:
+    """
+    見出し1つ分（【...】〜次の見出しまで）を agents / aggregated / swot に反映し、
+    更新したキー（logic / human / reality / media / summary / details / swot）を返す。
+    """
+    body = body.strip()
+    if name in AGENT_SECTIONS:
+        key, name_jp = AGENT_SECTIONS[name]
+        agents[key] = parse_agent_block(name_jp, body)
+        return key
+    if name == "MAGI-統合サマリー":
+        aggregated["summary"] = body.replace("\n", " ").strip()
+        return "summary"
+    if name == "MAGI-統合詳細":
+        aggregated["details"] = body.strip()
+        return "details"
+    swot.update(parse_swot_block(body))
+    return "swot"
+
+
+@_timed("parse")
+def parse_magi_text(text: str) -> tuple[Dict[str, Any], Dict[str, str], Dict[str, str]]:
+    agents: Dict[str, Any] = {}
+    aggregated: Dict[str, str] = {"summary": "", "details": ""}
+    swot: Dict[str, str] = {
+        "strengths": "",
+        "weaknesses": "",
+        "opportunities": "",
+        "threats": "",
+    }
+
+    parts = re.split(MAGI_SECTION_PATTERN, text, flags=re.MULTILINE)
+
+    it = iter(parts[1:])  # 最初の要素は前置き
+
+    for name, body in zip(it, it):
+        apply_magi_section(name, body, agents, aggregated, swot)
+
+    return agents, aggregated, swot
+
+
+class MagiStreamParser:
+    """
+    ストリーミングで届くテキストを少しずつ受け取り、
+    「次の見出しが現れた＝直前のセクションが完成した」時点で1セクションずつ確定させる。
+    確定済みの結果は agents / aggregated / swot に parse_magi_text と同じ形で溜まる。
+    """
+
+    def __init__(self) -> None:
+        self.text = ""
+        self.agents: Dict[str, Any] = {}
+        self.aggregated: Dict[str, str] = {"summary": "", "details": ""}
+        self.swot: Dict[str, str] = {
+            "strengths": "",
+            "weaknesses": "",
+            "opportunities": "",
+            "threats": "",
+        }
+        self._done = 0
+
+    def feed(self, piece: str) -> List[str]:
+        """チャンクを追加し、新たに確定したセクションのキー一覧を返す。"""
+        self.text += piece
+        return self._drain(final=False)
+
+    def finish(self) -> List[str]:
+        """ストリーム終了時に、最後のセクションを確定させる。"""
+        return self._drain(final=True)
+
+    def _drain(self, final: bool) -> List[str]:
+        parts = re.split(MAGI_SECTION_PATTERN, self.text, flags=re.MULTILINE)
+        sections = list(zip(parts[1::2], parts[2::2]))
+        complete = sections if final else sections[:-1]
+        updated = [
+            apply_magi_section(name, body, self.agents, self.aggregated, self.swot)
+            for name, body in complete[self._done:]
+        ]
+        self._done = len(complete)
+        return updated
+
+
+def parse_agent_block(name_jp: str, body: str) -> Dict[str, Any]:
+    lines = [l.strip() for l in body.splitlines() if l.strip()]
+    decision_jp = "保留"
+    summary = ""
+
+    for line in lines:
+        if line.startswith("判定"):
+            if "可決" in line:
+                decision_jp = "可決"
+            elif "否決" in line:
+                decision_jp = "否決"
+            elif "保留" in line:
+                decision_jp = "保留"
+        elif line.startswith("要約"):
+            summary = line.replace("要約", "").replace(":", "").replace("：", "").strip()
+        else:
+            if summary:
+                summary += " " + line
+
+    decision_code = {
+        "可決": "Go",
+        "否決": "No-Go",
+        "保留": "Hold",
+    }.get(decision_jp, "Hold")
+
+    return {
+        "name_jp": name_jp,
+        "summary": summary,
+        "decision_jp": decision_jp,
+        "decision_code": decision_code,
+    }
+
+
+def parse_swot_block(body: str) -> Dict[str, str]:
+    swot = {
+        "strengths": "",
+        "weaknesses": "",
+        "opportunities": "",
+        "threats": "",
+    }
+    lines = [l.strip() for l in body.splitlines() if l.strip()]
+    for line in lines:
+        if line.startswith("Strengths"):
+            swot["strengths"] = line.split(":", 1)[-1].strip()
+        elif line.startswith("Weaknesses"):
+            swot["weaknesses"] = line.split(":", 1)[-1].strip()
+        elif line.startswith("Opportunities"):
+            swot["opportunities"] = line.split(":", 1)[-1].strip()
+        elif line.startswith("Threats"):
+            swot["threats"] = line.split(":", 1)[-1].strip()
+    return swot
+
+
+def decision_to_css(decision_code: str) -> Dict[str, str]:
+    code = (decision_code or "Hold").strip()
+    if code == "Go":
+        return {"css": "approve", "en": "APPROVE", "jp": "可決"}
+    if code == "No-Go":
+        return {"css": "reject", "en": "REJECT", "jp": "否決"}
+    return {"css": "hold", "en": "HOLD", "jp": "保留"}
+
+
+def swot_text_to_chips(text: str, chip_class: str) -> str:
+    if not text:
+        return ""
+    items = [x.strip() for x in text.replace("。", "、").split("、") if x.strip()]
+    html_items = "".join(
+        f'<span class="swot-chip {chip_class}">{clean_text_for_display(item)}</span>'
+        for item in items
+    )
+    count_label = f'<div class="swot-count-label">項目数: {len(items)}</div>'
+    return count_label + html_items
+
+
+# ======================================================
+# 表示用 HTML（パネル・統合結論・SWOT チップ）
+# ======================================================
+AGENT_PANEL_TITLES = {
+    "logic": "Magi-Logic",
+    "reality": "Magi-Reality",
+    "human": "Magi-Human",
+    "media": "Magi-Media",
+}
+
+SWOT_PANELS = [
+    ("strengths", "Strengths（強み）", "swot-chip-s"),
+    ("weaknesses", "Weaknesses（弱み）", "swot-chip-w"),
+    ("opportunities", "Opportunities（機会）", "swot-chip-o"),
+    ("threats", "Threats（脅威）", "swot-chip-t"),
+]
+
+ALL_SECTION_KEYS = list(AGENT_PANEL_TITLES) + ["summary", "details", "swot"]
+
+
+def agent_panel_html(key: str, agent: Dict[str, Any]) -> str:
+    dec = decision_to_css(agent.get("decision_code", "Hold"))
+    summary_html = clean_text_for_display(agent.get("summary", "")).replace("\n", "<br>")
+    return f'''
+    <div class="magi-panel magi-panel-{key}">
+      <div class="magi-vote magi-vote-{dec["css"]}">
+        <div class="magi-vote-label-en">{dec["en"]}</div>
+        <div class="magi-vote-label-jp">{dec["jp"]}</div>
+      </div>
+      <div class="magi-panel-summary">
+        {summary_html}
+      </div>
+    </div>
+    '''
+
+
+def aggregated_html(aggregated: Dict[str, str]) -> str:
+    agg = clean_text_for_display(
+        aggregated.get("details", "") or aggregated.get("summary", "")
+    ).replace("\n", "<br>")
+    return f'<div class="magi-aggregator">{agg}</div>'
+
+
+def swot_panel_html(title: str, chips_html: str) -> str:
+    return f'''
+    <div class="magi-panel-swot">
+      <b>{title}</b><br>
+      {chips_html}
+    </div>
+    '''
+
+
+# ======================================================
+# MAGI ストリーミング生成（セクション単位で逐次表示）
+# ======================================================
+def _chunk_text(chunk) -> str:
+    # 安全フィルタ等で parts が空のチャンクは .text が例外を投げる
+    try:
+        return chunk.text or ""
+    except Exception:
+        return ""
+
+
+def stream_magi_plain(
+    context: Dict[str, Any],
+    enable_swot: bool,
+    on_sections: Callable[[List[str], MagiStreamParser], None],
+    model_name: str = DEFAULT_MODEL_NAME,
+    meta: Optional[Dict[str, Any]] = None,
+    refresh: bool = False,
+) -> str | None:
+    """
+    generate_content(stream=True) でテキストを受け取りながら MagiStreamParser に流し込み、
+    セクションが1つ確定するたびに on_sections(更新キー, parser) を呼ぶ。
+    戻り値は call_magi_plain と同じく全文テキスト（Word レポート用）。
+
+    キャッシュ済みならストリーミングせずに即座に全セクションを通知する。
+    何も受信できなかった場合は、SWOT縮退やエラー診断を持つ call_magi_plain（一括モード）に
+    フォールバックする。途中まで受信してから失敗した場合は、受け取れた部分だけを返し
+    （キャッシュはしない）、meta["partial"] = True を書き込む。
+    meta・refresh は call_magi_plain と同じ。
+    """
+    ctx_text = build_magi_ctx_text(condense_context(context, model_name, meta))
+    cache = get_result_cache()
+    cache_key = magi_result_cache_key(model_name, ctx_text, enable_swot)
+
+    def _emit_full_text(text: str | None) -> str | None:
+        if text and not is_error_text(text):
+            parser = MagiStreamParser()
+            updated = parser.feed(text) + parser.finish()
+            on_sections(updated, parser)
+        return text
+
+    cached, cached_meta = (None, {}) if refresh else cache.get_with_meta(cache_key)
+    if cached is not None:
+        if meta is not None:
+            meta.update(cached_meta, cached=True)
+        return _emit_full_text(cached)
+
+    answered: Dict[str, Any] = {}
+    use_swot = _preflight_use_swot(ctx_text, enable_swot, model_name, answered)
+    answered["used_swot"] = use_swot
+    sys_prompt = SYS_PROMPT_SWOT if use_swot else SYS_PROMPT_BASIC
+    max_tokens = MAX_TOKENS_SWOT if use_swot else MAX_TOKENS_BASIC
+    parser = MagiStreamParser()
+    last_chunk = None
+    t0 = time.perf_counter()
+
+    try:
+        resp = generate_with_fallback(
+            model_name,
+            [sys_prompt, ctx_text],
+            meta=answered,
+            generation_config={"max_output_tokens": max_tokens},
+            stream=True,
+        )
+        for chunk in resp:
+            last_chunk = chunk
+            piece = _chunk_text(chunk)
+            if not piece:
+                continue
+            if not parser.text:
+                get_metrics().observe("magi.stream.first_chunk", time.perf_counter() - t0, model_name)
+            updated = parser.feed(piece)
+            if updated:
+                on_sections(updated, parser)
+    except JobCancelled:
+        raise
+    except Exception:
+        if parser.text.strip():
+            # 受信済みのセクションはもう通知しているので、一括モードでやり直さずに打ち切る
+            get_metrics().observe("magi.stream", time.perf_counter() - t0, model_name, "partial")
+            updated = parser.finish()
+            if updated:
+                on_sections(updated, parser)
+            if meta is not None:
+                meta.update(answered, cached=False, partial=True)
+            return parser.text.strip()
+        get_metrics().observe("magi.stream", time.perf_counter() - t0, model_name, "error")
+        return _emit_full_text(call_magi_plain(context, enable_swot, model_name, meta, refresh))
+
+    text = parser.text.strip()
+    if not text:
+        get_metrics().observe("magi.stream", time.perf_counter() - t0, model_name, "error")
+        return _emit_full_text(call_magi_plain(context, enable_swot, model_name, meta, refresh))
+
+    updated = parser.finish()
+    if updated:
+        on_sections(updated, parser)
+    get_metrics().observe("magi.stream", time.perf_counter() - t0, model_name)
+    # ストリーミングでは最後のチャンクに使用量が載る
+    if last_chunk is not None:
+        record_usage(answered.get("model", model_name), "magi.stream", last_chunk)
+    record_mode_latency("single", time.perf_counter() - t0)
+    if meta is not None:
+        meta.update(answered, cached=False)
+    # 事前見積もりで SWOT なしに切り替えた回答は、SWOT なしのキーで保存する
+    # （下位モデルが代わりに回答した結果は保存しない）
+    if answered.get("model", model_name) == model_name:
+        cache.put(
+            magi_result_cache_key(model_name, ctx_text, use_swot),
+            text,
+            meta={"model": answered.get("model", model_name), "used_swot": use_swot},
+        )
+    return text
+
+
+# ======================================================
+# 並列モード：エージェントごとに同時実行 → 統合MAGIで集約
+# ======================================================
+MAX_TOKENS_FANOUT_AGENT = 160
+MAX_TOKENS_FANOUT_AGGREGATOR_SWOT = 560
+MAX_TOKENS_FANOUT_AGGREGATOR_BASIC = 400
+
+FANOUT_AGENT_FOCUS = {
+    "Magi-Logic": "論理的な整合性・構造・根拠の確かさ",
+    "Magi-Human": "感情・人間関係・関係者の受け止め方",
+    "Magi-Reality": "現実的な運用・コスト・リスク",
+    "Magi-Media": "表現・見え方・周囲に与える印象",
+}
+
+FANOUT_AGENT_PROMPT = """
+あなたは NERV の MAGI システムを構成する {name_jp} です。
+「{focus}」の観点だけから、ユーザーの問いを評価してください。
+以下のフォーマットだけを使って日本語で出力してください。
+
+判定: 可決 または 保留 または 否決 のいずれか
+要約: 2〜3文、合計120文字以内
+
+[制約]
+- 上記2行以外の文言や飾りは追加しない。
+- 箇条書き（・や番号付きリスト）は使わない。
+"""
+
+FANOUT_AGGREGATOR_PROMPT_SWOT = """
+あなたは NERV の MAGI システム全体を統合するAIです。
+4つのエージェント（Magi-Logic / Magi-Human / Magi-Reality / Magi-Media）の判定と要約を踏まえて、
+統合MAGIとしての結論と、意思決定に役立つSWOT分析を、以下のフォーマットだけを使って日本語で出力してください。
+
+【MAGI-統合サマリー】
+全体としての結論を150文字以内でまとめる
+
+【MAGI-統合詳細】
+統合的な視点から、2〜4段落・合計500文字以内で詳細なコメントと推奨アクションを書く
+
+【SWOT分析】
+Strengths: 強みを5〜7個、日本語で列挙し、読点「、」で区切って1行で書く（合計300文字以内）
+Weaknesses: 弱みを5〜7個、日本語で列挙し、読点「、」で区切って1行で書く（合計300文字以内）
+Opportunities: 機会を5〜7個、日本語で列挙し、読点「、」で区切って1行で書く（合計300文字以内）
+Threats: 脅威を5〜7個、日本語で列挙し、読点「、」で区切って1行で書く（合計300文字以内）
+
+[制約]
+- 箇条書き（・や番号付きリスト）は使わない。
+- 上記の見出し・ラベル以外の文言や飾りは追加しない。
+- 「Strengths:」「Weaknesses:」「Opportunities:」「Threats:」は英語ラベルをそのまま使う。
+- 出力は必ずこのフォーマットに沿ったプレーンテキストのみとする。
+"""
+
+FANOUT_AGGREGATOR_PROMPT_BASIC = """
+あなたは NERV の MAGI システム全体を統合するAIです。
+4つのエージェント（Magi-Logic / Magi-Human / Magi-Reality / Magi-Media）の判定と要約を踏まえて、
+統合MAGIとしての結論を、以下のフォーマットだけを使って日本語で出力してください。
+
+【MAGI-統合サマリー】
+全体としての結論を150文字以内でまとめる
+
+【MAGI-統合詳細】
+統合的な視点から、2〜3段落・合計400文字以内で詳細なコメントと推奨アクションを書く
+
+[制約]
+- 箇条書き（・や番号付きリスト）は使わない。
+- 上記の見出し・ラベル以外の文言や飾りは追加しない。
+- 出力は必ずこのフォーマットに沿ったプレーンテキストのみとする。
+"""
+
+
+def _fanout_generate(
+    model_name: str,
+    prompt: str,
+    ctx_text: str,
+    max_tokens: int,
+    timeout: float,
+    meta: Dict[str, Any],
+    purpose: str = "fanout.agent",
+    deadline: Optional[float] = None,
+) -> str:
+    # timeout は1リクエストのタイムアウト、deadline は順番待ち・再試行も含めた締め切り
+    resp = generate_with_fallback(
+        model_name,
+        [prompt, ctx_text],
+        meta=meta,
+        purpose=purpose,
+        deadline=deadline,
+        generation_config={"max_output_tokens": max_tokens},
+        request_options={"timeout": timeout},
+    )
+    text = _chunk_text(resp).strip()
+    if not text:
+        raise ValueError("Gemini が有効なテキストを返しませんでした")
+    return text
+
+
+def _fanout_hold_body(reason: str) -> str:
+    # 失敗したエージェントは「保留」として扱い、全体は止めない
+    return f"判定: 保留\n要約: この視点の分析を取得できなかったため、判定を保留とします（{reason}）。"
+
+
+def _fanout_failure_reason(e: BaseException) -> str:
+    if isinstance(e, ResourceExhausted):
+        return "リソース上限"
+    if isinstance(e, (TimeoutError, FuturesTimeoutError)):
+        return "タイムアウト"
+    return "応答エラー"
+
+
+def _drain_fanout_agents(futures: Dict[Future, str], drain_sec: float, model_name: str) -> None:
+    """
+    締め切り後も実行中のエージェントを待つ（リクエストのタイムアウトは締め切りまでに縮めてあるので、
+    ほどなく終わる）。drain_sec 待っても終わらないものは "fanout.drain" の status=abandoned として記録する。
+    それらは終わるまでスケジューラの実行枠を使ったままなので、stats() の running に数えられる。
+    """
+    running = [fut for fut in futures if not fut.done()]
+    if not running:
+        return
+    t0 = time.perf_counter()
+    _, still_running = futures_wait(running, timeout=drain_sec)
+    get_metrics().observe(
+        "fanout.drain", time.perf_counter() - t0, model_name, "abandoned" if still_running else "ok"
+    )
+
+
+def fanout_magi_plain(
+    context: Dict[str, Any],
+    enable_swot: bool,
+    on_sections: Optional[Callable[[List[str], MagiStreamParser], None]] = None,
+    model_name: str = DEFAULT_MODEL_NAME,
+    meta: Optional[Dict[str, Any]] = None,
+    refresh: bool = False,
+) -> str | None:
+    """
+    4エージェントを1リクエストずつ並列に呼び出し（同時実行数・タイムアウト付き）、
+    その結果を統合MAGIに渡して集約する。
+    戻り値は call_magi_plain と同じフォーマットの全文テキストなので、
+    parse_magi_text / build_word_report はそのまま使える。
+    meta["model"] には統合MAGIを回答したモデル、meta["agent_models"] には各エージェントのモデルを書き込む。
+    refresh は call_magi_plain と同じ。
+    """
+    ctx_text = build_magi_ctx_text(condense_context(context, model_name, meta))
+    cache = get_result_cache()
+    cache_key = magi_result_cache_key(model_name, ctx_text, enable_swot, mode="fanout")
+
+    state = MagiStreamParser()
+
+    def _notify(keys: List[str]) -> None:
+        if on_sections is not None and keys:
+            on_sections(keys, state)
+
+    cached, cached_meta = (None, {}) if refresh else cache.get_with_meta(cache_key)
+    if cached is not None:
+        if meta is not None:
+            meta.update(cached_meta, cached=True)
+        _notify(state.feed(cached) + state.finish())
+        return cached
+
+    max_workers = max(1, get_setting("MAGI_FANOUT_MAX_WORKERS", 4))
+    agent_timeout = float(get_setting("MAGI_FANOUT_AGENT_TIMEOUT_SEC", 30))
+    aggregator_timeout = float(get_setting("MAGI_FANOUT_AGGREGATOR_TIMEOUT_SEC", 60))
+    drain_sec = float(get_setting("MAGI_FANOUT_DRAIN_SEC", 5))
+
+    t0 = time.perf_counter()
+    agent_bodies: Dict[str, str] = {}
+    agent_meta: Dict[str, Dict[str, Any]] = {name: {} for name in AGENT_SECTIONS}
+    failures: List[BaseException] = []
+
+    def _set_agent(name: str, body: str) -> None:
+        agent_bodies[name] = body
+        _notify([apply_magi_section(name, body, state.agents, state.aggregated, state.swot)])
+
+    # 同時実行数が4未満なら待ち行列ができるので、その分だけ全体の締め切りを延ばす
+    rounds = -(-len(AGENT_SECTIONS) // max_workers)
+    agents_deadline = time.monotonic() + agent_timeout * rounds
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="magi-agent")
+    # 計測中のスパン一覧（collect_trace）をワーカースレッドにも引き継ぐ
+    futures = {
+        executor.submit(
+            contextvars.copy_context().run,
+            _fanout_generate,
+            model_name,
+            FANOUT_AGENT_PROMPT.format(name_jp=name_jp, focus=FANOUT_AGENT_FOCUS[name]),
+            ctx_text,
+            MAX_TOKENS_FANOUT_AGENT,
+            agent_timeout,
+            agent_meta[name],
+            "fanout.agent",
+            agents_deadline,
+        ): name
+        for name, (_, name_jp) in AGENT_SECTIONS.items()
+    }
+    try:
+        for fut in as_completed(futures, timeout=max(0.0, _time_left(agents_deadline))):
+            name = futures[fut]
+            try:
+                _set_agent(name, fut.result())
+            except JobCancelled:
+                # ジョブの取り消し・時間切れは保留にせず、ジョブごと止める
+                raise
+            except Exception as e:
+                failures.append(e)
+                _set_agent(name, _fanout_hold_body(_fanout_failure_reason(e)))
+    except FuturesTimeoutError as e:
+        for name in AGENT_SECTIONS:
+            if name not in agent_bodies:
+                failures.append(e)
+                _set_agent(name, _fanout_hold_body("タイムアウト"))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        _drain_fanout_agents(futures, drain_sec, model_name)
+    get_metrics().observe(
+        "fanout.agents", time.perf_counter() - t0, model_name, "error" if failures else "ok"
+    )
+
+    if len(failures) >= len(AGENT_SECTIONS):
+        first = failures[0]
+        if isinstance(first, ResourceExhausted):
+            return (
+                "【エラー】Gemini で ResourceExhausted が発生しました。\n\n"
+                f"生メッセージ：{str(first)}\n\n"
+                f"{classify_resource_exhausted(first)}"
+            )
+        return f"【エラー】すべてのMAGIエージェントの呼び出しに失敗しました: {str(first)}"
+
+    agents_text = "\n\n".join(
+        f"【{name}】\n{agent_bodies[name]}" for name in AGENT_SECTIONS
+    )
+    aggregator_prompt = (
+        FANOUT_AGGREGATOR_PROMPT_SWOT if enable_swot else FANOUT_AGGREGATOR_PROMPT_BASIC
+    )
+    aggregator_max_tokens = (
+        MAX_TOKENS_FANOUT_AGGREGATOR_SWOT if enable_swot else MAX_TOKENS_FANOUT_AGGREGATOR_BASIC
+    )
+    aggregator_meta: Dict[str, Any] = {}
+    try:
+        with get_metrics().span("fanout.aggregator", model_name):
+            aggregated_text = _fanout_generate(
+                model_name,
+                aggregator_prompt,
+                ctx_text + "\n【各エージェントの判定と要約】\n" + agents_text,
+                aggregator_max_tokens,
+                aggregator_timeout,
+                aggregator_meta,
+                "fanout.aggregator",
+                time.monotonic() + aggregator_timeout,
+            )
+    except ResourceExhausted as e:
+        return (
+            "【エラー】統合MAGIの生成中に ResourceExhausted が発生しました。\n\n"
+            f"生メッセージ：{str(e)}\n\n"
+            f"{classify_resource_exhausted(e)}"
+        )
+    except JobCancelled:
+        raise
+    except Exception as e:
+        return f"【エラー】統合MAGIの生成に失敗しました: {str(e)}"
+
+    if not re.search(MAGI_SECTION_PATTERN, aggregated_text, flags=re.MULTILINE):
+        aggregated_text = "【MAGI-統合サマリー】\n" + aggregated_text
+
+    text = agents_text + "\n\n" + aggregated_text
+    _, aggregated, swot = parse_magi_text(aggregated_text)
+    state.aggregated.update(aggregated)
+    state.swot.update(swot)
+    _notify(["summary", "details", "swot"])
+
+    get_metrics().observe("magi.fanout", time.perf_counter() - t0, model_name)
+    record_mode_latency("fanout", time.perf_counter() - t0)
+    answered = {
+        "model": aggregator_meta.get("model", model_name),
+        "agent_models": {
+            AGENT_SECTIONS[name][0]: m["model"] for name, m in agent_meta.items() if "model" in m
+        },
+    }
+    if meta is not None:
+        meta.update(answered, cached=False)
+    # 一部エージェントが保留に落ちた結果・下位モデルが代わりに回答した結果はキャッシュしない（次回は再取得を試みる）
+    answered_models = {answered["model"], *answered["agent_models"].values()}
+    if not failures and answered_models == {model_name}:
+        cache.put(cache_key, text, meta=answered)
+    return text
+
+
+# ======================================================
+# 分析履歴（過去の結果を Gemini を呼ばずに開き直す）
+# ======================================================
+@lru_cache(maxsize=1)
+def get_history() -> AnalysisHistory:
+    """過去の分析結果の履歴（全セッション共有・SQLite に永続化）。"""
+    return AnalysisHistory(
+        get_setting("MAGI_HISTORY_DB_PATH", os.path.join(".magi_cache", "history.sqlite3")),
+        retention_days=get_setting("MAGI_HISTORY_RETENTION_DAYS", 180),
+        max_entries=get_setting("MAGI_HISTORY_MAX_ENTRIES", 1000),
+        max_bytes=get_setting("MAGI_HISTORY_MAX_BYTES", 64 * 1024 * 1024),
+    )
+
+
+# ======================================================
+# バックグラウンドジョブ（分析を画面の再実行・再読み込みから切り離す）
+# ======================================================
+@lru_cache(maxsize=1)
+def get_job_queue() -> JobQueue:
+    """
+    分析ジョブのワーカーとジョブ表（全セッション共有・SQLite に永続化）。
+    画面からの分析はすべてここを通るので、ワーカー数は同時に使うセッション数を目安にする
+    （Gemini の同時実行数は get_scheduler() が別に抑えるので、ワーカーの多くは順番待ちで寝ているだけ）。
+    """
+    return JobQueue(
+        get_setting("MAGI_JOBS_DB_PATH", os.path.join(".magi_cache", "jobs.sqlite3")),
+        workers=get_setting("MAGI_JOB_WORKERS", 32),
+        timeout_sec=get_setting("MAGI_JOB_TIMEOUT_SEC", 300.0),
+        retention_days=get_setting("MAGI_JOB_RETENTION_DAYS", 7.0),
+        heartbeat_sec=get_setting("MAGI_JOB_HEARTBEAT_SEC", 30.0),
+    )
+
+
+# ======================================================
+# レポート生成（Word はテンプレートから。Markdown / HTML / JSON も同じデータから作る）
+# ======================================================
+@lru_cache(maxsize=1)
+def get_report_template() -> DocxTemplate:
+    """
+    MAGI_REPORT_TEMPLATE_PATH の .docx（未設定なら既定のテンプレート）をプロセスごとに1回だけ読み込む。
+    既定のテンプレートは `python magi_report.py --write-template PATH` で書き出して編集できる。
+    """
+    path = get_setting("MAGI_REPORT_TEMPLATE_PATH", "")
+    if path:
+        with open(path, "rb") as f:
+            return DocxTemplate(f.read())
+    return DocxTemplate(default_template_bytes())
+
+
+def report_data(
+    context: Dict[str, Any],
+    agents: Dict[str, Any],
+    aggregated: Dict[str, Any],
+    magi_raw_text: str,
+    swot: Optional[Dict[str, str]] = None,
+    enable_swot: bool = False,
+    answered_model: Optional[str] = None,
+) -> Dict[str, Any]:
+    """パース結果をレポート用のデータ（文字列だけの dict）にまとめる。どの出力形式もこれから作る。"""
+    title = "MAGI風マルチAI分析レポート（テキスト簡易版"
+    if enable_swot:
+        title += "＋SWOT"
+    title += "）"
+
+    inputs: List[Dict[str, str]] = []
+    if context.get("text_input"):
+        inputs.append({"label": "テキスト入力", "body": context["text_input"]})
+    text_file: Optional[IngestedText] = context.get("text_file")
+    if text_file is not None:
+        # 添付ファイルは先頭だけを載せる（レポートを巨大にしない）
+        max_chars = get_setting("MAGI_REPORT_TEXT_FILE_MAX_CHARS", 20_000)
+        inputs.append({
+            "label": "添付テキストファイル",
+            "body": trim_text(text_file.head(max_chars + 1), max_chars)
+            + (f"\n（全 {text_file.chars:,} 文字）" if text_file.chars > max_chars else ""),
+        })
+    if context.get("audio_transcript"):
+        inputs.append({"label": "音声文字起こし", "body": context["audio_transcript"]})
+    if context.get("image_description"):
+        inputs.append({"label": "画像の説明", "body": context["image_description"]})
+
+    agent_items = [
+        {
+            "key": key,
+            "name": agents[key].get("name_jp", key),
+            "decision": agents[key].get("decision_jp", ""),
+            "summary": clean_text_for_display(agents[key].get("summary", "")),
+        }
+        for key in ["logic", "human", "reality", "media"]
+        if key in (agents or {})
+    ]
+
+    return {
+        "title": title,
+        "user_question": context.get("user_question", ""),
+        "answered_model": answered_model or "",
+        "inputs": inputs,
+        "agents": agent_items,
+        "aggregated": {
+            "summary": clean_text_for_display(aggregated.get("summary", "")),
+            "details": "\n".join(clean_text_for_display(aggregated.get("details", "")).splitlines()),
+        },
+        # SWOT OFF のときは None（第4章なし）。ON で空なら「生成されませんでした」
+        "swot": {k: swot.get(k, "") for k, _ in SWOT_LABELS} if enable_swot and swot else None,
+        "raw_text": "\n".join(magi_raw_text.splitlines()),
+    }
+
+
+def _report_image(image: Optional[Union[Image.Image, EncodedImage]]) -> Optional[EncodedImage]:
+    if isinstance(image, Image.Image):
+        return encode_image(image, image_profile("report"))
+    return image
+
+
+@_timed("report.build")
+def build_word_report(
+    context: Dict[str, Any],
+    agents: Dict[str, Any],
+    aggregated: Dict[str, Any],
+    magi_raw_text: str,
+    image: Optional[Union[Image.Image, EncodedImage]] = None,
+    swot: Optional[Dict[str, str]] = None,
+    enable_swot: bool = False,
+    answered_model: Optional[str] = None,
+) -> bytes:
+    """
+    image には prepare_image_cached(data, "report") の結果を渡すと、再エンコードせずにそのまま貼る。
+    PIL 画像を渡した場合は、レポート用プロファイルでその場で縮小・エンコードする。
+    """
+    data = report_data(context, agents, aggregated, magi_raw_text, swot, enable_swot, answered_model)
+    encoded = _report_image(image)
+    return get_report_template().render(data, image=encoded.data if encoded is not None else None)
+
+
+def build_report(
+    fmt: str,
+    context: Dict[str, Any],
+    agents: Dict[str, Any],
+    aggregated: Dict[str, Any],
+    magi_raw_text: str,
+    image: Optional[Union[Image.Image, EncodedImage]] = None,
+    swot: Optional[Dict[str, str]] = None,
+    enable_swot: bool = False,
+    answered_model: Optional[str] = None,
+) -> bytes:
+    """fmt（REPORT_FORMATS のキー）の形式でレポートを作る。docx 以外は UTF-8 のテキスト。"""
+    if fmt == "docx":
+        return build_word_report(
+            context, agents, aggregated, magi_raw_text, image, swot, enable_swot, answered_model
+        )
+    if fmt not in REPORT_FORMATS:
+        raise ValueError(f"未対応のレポート形式です: {fmt}")
+    with get_metrics().span(f"report.build.{fmt}"):
+        data = report_data(context, agents, aggregated, magi_raw_text, swot, enable_swot, answered_model)
+        if fmt == "md":
+            return render_markdown(data).encode("utf-8")
+        if fmt == "html":
+            encoded = _report_image(image)
+            if encoded is None:
+                return render_html(data).encode("utf-8")
+            return render_html(data, encoded.data, encoded.mime_type).encode("utf-8")
+        return render_json(data).encode("utf-8")
+
+
+# レポートのレイアウトを変えたら上げて、作成済みレポートのキャッシュを無効化する
+# （Word テンプレートの差し替えはテンプレートのハッシュでキーが変わる）
+REPORT_LAYOUT_VERSION = "v2"
+
+
+@lru_cache(maxsize=1)
+def get_report_cache() -> ReportCache:
+    return ReportCache(max_bytes=get_setting("MAGI_REPORT_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+
+def _image_digest(image: Optional[Union[Image.Image, EncodedImage]]) -> str:
+    if image is None:
+        return ""
+    if isinstance(image, Image.Image):
+        return hashlib.sha256(image.tobytes()).hexdigest()
+    return hashlib.sha256(image.data).hexdigest()
+
+
+def report_cache_key(
+    context: Dict[str, Any],
+    agents: Dict[str, Any],
+    aggregated: Dict[str, Any],
+    magi_raw_text: str,
+    image: Optional[Union[Image.Image, EncodedImage]] = None,
+    swot: Optional[Dict[str, str]] = None,
+    enable_swot: bool = False,
+    answered_model: Optional[str] = None,
+    fmt: str = "docx",
+) -> str:
+    """入力（添付ファイル・画像は内容のハッシュ）とパース結果・SWOT 設定・出力形式から作るレポートのキー。"""
+    return result_cache_key(
+        kind="word_report" if fmt == "docx" else f"report_{fmt}",
+        layout_version=REPORT_LAYOUT_VERSION,
+        template=get_report_template().digest if fmt == "docx" else "",
+        context={
+            name: value.digest if isinstance(value, IngestedText) else value
+            for name, value in context.items()
+        },
+        agents=agents,
+        aggregated=aggregated,
+        magi_raw_text=magi_raw_text,
+        # JSON には画像を入れない
+        image=_image_digest(image) if fmt in ("docx", "html") else "",
+        swot=swot,
+        enable_swot=enable_swot,
+        answered_model=answered_model,
+    )
+
+
+def build_report_cached(
+    fmt: str,
+    context: Dict[str, Any],
+    agents: Dict[str, Any],
+    aggregated: Dict[str, Any],
+    magi_raw_text: str,
+    image: Optional[Union[Image.Image, EncodedImage]] = None,
+    swot: Optional[Dict[str, str]] = None,
+    enable_swot: bool = False,
+    answered_model: Optional[str] = None,
+    meta: Optional[Dict[str, Any]] = None,
+) -> bytes:
+    """
+    build_report の結果を report_cache_key ごとに保持する（全セッション共有）。
+    meta にはキャッシュ利用有無（cached）・作成にかかった秒数（build_sec）・サイズ（bytes）を書き込む。
+    """
+    kwargs = dict(
+        context=context,
+        agents=agents,
+        aggregated=aggregated,
+        magi_raw_text=magi_raw_text,
+        image=image,
+        swot=swot,
+        enable_swot=enable_swot,
+        answered_model=answered_model,
+    )
+    cache = get_report_cache()
+    key = report_cache_key(fmt=fmt, **kwargs)
+    data = cache.get(key)
+    if data is not None:
+        if meta is not None:
+            meta.update(cached=True, build_sec=0.0, bytes=len(data))
+        return data
+    t0 = time.perf_counter()
+    data = build_report(fmt, **kwargs)
+    cache.put(key, data)
+    if meta is not None:
+        meta.update(cached=False, build_sec=time.perf_counter() - t0, bytes=len(data))
+    return data
+
+
+def build_word_report_cached(
+    context: Dict[str, Any],
+    agents: Dict[str, Any],
+    aggregated: Dict[str, Any],
+    magi_raw_text: str,
+    image: Optional[Union[Image.Image, EncodedImage]] = None,
+    swot: Optional[Dict[str, str]] = None,
+    enable_swot: bool = False,
+    answered_model: Optional[str] = None,
+    meta: Optional[Dict[str, Any]] = None,
+) -> bytes:
+    return build_report_cached(
+        "docx", context, agents, aggregated, magi_raw_text, image, swot, enable_swot, answered_model, meta
+    )
+
+
+class ReportBuilderPool:
+    """
+    多数のレポートをバックグラウンドで作る（バッチ用）。
+    submit したものを completed() で出来た順に受け取る。
+    python-docx は純 Python なので、CPU を並列に使いたいときは processes=True にする。
+    """
+
+    def __init__(self, max_workers: int = 2, processes: bool = False):
+        self._executor: Executor = (
+            ProcessPoolExecutor(max_workers=max(1, max_workers))
+            if processes
+            else ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="magi-report")
+        )
+        self._processes = processes
+        self._pending: Dict["Future[bytes]", str] = {}
+
+    def submit(self, name: str, fmt: str = "docx", **report_kwargs: Any) -> None:
+        # 別プロセスではこのプロセスのキャッシュは使えないので、直接作る
+        build = build_report if self._processes else build_report_cached
+        self._pending[self._executor.submit(build, fmt, **report_kwargs)] = name
+
+    def completed(self, wait: bool = False) -> Iterator[Tuple[str, bytes]]:
+        """出来上がったレポートの (name, bytes)。wait=True なら残り全部を待つ。"""
+        done = (
+            list(as_completed(self._pending))
+            if wait
+            else [fut for fut in self._pending if fut.done()]
+        )
+        for fut in done:
+            yield self._pending.pop(fut), fut.result()
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self) -> "ReportBuilderPool":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
@@ -0,0 +1,133 @@
+"""
+モデルのフォールバック（例：pro → 2.5-flash → 2.0-flash → flash-lite）と、
+モデルごとの直近の健全性（レイテンシ・エラー率・クールダウン）の記録。
+"""
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Sequence, Tuple
+
+
+def model_cascade(selected: str, chain: Sequence[str]) -> List[str]:
+    """
+    選択モデルを先頭に、フォールバックチェーン上でそれより後ろのモデルを並べる。
+    選択モデルがチェーンに無い場合は、チェーン全体を後ろに付ける。
+    """
+    chain = [m for m in chain if m]
+    if selected in chain:
+        rest = chain[chain.index(selected) + 1:]
+    else:
+        rest = chain
+    return [selected] + [m for m in rest if m != selected]
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class ModelHealthTracker:
+    """
+    モデルごとに直近 window_sec 秒の (時刻, レイテンシ, 成否) を保持し、
+    - エラー率が error_rate_threshold 以上（min_samples 件以上あるとき）
+    - レイテンシ中央値が slow_latency_sec を超える（0 なら判定しない）
+    - 呼び出し側から明示的にクールダウンを指定された（min_consecutive 回続けて失敗したときだけ）
+    のいずれかで、そのモデルを cooldown_sec 秒のあいだ「使わない」状態にする。
+    """
+
+    def __init__(
+        self,
+        window_sec: float = 300.0,
+        min_samples: int = 4,
+        error_rate_threshold: float = 0.5,
+        cooldown_sec: float = 60.0,
+        slow_latency_sec: float = 0.0,
+    ):
+        self.window_sec = float(window_sec)
+        self.min_samples = int(min_samples)
+        self.error_rate_threshold = float(error_rate_threshold)
+        self.cooldown_sec = float(cooldown_sec)
+        self.slow_latency_sec = float(slow_latency_sec)
+        self._samples: Dict[str, Deque[Tuple[float, float, bool]]] = {}
+        self._cooldown_until: Dict[str, float] = {}
+        # 直近で続けて失敗した回数（成功したら 0 に戻す）
+        self._consecutive: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _window_locked(self, model_name: str, now: float) -> Deque[Tuple[float, float, bool]]:
+        samples = self._samples.setdefault(model_name, deque())
+        while samples and now - samples[0][0] > self.window_sec:
+            samples.popleft()
+        return samples
+
+    def _evaluate_locked(self, model_name: str, now: float) -> None:
+        samples = self._window_locked(model_name, now)
+        if len(samples) < self.min_samples:
+            return
+        errors = sum(1 for _, _, ok in samples if not ok)
+        latencies = [lat for _, lat, ok in samples if ok]
+        too_many_errors = errors / len(samples) >= self.error_rate_threshold
+        too_slow = (
+            self.slow_latency_sec > 0
+            and bool(latencies)
+            and _percentile(latencies, 0.5) > self.slow_latency_sec
+        )
+        if too_many_errors or too_slow:
+            self._cooldown_until[model_name] = max(
+                self._cooldown_until.get(model_name, 0.0), now + self.cooldown_sec
+            )
+            # クールダウン明けは新しい統計で判定し直す
+            samples.clear()
+
+    def record_success(self, model_name: str, latency: float) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._window_locked(model_name, now).append((now, latency, True))
+            self._consecutive[model_name] = 0
+            self._evaluate_locked(model_name, now)
+
+    def record_failure(
+        self,
+        model_name: str,
+        latency: float,
+        cooldown_sec: Optional[float] = None,
+        min_consecutive: int = 1,
+    ) -> None:
+        """cooldown_sec は、続けて min_consecutive 回失敗したときだけ適用する（1回の不調では止めない）。"""
+        now = time.monotonic()
+        with self._lock:
+            self._window_locked(model_name, now).append((now, latency, False))
+            consecutive = self._consecutive.get(model_name, 0) + 1
+            self._consecutive[model_name] = consecutive
+            if cooldown_sec and consecutive >= min_consecutive:
+                self._cooldown_until[model_name] = max(
+                    self._cooldown_until.get(model_name, 0.0), now + cooldown_sec
+                )
+            self._evaluate_locked(model_name, now)
+
+    def is_available(self, model_name: str) -> bool:
+        with self._lock:
+            return time.monotonic() >= self._cooldown_until.get(model_name, 0.0)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        now = time.monotonic()
+        with self._lock:
+            out: Dict[str, Dict[str, float]] = {}
+            for model_name in set(self._samples) | set(self._cooldown_until):
+                samples = self._window_locked(model_name, now)
+                latencies = [lat for _, lat, ok in samples if ok]
+                errors = sum(1 for _, _, ok in samples if not ok)
+                out[model_name] = {
+                    "samples": len(samples),
+                    "error_rate": errors / len(samples) if samples else 0.0,
+                    "p50": _percentile(latencies, 0.5),
+                    "p95": _percentile(latencies, 0.95),
+                    "consecutive_failures": self._consecutive.get(model_name, 0),
+                    "cooldown_remaining": max(
+                        0.0, self._cooldown_until.get(model_name, 0.0) - now
+                    ),
+                }
+            return out
@@ -0,0 +1,270 @@
+"""
+過去の分析結果の履歴（SQLite）。
+
+- 1回の分析を1行で保存する（入力・モデル・MAGI 生テキスト・各エージェントの判定・SWOT・所要時間・使用量）
+- 画像・音声・テキストファイルの中身は保存せず、ハッシュと種類・サイズだけを残す
+- 日時・モデル・総合判定にインデックス、質問とサマリーに全文検索（FTS5・trigram）を張る
+  （FTS5 が使えない SQLite では LIKE 検索で代用する）
+- retention_days・max_entries・max_bytes を超えた分は、書き込み時に古いものから削除する
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Dict, List, Optional
+
+DECISIONS = ("可決", "否決", "保留")
+
+# 一覧（search）で返す列。生テキストなど大きい列は get() でだけ読む
+_LIST_COLUMNS = (
+    "id",
+    "created_at",
+    "model",
+    "answered_model",
+    "mode",
+    "enable_swot",
+    "decision",
+    "question",
+    "summary",
+)
+
+
+def tally_votes(votes: Dict[str, str]) -> str:
+    """各エージェントの判定から総合判定を決める（可決・否決の多い方。同数・判定なしは保留）。"""
+    approve = sum(1 for v in votes.values() if v == "可決")
+    reject = sum(1 for v in votes.values() if v == "否決")
+    if approve > reject:
+        return "可決"
+    if reject > approve:
+        return "否決"
+    return "保留"
+
+
+class AnalysisHistory:
+    """
+    分析履歴のストア（スレッドセーフ・全セッション共有）。
+    record() で保存し、search() で一覧を、get() で1件分の全内容を取り出す。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        retention_days: int = 180,
+        max_entries: int = 1000,
+        max_bytes: int = 64 * 1024 * 1024,
+    ):
+        self.path = path
+        self.retention_days = int(retention_days)
+        self.max_entries = int(max_entries)
+        self.max_bytes = int(max_bytes)
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS analyses (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    created_at REAL NOT NULL,
+                    session_id TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    answered_model TEXT NOT NULL,
+                    mode TEXT NOT NULL,
+                    enable_swot INTEGER NOT NULL,
+                    decision TEXT NOT NULL,
+                    question TEXT NOT NULL,
+                    summary TEXT NOT NULL,
+                    inputs TEXT NOT NULL,
+                    votes TEXT NOT NULL,
+                    swot TEXT,
+                    timings TEXT,
+                    usage TEXT,
+                    meta TEXT,
+                    raw_text BLOB NOT NULL,
+                    size INTEGER NOT NULL
+                )
+                """
+            )
+            for column in ("created_at", "model, created_at", "decision, created_at"):
+                name = "idx_analyses_" + column.replace(", ", "_")
+                self._conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON analyses({column})")
+            self.fts = self._create_fts_locked()
+
+    def _create_fts_locked(self) -> bool:
+        """質問・サマリーの全文検索用テーブル。日本語は単語に区切れないので trigram で引く。"""
+        try:
+            self._conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS analyses_fts USING fts5("
+                "question, summary, content='analyses', content_rowid='id', tokenize='trigram')"
+            )
+        except sqlite3.OperationalError:
+            return False
+        self._conn.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS analyses_fts_insert AFTER INSERT ON analyses BEGIN
+                INSERT INTO analyses_fts(rowid, question, summary)
+                VALUES (new.id, new.question, new.summary);
+            END
+            """
+        )
+        self._conn.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS analyses_fts_delete AFTER DELETE ON analyses BEGIN
+                INSERT INTO analyses_fts(analyses_fts, rowid, question, summary)
+                VALUES ('delete', old.id, old.question, old.summary);
+            END
+            """
+        )
+        return True
+
+    def record(
+        self,
+        question: str,
+        model: str,
+        answered_model: str,
+        mode: str,
+        enable_swot: bool,
+        raw_text: str,
+        votes: Dict[str, str],
+        summary: str = "",
+        swot: Optional[Dict[str, str]] = None,
+        inputs: Optional[Dict[str, Any]] = None,
+        timings: Optional[Dict[str, float]] = None,
+        usage: Optional[Dict[str, Any]] = None,
+        meta: Optional[Dict[str, Any]] = None,
+        session_id: str = "",
+    ) -> int:
+        """1回分の分析を保存して、その id を返す。"""
+        payload = zlib.compress(raw_text.encode("utf-8"))
+        row = {
+            "created_at": time.time(),
+            "session_id": session_id,
+            "model": model,
+            "answered_model": answered_model or model,
+            "mode": mode,
+            "enable_swot": int(bool(enable_swot)),
+            "decision": tally_votes(votes),
+            "question": question or "",
+            "summary": summary or "",
+            "inputs": json.dumps(inputs or {}, ensure_ascii=False),
+            "votes": json.dumps(votes, ensure_ascii=False),
+            "swot": json.dumps(swot, ensure_ascii=False) if swot is not None else None,
+            "timings": json.dumps(timings or {}, ensure_ascii=False),
+            "usage": json.dumps(usage or {}, ensure_ascii=False),
+            "meta": json.dumps(meta or {}, ensure_ascii=False),
+            "raw_text": payload,
+        }
+        row["size"] = len(payload) + sum(
+            len(row[k].encode("utf-8")) for k in ("question", "summary", "inputs", "votes", "meta")
+        )
+        with self._lock:
+            cur = self._conn.execute(
+                f"INSERT INTO analyses ({', '.join(row)}) VALUES ({', '.join(':' + k for k in row)})",
+                row,
+            )
+            entry_id = cur.lastrowid
+            self._prune_locked(row["created_at"])
+        return entry_id
+
+    def _prune_locked(self, now: float) -> None:
+        deleted = 0
+        if self.retention_days > 0:
+            deleted += self._conn.execute(
+                "DELETE FROM analyses WHERE created_at < ?", (now - self.retention_days * 86400,)
+            ).rowcount
+        if self.max_entries > 0:
+            deleted += self._conn.execute(
+                "DELETE FROM analyses WHERE id NOT IN "
+                "(SELECT id FROM analyses ORDER BY created_at DESC LIMIT ?)",
+                (self.max_entries,),
+            ).rowcount
+        if self.max_bytes > 0:
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM analyses").fetchone()[0]
+            if total > self.max_bytes:
+                for entry_id, size in self._conn.execute(
+                    "SELECT id, size FROM analyses ORDER BY created_at ASC"
+                ).fetchall():
+                    if total <= self.max_bytes:
+                        break
+                    self._conn.execute("DELETE FROM analyses WHERE id = ?", (entry_id,))
+                    total -= size
+                    deleted += 1
+        self.evictions += max(deleted, 0)
+
+    def search(
+        self,
+        query: str = "",
+        model: Optional[str] = None,
+        decision: Optional[str] = None,
+        limit: int = 50,
+    ) -> List[Dict[str, Any]]:
+        """新しい順の一覧。query は質問・サマリーの全文検索（空白区切りはすべてを含むもの）。"""
+        where: List[str] = []
+        params: List[Any] = []
+        terms = query.split()
+        if terms:
+            # trigram は3文字未満の語を引けないので、そのときは LIKE で探す
+            if self.fts and all(len(t) >= 3 for t in terms):
+                where.append(
+                    "id IN (SELECT rowid FROM analyses_fts WHERE analyses_fts MATCH ?)"
+                )
+                params.append(" AND ".join('"' + t.replace('"', '""') + '"' for t in terms))
+            else:
+                for term in terms:
+                    where.append("(question LIKE ? ESCAPE '\\' OR summary LIKE ? ESCAPE '\\')")
+                    pattern = "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+                    params += [pattern, pattern]
+        if model:
+            where.append("model = ?")
+            params.append(model)
+        if decision:
+            where.append("decision = ?")
+            params.append(decision)
+        sql = (
+            f"SELECT {', '.join(_LIST_COLUMNS)} FROM analyses"
+            + (" WHERE " + " AND ".join(where) if where else "")
+            + " ORDER BY created_at DESC LIMIT ?"
+        )
+        with self._lock:
+            rows = self._conn.execute(sql, params + [int(limit)]).fetchall()
+        return [dict(zip(_LIST_COLUMNS, row)) for row in rows]
+
+    def get(self, entry_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            cur = self._conn.execute("SELECT * FROM analyses WHERE id = ?", (int(entry_id),))
+            row = cur.fetchone()
+            columns = [d[0] for d in cur.description]
+        if row is None:
+            return None
+        entry = dict(zip(columns, row))
+        entry["raw_text"] = zlib.decompress(entry["raw_text"]).decode("utf-8")
+        entry["enable_swot"] = bool(entry["enable_swot"])
+        for key in ("inputs", "votes", "swot", "timings", "usage", "meta"):
+            entry[key] = json.loads(entry[key]) if entry[key] else None
+        return entry
+
+    def models(self) -> List[str]:
+        with self._lock:
+            rows = self._conn.execute("SELECT DISTINCT model FROM analyses ORDER BY model").fetchall()
+        return [row[0] for row in rows]
+
+    def delete(self, entry_id: int) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM analyses WHERE id = ?", (int(entry_id),))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM analyses")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM analyses"
+            ).fetchone()
+        return {"entries": entries, "bytes": total, "evictions": self.evictions, "fts": self.fts}
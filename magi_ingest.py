@@ -0,0 +1,228 @@
+"""
+テキストファイル（.txt）アップロードの取り込み。
+
+- 少しずつ読みながら文字コードを判定・デコードし（UTF-8 → CP932（Shift_JIS を含む）の順に試す）、
+  UTF-8 に変換して一時ファイルへ書き出す（本文をメモリや session_state に置かない）
+- バイト数の上限を超えた分は読まない
+- プロンプトには head() で必要な先頭部分だけ、要約には iter_blocks() で少しずつ渡す
+- TextSpool: アップロード内容のハッシュごとに一時ファイルを使い回す（件数上限つき LRU。
+  セッションやジョブがまだ持っているファイルは消さない）
+"""
+import atexit
+import codecs
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+READ_BLOCK_BYTES = 64 * 1024
+
+# BOM 付きならその文字コードで確定。BOM が無ければ ENCODING_CANDIDATES を順に厳密デコードで試す
+_BOMS: List[Tuple[bytes, str]] = [
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+ENCODING_CANDIDATES = ("utf-8", "cp932")
+
+
+@dataclass(frozen=True)
+class IngestedText:
+    """一時ファイルに UTF-8 で書き出したアップロード本文。"""
+
+    path: str
+    encoding: str
+    digest: str
+    bytes_read: int
+    total_bytes: int
+    chars: int
+    truncated: bool
+    # どの候補でも厳密にデコードできず、置換文字（U+FFFD）で補った場合 True
+    lossy: bool = False
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def head(self, max_chars: int) -> str:
+        """
+        先頭 max_chars 文字だけを読む。一時ファイルが消えていれば OSError
+        （空文字を返すと、添付ファイル抜きで分析したことに気付けない）。
+        """
+        with open(self.path, "r", encoding="utf-8") as f:
+            return f.read(max(0, int(max_chars)))
+
+    def iter_blocks(self, block_chars: int = 16 * 1024) -> Iterator[str]:
+        """block_chars 文字ずつ読む。一時ファイルが消えていれば OSError。"""
+        with open(self.path, "r", encoding="utf-8") as f:
+            while True:
+                block = f.read(block_chars)
+                if not block:
+                    return
+                yield block
+
+
+def _read_capped(stream: BinaryIO, max_bytes: int) -> Iterator[bytes]:
+    remaining = max_bytes
+    while remaining > 0:
+        block = stream.read(min(READ_BLOCK_BYTES, remaining))
+        if not block:
+            return
+        remaining -= len(block)
+        yield block
+
+
+def _hash_stream(stream: BinaryIO, max_bytes: int) -> Tuple[str, int, int]:
+    """(上限までの内容の sha256, 読んだバイト数, 全体のバイト数) を返す。"""
+    digest = hashlib.sha256()
+    read = 0
+    for block in _read_capped(stream, max_bytes):
+        digest.update(block)
+        read += len(block)
+    total = read
+    # 上限を超えた分は読み捨てて大きさだけ数える
+    while True:
+        block = stream.read(READ_BLOCK_BYTES)
+        if not block:
+            break
+        total += len(block)
+    return digest.hexdigest(), read, total
+
+
+def _sniff_bom(stream: BinaryIO) -> Optional[str]:
+    stream.seek(0)
+    head = stream.read(4)
+    stream.seek(0)
+    for bom, encoding in _BOMS:
+        if head.startswith(bom):
+            return encoding
+    return None
+
+
+def _decode_to_file(
+    stream: BinaryIO, encoding: str, max_bytes: int, truncated: bool, out_path: str, errors: str
+) -> int:
+    """stream を encoding でデコードして out_path に UTF-8 で書き、文字数を返す。"""
+    stream.seek(0)
+    decoder = codecs.getincrementaldecoder(encoding)(errors=errors)
+    chars = 0
+    with open(out_path, "w", encoding="utf-8", newline="") as out:
+        for block in _read_capped(stream, max_bytes):
+            text = decoder.decode(block)
+            out.write(text)
+            chars += len(text)
+        # 上限で切った場合、末尾の書きかけの文字は捨てる
+        if not truncated:
+            text = decoder.decode(b"", final=True)
+            out.write(text)
+            chars += len(text)
+    return chars
+
+
+def ingest_text_stream(stream: BinaryIO, out_path: str, max_bytes: int) -> IngestedText:
+    """
+    stream（シーク可能なバイナリ）を max_bytes まで取り込み、out_path に UTF-8 で書き出す。
+    同時にメモリに載るのは READ_BLOCK_BYTES 程度まで。
+    """
+    stream.seek(0)
+    digest, read, total = _hash_stream(stream, max_bytes)
+    truncated = total > read
+    bom = _sniff_bom(stream)
+    candidates = (bom,) if bom else ENCODING_CANDIDATES
+    for encoding in candidates:
+        try:
+            chars = _decode_to_file(stream, encoding, max_bytes, truncated, out_path, "strict")
+            return IngestedText(out_path, encoding, digest, read, total, chars, truncated)
+        except UnicodeDecodeError:
+            continue
+    encoding = candidates[0]
+    chars = _decode_to_file(stream, encoding, max_bytes, truncated, out_path, "replace")
+    return IngestedText(out_path, encoding, digest, read, total, chars, truncated, lossy=True)
+
+
+class TextSpool:
+    """
+    取り込んだテキストを一時ディレクトリに置き、内容のハッシュごとに使い回す（スレッドセーフ）。
+    同じ内容には同じ IngestedText を返し、それを誰か（セッション・ジョブ）が持っている間は使用中とみなす。
+    max_files を超えたら、使用中でないものを古い順に消す（すべて使用中なら上限を一時的に超える）。
+    プロセス終了時にディレクトリごと消す。
+    """
+
+    def __init__(self, max_bytes: int = 20 * 1024 * 1024, max_files: int = 32, directory: str = ""):
+        self.max_bytes = max(1, int(max_bytes))
+        self.max_files = max(1, int(max_files))
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.directory = tempfile.mkdtemp(prefix="magi-text-", dir=directory or None)
+        self._files: "OrderedDict[str, IngestedText]" = OrderedDict()
+        # 配った IngestedText（弱参照）。ここに残っている間は使用中
+        self._handles: "weakref.WeakValueDictionary[str, IngestedText]" = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        atexit.register(shutil.rmtree, self.directory, True)
+
+    def ingest(self, stream: BinaryIO) -> IngestedText:
+        stream.seek(0)
+        digest, _, _ = _hash_stream(stream, self.max_bytes)
+        with self._lock:
+            existing = self._files.get(digest)
+            if existing is not None and existing.exists():
+                self._files.move_to_end(digest)
+                self.hits += 1
+                return self._handle_locked(digest, existing)
+            self.misses += 1
+
+        path = os.path.join(self.directory, f"{digest}.txt")
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            ingested = ingest_text_stream(stream, tmp, self.max_bytes)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        ingested = replace(ingested, path=path)
+
+        with self._lock:
+            self._files[digest] = ingested
+            self._files.move_to_end(digest)
+            # 消えたファイルの古い持ち主とは別の、新しい IngestedText を配る
+            self._handles.pop(digest, None)
+            handle = self._handle_locked(digest, ingested)
+            self._evict_locked()
+        return handle
+
+    def _handle_locked(self, digest: str, ingested: IngestedText) -> IngestedText:
+        handle = self._handles.get(digest)
+        if handle is None:
+            # 記録用とは別のオブジェクトを配り、その生存で使用中かどうかを見る
+            handle = replace(ingested)
+            self._handles[digest] = handle
+        return handle
+
+    def _evict_locked(self) -> None:
+        excess = len(self._files) - self.max_files
+        for digest in list(self._files):
+            if excess <= 0:
+                return
+            if digest in self._handles:
+                continue
+            evicted = self._files.pop(digest)
+            excess -= 1
+            if os.path.exists(evicted.path):
+                os.remove(evicted.path)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            files = list(self._files.values())
+            return {
+                "files": len(files),
+                "bytes": sum(f.bytes_read for f in files),
+                "in_use": sum(1 for digest in self._files if digest in self._handles),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,379 @@
+"""
+分析をバックグラウンドで実行するジョブキュー（ローカルのワーカースレッド＋SQLite のジョブ表）。
+
+- submit() した処理はワーカースレッドで実行し、状態・進捗・結果をジョブ表に書く
+  （画面の再実行・ブラウザの再読み込み・別セッションからでも、ジョブ ID で結果を取り出せる）
+- cancel() で取り消せる。実行中のジョブは、処理が check_cancelled() を呼んだところで止まる
+- ジョブごとの制限時間を超えたら timeout として打ち切る（扱いは取り消しと同じ）
+- 処理そのものは保存できないので、止まったプロセスが終わらせられなかったジョブは error にする。
+  ジョブ表は複数のプロセスで共有できるので、ジョブには投入したインスタンス（owner）を記録し、
+  ハートビートが途絶えたインスタンスのジョブだけを片付ける（動いている他のプロセスのジョブには触れない）
+- ジョブ表に保存する結果は submit(persist=...) で JSON にできる値に変換する（変換は呼び出し側が決める）。
+  JSON にできない値が残っていたら黙って捨てずに、結果を保存しなかったことを error 欄に残す
+"""
+import contextvars
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_ERROR = "error"
+STATUS_CANCELLED = "cancelled"
+STATUS_TIMEOUT = "timeout"
+ACTIVE_STATUSES = (STATUS_QUEUED, STATUS_RUNNING)
+FINISHED_STATUSES = (STATUS_DONE, STATUS_ERROR, STATUS_CANCELLED, STATUS_TIMEOUT)
+
+_COLUMNS = (
+    "id",
+    "session_id",
+    "label",
+    "status",
+    "created_at",
+    "started_at",
+    "finished_at",
+    "timeout_sec",
+    "progress",
+    "partial",
+    "error",
+)
+
+
+class JobCancelled(Exception):
+    """ジョブが取り消された（または制限時間を超えた）ことを表す。"""
+
+    def __init__(self, job_id: str, status: str = STATUS_CANCELLED):
+        super().__init__(f"job {job_id} {status}")
+        self.job_id = job_id
+        self.status = status
+
+
+class Job:
+    """実行中の処理から見たジョブ（進捗の報告と、取り消しの確認に使う）。"""
+
+    def __init__(self, queue: "JobQueue", job_id: str, timeout_sec: float):
+        self.queue = queue
+        self.id = job_id
+        self.timeout_sec = timeout_sec
+        self.deadline = 0.0
+        self.cancel_event = threading.Event()
+
+    def check_cancelled(self) -> None:
+        if self.cancel_event.is_set():
+            raise JobCancelled(self.id)
+        if self.deadline and time.monotonic() > self.deadline:
+            raise JobCancelled(self.id, STATUS_TIMEOUT)
+
+    def progress(self, message: str, partial: Any = None) -> None:
+        """進捗メッセージ（と、途中経過として見せる JSON にできる値）をジョブ表に書く。"""
+        self.queue._update_progress(self.id, message, partial)
+
+
+_current_job: contextvars.ContextVar[Optional[Job]] = contextvars.ContextVar(
+    "magi_current_job", default=None
+)
+
+
+def current_job() -> Optional[Job]:
+    return _current_job.get()
+
+
+def check_cancelled() -> None:
+    """ジョブの中から呼ばれたときだけ、取り消し・時間切れなら JobCancelled を投げる。"""
+    job = _current_job.get()
+    if job is not None:
+        job.check_cancelled()
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    # 画像や一時ファイルなどを黙って null にすると、別のプロセスで読んだ結果が気付かれずに欠ける
+    raise TypeError(f"{type(value).__name__} は JSON にできません")
+
+
+class JobQueue:
+    """
+    ジョブの投入・状態の取得・取り消し（スレッドセーフ・全セッション共有）。
+    結果は JSON にしてジョブ表に保存し、同じプロセスでは直近 memory_results 件の元の値もメモリに残す。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        workers: int = 2,
+        timeout_sec: float = 300.0,
+        retention_days: float = 7.0,
+        memory_results: int = 32,
+        heartbeat_sec: float = 30.0,
+    ):
+        self.path = path
+        # ジョブ表を共有する他のプロセスと区別するための、このインスタンスの ID
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.heartbeat_sec = max(1.0, float(heartbeat_sec))
+        self.timeout_sec = float(timeout_sec)
+        self.retention_days = float(retention_days)
+        self.memory_results = int(memory_results)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, int(workers)), thread_name_prefix="magi-job")
+        self._lock = threading.Lock()
+        self._jobs: Dict[str, Job] = {}
+        self._persist: Dict[str, Callable[[Any], Any]] = {}
+        self._values: "OrderedDict[str, Any]" = OrderedDict()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    session_id TEXT NOT NULL,
+                    label TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    timeout_sec REAL NOT NULL,
+                    progress TEXT NOT NULL DEFAULT '',
+                    partial TEXT,
+                    error TEXT,
+                    result BLOB
+                )
+                """
+            )
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            if "owner" not in columns:
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_jobs_session ON jobs(session_id, created_at)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_owners (owner TEXT PRIMARY KEY, heartbeat REAL NOT NULL)"
+            )
+            self._heartbeat_locked(time.time())
+        self._heartbeat_thread = threading.Thread(
+            target=self._heartbeat_loop, name="magi-job-heartbeat", daemon=True
+        )
+        self._heartbeat_thread.start()
+
+    # --------------------------------------------------
+    # インスタンスの生存確認
+    # --------------------------------------------------
+    def _heartbeat_locked(self, now: float) -> None:
+        """
+        このインスタンスのハートビートを書き、ハートビートが途絶えたインスタンス
+        （heartbeat_sec の3倍より古い。owner の無い旧形式の行も含む）の未完了ジョブを error にする。
+        """
+        self._conn.execute(
+            "INSERT OR REPLACE INTO job_owners (owner, heartbeat) VALUES (?, ?)", (self.owner, now)
+        )
+        stale_before = now - self.heartbeat_sec * 3
+        # 止まったプロセスで終わらなかったジョブは、続きを実行できない
+        self._conn.execute(
+            "UPDATE jobs SET status = ?, error = ?, finished_at = ?"
+            " WHERE status IN (?, ?)"
+            " AND (owner IS NULL OR owner NOT IN (SELECT owner FROM job_owners WHERE heartbeat >= ?))",
+            (STATUS_ERROR, "サーバーの停止・再起動で中断されました。", now, *ACTIVE_STATUSES, stale_before),
+        )
+        self._conn.execute("DELETE FROM job_owners WHERE heartbeat < ?", (stale_before,))
+
+    def _heartbeat_loop(self) -> None:
+        while True:
+            time.sleep(self.heartbeat_sec)
+            try:
+                with self._lock:
+                    self._heartbeat_locked(time.time())
+            except sqlite3.Error:
+                # ロック待ちなどで書けなかったときは、次の周期で書き直す
+                continue
+
+    # --------------------------------------------------
+    # 投入と実行
+    # --------------------------------------------------
+    def submit(
+        self,
+        fn: Callable[[Job], Any],
+        session_id: str = "",
+        label: str = "",
+        timeout_sec: Optional[float] = None,
+        persist: Optional[Callable[[Any], Any]] = None,
+    ) -> str:
+        """
+        fn(job) をワーカーで実行するジョブを作り、その ID を返す。呼び出し元のコンテキストを引き継ぐ。
+        persist(戻り値) があれば、その値（JSON にできるもの）をジョブ表に保存する（省略時は戻り値そのもの）。
+        """
+        job_id = uuid.uuid4().hex[:12]
+        job = Job(self, job_id, self.timeout_sec if timeout_sec is None else float(timeout_sec))
+        now = time.time()
+        with self._lock:
+            self._prune_locked(now)
+            self._conn.execute(
+                "INSERT INTO jobs (id, session_id, label, status, created_at, timeout_sec, owner)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, session_id, label, STATUS_QUEUED, now, job.timeout_sec, self.owner),
+            )
+            self._jobs[job_id] = job
+            if persist is not None:
+                self._persist[job_id] = persist
+        ctx = contextvars.copy_context()
+        self._executor.submit(ctx.run, self._run, job, fn)
+        return job_id
+
+    def _run(self, job: Job, fn: Callable[[Job], Any]) -> None:
+        with self._lock:
+            # 待っている間に取り消されたものは実行しない
+            started = self._conn.execute(
+                "UPDATE jobs SET status = ?, started_at = ? WHERE id = ? AND status = ?",
+                (STATUS_RUNNING, time.time(), job.id, STATUS_QUEUED),
+            ).rowcount
+        if not started:
+            self._forget(job.id)
+            return
+        if job.timeout_sec > 0:
+            job.deadline = time.monotonic() + job.timeout_sec
+        _current_job.set(job)
+        try:
+            value = fn(job)
+            job.check_cancelled()
+        except JobCancelled as e:
+            self._finish(job.id, e.status, error="")
+        except Exception as e:
+            self._finish(job.id, STATUS_ERROR, error=f"{type(e).__name__}: {e}")
+        else:
+            self._finish(job.id, STATUS_DONE, value=value)
+        finally:
+            self._forget(job.id)
+
+    def _finish(self, job_id: str, status: str, value: Any = None, error: str = "") -> None:
+        payload = None
+        if status == STATUS_DONE:
+            with self._lock:
+                persist = self._persist.get(job_id)
+            try:
+                stored = persist(value) if persist is not None else value
+                payload = zlib.compress(json.dumps(stored, ensure_ascii=False, default=_json_default).encode("utf-8"))
+            except (TypeError, ValueError) as e:
+                # 完了は完了として記録し、別のプロセスからは結果を読めないことを残す
+                error = f"結果をジョブ表に保存できませんでした: {e}"
+        with self._lock:
+            # 取り消し・時間切れで先に終わらせたジョブの結果は捨てる
+            updated = self._conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, error = ?, result = ?, partial = NULL"
+                " WHERE id = ? AND status = ?",
+                (status, time.time(), error or None, payload, job_id, STATUS_RUNNING),
+            ).rowcount
+            if updated and status == STATUS_DONE:
+                self._values[job_id] = value
+                while len(self._values) > self.memory_results:
+                    self._values.popitem(last=False)
+
+    def _forget(self, job_id: str) -> None:
+        with self._lock:
+            self._jobs.pop(job_id, None)
+            self._persist.pop(job_id, None)
+
+    def _update_progress(self, job_id: str, message: str, partial: Any) -> None:
+        encoded = json.dumps(partial, ensure_ascii=False, default=_json_default) if partial is not None else None
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET progress = ?, partial = COALESCE(?, partial) WHERE id = ? AND status = ?",
+                (message, encoded, job_id, STATUS_RUNNING),
+            )
+
+    # --------------------------------------------------
+    # 取り消し・時間切れ
+    # --------------------------------------------------
+    def cancel(self, job_id: str) -> bool:
+        """待ち・実行中のジョブを取り消す。取り消せたら True。"""
+        return self._stop(job_id, STATUS_CANCELLED)
+
+    def _stop(self, job_id: str, status: str) -> bool:
+        with self._lock:
+            stopped = self._conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, partial = NULL WHERE id = ? AND status IN (?, ?)",
+                (status, time.time(), job_id, *ACTIVE_STATUSES),
+            ).rowcount
+            job = self._jobs.get(job_id)
+        if job is not None:
+            job.cancel_event.set()
+        return bool(stopped)
+
+    def _expire(self, entry: Dict[str, Any]) -> Dict[str, Any]:
+        # 処理が check_cancelled() を呼ぶまで待たずに、読んだ時点で時間切れにする
+        if (
+            entry["status"] == STATUS_RUNNING
+            and entry["timeout_sec"] > 0
+            and time.time() - entry["started_at"] > entry["timeout_sec"]
+            and self._stop(entry["id"], STATUS_TIMEOUT)
+        ):
+            entry["status"] = STATUS_TIMEOUT
+            entry["partial"] = None
+        return entry
+
+    # --------------------------------------------------
+    # 参照
+    # --------------------------------------------------
+    def get(self, job_id: str, with_result: bool = True) -> Optional[Dict[str, Any]]:
+        """
+        ジョブの状態。done なら "result" に結果（同じプロセスではメモリ上の元の値、
+        それ以外では persist で保存した値。保存できなかったときは None で、理由は "error"）を入れる。
+        """
+        columns = _COLUMNS + ("result",) if with_result else _COLUMNS
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {', '.join(columns)} FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            value = self._values.get(job_id)
+        if row is None:
+            return None
+        entry = self._expire(dict(zip(columns, row)))
+        entry["partial"] = json.loads(entry["partial"]) if entry["partial"] else None
+        if with_result:
+            payload = entry.pop("result")
+            entry["in_memory"] = value is not None
+            if value is None and payload is not None:
+                value = json.loads(zlib.decompress(payload).decode("utf-8"))
+            entry["result"] = value
+        return entry
+
+    def recent(self, session_id: Optional[str] = None, limit: int = 20) -> List[Dict[str, Any]]:
+        """新しい順のジョブ一覧（結果・途中経過は含めない）。"""
+        columns = tuple(c for c in _COLUMNS if c != "partial")
+        sql = f"SELECT {', '.join(columns)} FROM jobs"
+        params: List[Any] = []
+        if session_id is not None:
+            sql += " WHERE session_id = ?"
+            params.append(session_id)
+        with self._lock:
+            rows = self._conn.execute(sql + " ORDER BY created_at DESC LIMIT ?", params + [int(limit)]).fetchall()
+        entries = []
+        for row in rows:
+            entry = dict(zip(columns, row), partial=None)
+            entries.append(self._expire(entry))
+        return entries
+
+    def _prune_locked(self, now: float) -> None:
+        if self.retention_days > 0:
+            self._conn.execute(
+                f"DELETE FROM jobs WHERE created_at < ? AND status NOT IN ({', '.join('?' * len(ACTIVE_STATUSES))})",
+                (now - self.retention_days * 86400, *ACTIVE_STATUSES),
+            )
+
+    def stats(self) -> Dict[str, int]:
+        """状態ごとのジョブ数（保存期間内の全セッション分）。"""
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        counts = {status: 0 for status in ACTIVE_STATUSES + FINISHED_STATUSES}
+        counts.update(dict(rows))
+        return counts
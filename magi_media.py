@@ -0,0 +1,137 @@
+"""
+アップロード画像の前処理（EXIF の向き補正・長辺の縮小・JPEG / WebP への再エンコード）。
+
+Gemini に送る画像と Word レポートに埋め込む画像で、別々のプロファイル（ImageProfile）を使う。
+エンコード結果はアップロードのハッシュ＋プロファイルごとに EncodedImageCache に保持する。
+"""
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+# python-docx が埋め込める形式（WebP は不可）
+DOCX_IMAGE_FORMATS = ("JPEG", "PNG")
+
+_MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+
+@dataclass(frozen=True)
+class ImageProfile:
+    """max_edge: 長辺の上限（px, 0 なら縮小しない） / fmt: JPEG・WEBP・PNG / quality: 1〜100"""
+
+    max_edge: int = 1536
+    fmt: str = "JPEG"
+    quality: int = 85
+
+    @property
+    def signature(self) -> str:
+        return f"{self.fmt.upper()}-{self.max_edge}-q{self.quality}"
+
+
+@dataclass(frozen=True)
+class EncodedImage:
+    data: bytes
+    mime_type: str
+    size: Tuple[int, int]
+    original_bytes: int
+    original_size: Tuple[int, int]
+
+    def as_blob(self) -> Dict[str, Any]:
+        """generate_content にそのまま渡せる形。"""
+        return {"mime_type": self.mime_type, "data": self.data}
+
+
+def load_image(data: bytes) -> Image.Image:
+    """EXIF の向きを反映した RGB 画像を返す（カメラ写真が横倒しにならないように）。"""
+    with Image.open(io.BytesIO(data)) as img:
+        return ImageOps.exif_transpose(img).convert("RGB")
+
+
+def encode_image(image: Image.Image, profile: ImageProfile, original_bytes: int = 0) -> EncodedImage:
+    fmt = profile.fmt.upper()
+    if fmt not in _MIME_TYPES:
+        fmt = "JPEG"
+    resized = image
+    if profile.max_edge and max(image.size) > profile.max_edge:
+        resized = image.copy()
+        resized.thumbnail((profile.max_edge, profile.max_edge), Image.LANCZOS)
+
+    buf = io.BytesIO()
+    if fmt == "PNG":
+        resized.save(buf, format="PNG", optimize=True)
+    elif fmt == "WEBP":
+        resized.save(buf, format="WEBP", quality=profile.quality, method=4)
+    else:
+        resized.save(buf, format="JPEG", quality=profile.quality, optimize=True, progressive=True)
+    return EncodedImage(
+        data=buf.getvalue(),
+        mime_type=_MIME_TYPES[fmt],
+        size=resized.size,
+        original_bytes=original_bytes,
+        original_size=image.size,
+    )
+
+
+def prepare_image(data: bytes, profile: ImageProfile) -> EncodedImage:
+    return encode_image(load_image(data), profile, original_bytes=len(data))
+
+
+class EncodedImageCache:
+    """エンコード済み画像の LRU（合計バイト数の上限つき・スレッドセーフ）。"""
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max(1, int(max_bytes))
+        self._data: "OrderedDict[str, EncodedImage]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(data: bytes, profile: ImageProfile) -> str:
+        return f"{profile.signature}|{hashlib.sha256(data).hexdigest()}"
+
+    def get(self, key: str) -> Optional[EncodedImage]:
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: EncodedImage) -> None:
+        if len(value.data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old.data)
+            self._data[key] = value
+            self._bytes += len(value.data)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self._bytes -= len(evicted.data)
+
+    def get_or_prepare(self, data: bytes, profile: ImageProfile) -> EncodedImage:
+        key = self.key(data, profile)
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        value = prepare_image(data, profile)
+        self.put(key, value)
+        return value
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,171 @@
+"""
+処理段階ごとの所要時間の計測（スパン）と、プロセス全体で集計したヒストグラムの出力。
+
+- MetricsRegistry.span(stage, model): with ブロックの所要時間を (stage, model, status) ごとに集計する
+- start_trace() / collect_trace(): その実行（1回の MAGI 分析）で記録されたスパンの一覧を受け取る
+- prometheus_text() / jsonl_text(): 集計結果を Prometheus テキスト形式・JSON Lines で出力する
+"""
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# 実行中の MAGI 分析1回ぶんのスパン一覧（スレッドをまたぐときは contextvars.copy_context で引き継ぐ）
+_current_trace: contextvars.ContextVar[Optional[List[Dict[str, Any]]]] = contextvars.ContextVar(
+    "magi_current_trace", default=None
+)
+
+
+def start_trace() -> List[Dict[str, Any]]:
+    """現在のコンテキストで新しいスパン一覧を開始し、それを返す（Streamlit の1回の実行用）。"""
+    trace: List[Dict[str, Any]] = []
+    _current_trace.set(trace)
+    return trace
+
+
+@contextmanager
+def collect_trace() -> Iterator[List[Dict[str, Any]]]:
+    trace: List[Dict[str, Any]] = []
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))]
+
+
+class _Histogram:
+    def __init__(self, buckets: Tuple[float, ...], recent: int):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+        # p50 / p95 は直近 recent 件から求める
+        self.recent: Deque[float] = deque(maxlen=recent)
+
+    def observe(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.recent.append(seconds)
+        for index, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[index] += 1
+
+
+class MetricsRegistry:
+    """
+    (stage, model, status) ごとの所要時間ヒストグラム（全セッション共有・スレッドセーフ）。
+    status は "ok" / "error"。
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, recent: int = 1000):
+        self.buckets = tuple(sorted(buckets))
+        self.recent = int(recent)
+        self._hists: Dict[Tuple[str, str, str], _Histogram] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float, model: str = "", status: str = "ok") -> None:
+        key = (stage, model or "", status)
+        with self._lock:
+            hist = self._hists.get(key)
+            if hist is None:
+                hist = self._hists[key] = _Histogram(self.buckets, self.recent)
+            hist.observe(seconds)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.append({"stage": stage, "model": model or "", "status": status, "sec": seconds})
+
+    @contextmanager
+    def span(self, stage: str, model: str = "") -> Iterator[Dict[str, str]]:
+        """
+        with ブロックの所要時間を記録する。例外なら status="error"。
+        戻り値の dict の "status" を書き換えると、例外以外の失敗（【エラー】〜 など）も記録できる。
+        """
+        state = {"status": "ok"}
+        t0 = time.perf_counter()
+        try:
+            yield state
+        except BaseException:
+            state["status"] = "error"
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - t0, model, state["status"])
+
+    def summary(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = [
+                {
+                    "stage": stage,
+                    "model": model,
+                    "status": status,
+                    "count": hist.count,
+                    "mean": hist.total / hist.count if hist.count else 0.0,
+                    "p50": _percentile(list(hist.recent), 0.5),
+                    "p95": _percentile(list(hist.recent), 0.95),
+                }
+                for (stage, model, status), hist in self._hists.items()
+            ]
+        return sorted(rows, key=lambda r: (r["stage"], r["model"], r["status"]))
+
+    def prometheus_text(self, name: str = "magi_stage_duration_seconds") -> str:
+        lines = [
+            f"# HELP {name} MAGI の処理段階ごとの所要時間（秒）",
+            f"# TYPE {name} histogram",
+        ]
+        with self._lock:
+            items = sorted(self._hists.items())
+            for (stage, model, status), hist in items:
+                labels = f'stage="{stage}",model="{model}",status="{status}"'
+                for bound, count in zip(hist.buckets, hist.counts):
+                    lines.append(f'{name}_bucket{{{labels},le="{bound:g}"}} {count}')
+                lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {hist.count}')
+                lines.append(f"{name}_sum{{{labels}}} {hist.total:.6f}")
+                lines.append(f"{name}_count{{{labels}}} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+    def jsonl_text(self) -> str:
+        now = time.time()
+        with self._lock:
+            rows = [
+                {
+                    "ts": now,
+                    "stage": stage,
+                    "model": model,
+                    "status": status,
+                    "count": hist.count,
+                    "sum": round(hist.total, 6),
+                    "p50": round(_percentile(list(hist.recent), 0.5), 6),
+                    "p95": round(_percentile(list(hist.recent), 0.95), 6),
+                    "buckets": {f"{b:g}": c for b, c in zip(hist.buckets, hist.counts)},
+                }
+                for (stage, model, status), hist in sorted(self._hists.items())
+            ]
+        return "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
+
+    def export(self, path: str) -> None:
+        """
+        .jsonl なら JSON Lines を追記、それ以外は Prometheus テキスト形式で置き換える
+        （node_exporter の textfile collector で読めるよう、一時ファイル経由で差し替える）。
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        if path.endswith(".jsonl"):
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(self.jsonl_text())
+            return
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp, path)
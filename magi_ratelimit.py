@@ -0,0 +1,216 @@
+"""
+Gemini 呼び出しのクライアント側レート制御。
+
+- TokenBucket: 1分あたりの量（リクエスト数・トークン数）を平準化するトークンバケット
+- RateLimiter: モデルごとに RPM / TPM のバケットを持ち、呼び出し前に必要なだけ待機する
+- quota_category / parse_retry_delay / backoff_delay:
+  ResourceExhausted のメッセージから「待てば回復するか」を判定し、再試行間隔を決める
+"""
+import random
+import re
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+# 待てば回復する（再試行してよい）カテゴリ
+RETRYABLE_CATEGORIES = ("rate", "transient")
+
+
+def quota_category(message: str) -> str:
+    """
+    ResourceExhausted のメッセージを分類する。
+    - "zero":      free tier が 0（待っても回復しない）
+    - "rate":      分単位のレートリミット
+    - "daily":     日次／総量クォータ（当日中は回復しない）
+    - "transient": モデル側の一時的な混雑
+    - "other":     判別不能
+    """
+    msg = message or ""
+    low = msg.lower()
+
+    if "limit: 0" in msg:
+        return "zero"
+
+    is_per_minute = ("PerMinute" in msg) or ("per minute" in low)
+    is_per_day = ("PerDay" in msg) or ("per day" in low)
+
+    if "rate limit" in low or "too many requests" in low or (is_per_minute and not is_per_day):
+        return "rate"
+    if is_per_day:
+        return "daily"
+    if "exhausted" in low or "resources exhausted" in low:
+        return "transient"
+    return "other"
+
+
+_RETRY_DELAY_PATTERNS = [
+    re.compile(r"retry_delay\s*\{\s*seconds:\s*(\d+(?:\.\d+)?)"),
+    re.compile(r"retry in\s+(\d+(?:\.\d+)?)\s*s", re.IGNORECASE),
+    re.compile(r"retryDelay[\"']?\s*:\s*[\"']?(\d+(?:\.\d+)?)s"),
+]
+
+
+def parse_retry_delay(message: str) -> Optional[float]:
+    """API が返した再試行までの待ち時間（秒）があれば取り出す。"""
+    for pattern in _RETRY_DELAY_PATTERNS:
+        m = pattern.search(message or "")
+        if m:
+            return float(m.group(1))
+    return None
+
+
+def backoff_delay(
+    attempt: int,
+    base: float = 1.0,
+    cap: float = 30.0,
+    retry_after: Optional[float] = None,
+    rng: Callable[[float, float], float] = random.uniform,
+) -> float:
+    """
+    フルジッター付きの指数バックオフ。
+    API から retry_after が指定されていれば、それより短くは待たない。
+    """
+    delay = rng(0.0, min(cap, base * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, retry_after + rng(0.0, 0.5))
+    return delay
+
+
+class TokenBucket:
+    """
+    per_minute の量が1分かけて均等に補充されるバケット（容量は1分ぶん）。
+    reserve() は残量をマイナスまで先取りし、補充されるまでの待ち時間を返す
+    （先に予約した呼び出しから順に通る）。
+    """
+
+    def __init__(self, per_minute: float):
+        self.per_minute = float(per_minute)
+        self.rate = self.per_minute / 60.0
+        self.capacity = self.per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill_locked(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float = 1.0) -> float:
+        # 容量を超える要求は、容量ぶんとして扱う（永久に待たないように）
+        amount = min(float(amount), self.capacity)
+        with self._lock:
+            self._refill_locked()
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def refund(self, amount: float = 1.0) -> None:
+        amount = min(float(amount), self.capacity)
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    def pause(self, seconds: float) -> None:
+        """
+        サーバ側でレートリミットを受けたとき、seconds 秒は新規の呼び出しを通さない
+        （seconds 秒後にちょうど1件ぶん補充されている状態にする）。
+        """
+        with self._lock:
+            self._refill_locked()
+            self.tokens = min(self.tokens, 1.0 - seconds * self.rate)
+
+
+class RateLimitWaitTooLong(Exception):
+    """待機時間が上限を超えるため、呼び出しを諦めたことを表す。"""
+
+    def __init__(self, model_name: str, wait_sec: float):
+        super().__init__(
+            f"client-side rate limit per minute for {model_name}: "
+            f"would need to wait {wait_sec:.1f}s"
+        )
+        self.model_name = model_name
+        self.wait_sec = wait_sec
+
+
+class RateLimiter:
+    """
+    モデルごとに RPM（リクエスト/分）と TPM（トークン/分）のバケットを持つ。
+    limits_for(model_name) -> (rpm, tpm) で上限を決める（0 以下ならその軸は制限しない）。
+    """
+
+    def __init__(
+        self,
+        limits_for: Callable[[str], Tuple[float, float]],
+        max_wait_sec: float = 60.0,
+    ):
+        self._limits_for = limits_for
+        self.max_wait_sec = float(max_wait_sec)
+        self._buckets: Dict[str, Tuple[Optional[TokenBucket], Optional[TokenBucket]]] = {}
+        self._lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, float]] = {}
+
+    def _buckets_for(self, model_name: str) -> Tuple[Optional[TokenBucket], Optional[TokenBucket]]:
+        with self._lock:
+            if model_name not in self._buckets:
+                rpm, tpm = self._limits_for(model_name)
+                self._buckets[model_name] = (
+                    TokenBucket(rpm) if rpm and rpm > 0 else None,
+                    TokenBucket(tpm) if tpm and tpm > 0 else None,
+                )
+                self._stats[model_name] = {
+                    "calls": 0,
+                    "throttled": 0,
+                    "wait_sec": 0.0,
+                    "retries": 0,
+                    "rejected": 0,
+                }
+            return self._buckets[model_name]
+
+    def acquire(self, model_name: str, tokens: float = 0.0, max_wait_sec: Optional[float] = None) -> float:
+        """
+        1リクエスト＋tokens ぶんを予約し、必要なら待機する。待った秒数を返す。
+        待ち時間が max_wait_sec（省略時はコンストラクタの値）を超える場合は
+        予約を取り消して RateLimitWaitTooLong を投げる。
+        """
+        limit = self.max_wait_sec if max_wait_sec is None else float(max_wait_sec)
+        rpm_bucket, tpm_bucket = self._buckets_for(model_name)
+        wait = 0.0
+        if rpm_bucket is not None:
+            wait = max(wait, rpm_bucket.reserve(1))
+        if tpm_bucket is not None and tokens > 0:
+            wait = max(wait, tpm_bucket.reserve(tokens))
+
+        if wait > limit:
+            if rpm_bucket is not None:
+                rpm_bucket.refund(1)
+            if tpm_bucket is not None and tokens > 0:
+                tpm_bucket.refund(tokens)
+            self._bump(model_name, rejected=1)
+            raise RateLimitWaitTooLong(model_name, wait)
+
+        if wait > 0:
+            time.sleep(wait)
+            self._bump(model_name, calls=1, throttled=1, wait_sec=wait)
+        else:
+            self._bump(model_name, calls=1)
+        return wait
+
+    def penalize(self, model_name: str, seconds: float) -> None:
+        rpm_bucket, _ = self._buckets_for(model_name)
+        if rpm_bucket is not None:
+            rpm_bucket.pause(seconds)
+
+    def record_retry(self, model_name: str) -> None:
+        self._bump(model_name, retries=1)
+
+    def _bump(self, model_name: str, **deltas: float) -> None:
+        self._buckets_for(model_name)
+        with self._lock:
+            stats = self._stats[model_name]
+            for key, value in deltas.items():
+                stats[key] += value
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {name: dict(values) for name, values in self._stats.items()}
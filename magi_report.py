@@ -0,0 +1,317 @@
+"""
+レポートの描画エンジン（Word テンプレート・Markdown・HTML・JSON）。
+
+Word は、スタイルや社名ロゴなどを設定済みの .docx テンプレートをプロセスごとに1回だけ読み込み、
+その中のブロック（[[名前]] 〜 [[/名前]] で囲んだ段落・表）を複製して差し込み（{{項目}}）を埋める。
+テンプレートを差し替えれば、コードを変えずに見た目を変えられる。
+
+    python magi_report.py --write-template my_template.docx   # 既定のテンプレートを書き出す
+
+差し込み項目とブロック（data は magi_core.report_data の戻り値）:
+- 全体: {{title}} {{user_question}} {{raw_text}}
+- [[model]] {{answered_model}} / [[input]] {{label}} {{body}} / [[image]] {{image}}
+- [[agent]] {{name}} {{decision}} {{summary}} / [[no_agents]]
+- [[summary]] {{summary}} / [[details]] {{details}}
+- [[swot]] {{strengths}} {{weaknesses}} {{opportunities}} {{threats}} / [[swot_empty]]
+"""
+import argparse
+import base64
+import copy
+import hashlib
+import html
+import io
+import json
+import re
+import sys
+from typing import Any, Dict, List, Optional, Tuple
+
+import docx
+from docx.oxml.ns import qn
+from docx.shared import Inches
+from docx.text.paragraph import Paragraph
+
+# 形式ごとの (MIME type, 拡張子)
+REPORT_FORMATS = {
+    "docx": ("application/vnd.openxmlformats-officedocument.wordprocessingml.document", "docx"),
+    "md": ("text/markdown", "md"),
+    "html": ("text/html", "html"),
+    "json": ("application/json", "json"),
+}
+
+_PLACEHOLDER = re.compile(r"\{\{(\w+)\}\}")
+_BLOCK_MARKER = re.compile(r"\[\[(/?)(\w+)\]\]")
+
+SWOT_LABELS = [
+    ("strengths", "Strengths（強み）"),
+    ("weaknesses", "Weaknesses（弱み）"),
+    ("opportunities", "Opportunities（機会）"),
+    ("threats", "Threats（脅威）"),
+]
+
+
+# ======================================================
+# ブロックごとの差し込みデータ
+# ======================================================
+def block_items(data: Dict[str, Any], has_image: bool = False) -> Dict[str, List[Dict[str, str]]]:
+    """ブロック名 → 複製する回数ぶんの差し込み項目（0件ならそのブロックは出力しない）。"""
+    aggregated = data.get("aggregated") or {}
+    swot = data.get("swot")
+    return {
+        "model": [{"answered_model": data["answered_model"]}] if data.get("answered_model") else [],
+        "input": list(data.get("inputs") or []),
+        "image": [{}] if has_image else [],
+        "agent": list(data.get("agents") or []),
+        "no_agents": [] if data.get("agents") else [{}],
+        "summary": [{"summary": aggregated["summary"]}] if aggregated.get("summary") else [],
+        "details": [{"details": aggregated["details"]}] if aggregated.get("details") else [],
+        "swot": [dict(swot)] if swot and any(swot.values()) else [],
+        "swot_empty": [{}] if swot is not None and not any(swot.values()) else [],
+    }
+
+
+# ======================================================
+# Word テンプレート
+# ======================================================
+def _paragraph_text(element: Any) -> str:
+    return "".join(t.text or "" for t in element.iter(qn("w:t")))
+
+
+def _merge_placeholder_runs(element: Any) -> None:
+    """
+    Word で編集すると {{項目}} が複数の run に分かれることがあるので、
+    差し込みを含む段落は先頭の run（書式）にまとめておく。
+    """
+    for p in element.iter(qn("w:p")):
+        text = _paragraph_text(p)
+        if "{{" not in text:
+            continue
+        runs = p.findall(qn("w:r"))
+        if not runs:
+            continue
+        runs[0].text = text
+        for run in runs[1:]:
+            p.remove(run)
+
+
+class DocxTemplate:
+    """
+    読み込み済みのテンプレート。ブロックの切り出しと run の整理は最初の1回だけ行い、
+    render() では切り出した要素を複製して差し込むだけにする（スレッドセーフ）。
+    """
+
+    def __init__(self, template_bytes: bytes):
+        self.template_bytes = template_bytes
+        self.digest = hashlib.sha256(template_bytes).hexdigest()[:16]
+        self.segments = self._prepare(docx.Document(io.BytesIO(template_bytes)))
+
+    @staticmethod
+    def _prepare(doc: Any) -> List[Tuple[Optional[str], List[Any]]]:
+        """本文を [(ブロック名 or None（常に出す部分）, 要素のリスト)] に分ける。"""
+        segments: List[Tuple[Optional[str], List[Any]]] = [(None, [])]
+        for element in doc.element.body.iterchildren():
+            if element.tag == qn("w:sectPr"):
+                continue
+            if element.tag == qn("w:p"):
+                marker = _BLOCK_MARKER.fullmatch(_paragraph_text(element).strip())
+                if marker:
+                    segments.append((None if marker.group(1) else marker.group(2), []))
+                    continue
+            _merge_placeholder_runs(element)
+            segments[-1][1].append(element)
+        return [(name, elements) for name, elements in segments if elements]
+
+    def render(self, data: Dict[str, Any], image: Optional[bytes] = None) -> bytes:
+        doc = docx.Document(io.BytesIO(self.template_bytes))
+        body = doc.element.body
+        sect_pr = body.find(qn("w:sectPr"))
+        for element in list(body.iterchildren()):
+            if element is not sect_pr:
+                body.remove(element)
+
+        top = {
+            "title": data.get("title", ""),
+            "user_question": data.get("user_question", ""),
+            "raw_text": data.get("raw_text", ""),
+        }
+        blocks = block_items(data, has_image=image is not None)
+        for name, elements in self.segments:
+            for item in [top] if name is None else blocks.get(name, []):
+                values = {**top, **item}
+                for element in elements:
+                    clone = copy.deepcopy(element)
+                    self._fill(clone, values, doc, image)
+                    if sect_pr is not None:
+                        sect_pr.addprevious(clone)
+                    else:
+                        body.append(clone)
+
+        buf = io.BytesIO()
+        doc.save(buf)
+        return buf.getvalue()
+
+    @staticmethod
+    def _fill(element: Any, values: Dict[str, str], doc: Any, image: Optional[bytes]) -> None:
+        for p in element.iter(qn("w:p")):
+            text = _paragraph_text(p)
+            if "{{" not in text:
+                continue
+            run = p.find(qn("w:r"))
+            if text.strip() == "{{image}}":
+                run.text = ""
+                if image is not None:
+                    Paragraph(p, doc._body).runs[0].add_picture(io.BytesIO(image), width=Inches(3))
+                continue
+            # 改行は w:br になる（python-docx の run.text と同じ扱い）
+            run.text = _PLACEHOLDER.sub(lambda m: str(values.get(m.group(1), "") or ""), text)
+
+
+def default_template_bytes() -> bytes:
+    """既定のテンプレート（従来の build_word_report と同じ構成・見た目）を作る。"""
+    doc = docx.Document()
+
+    def block(name: str, *paragraphs: Tuple[str, int]) -> None:
+        doc.add_paragraph(f"[[{name}]]")
+        for text, level in paragraphs:
+            if level:
+                doc.add_heading(text, level=level)
+            else:
+                doc.add_paragraph(text)
+        doc.add_paragraph(f"[[/{name}]]")
+
+    doc.add_heading("{{title}}", level=1)
+    doc.add_heading("第1章 入力情報", level=2)
+    doc.add_paragraph("■ ユーザー質問：{{user_question}}")
+    block("model", ("■ 回答モデル：{{answered_model}}", 0))
+    block("input", ("■ {{label}}：", 0), ("{{body}}", 0))
+    block("image", ("{{image}}", 0))
+
+    doc.add_heading("第2章 各MAGIエージェントの要約と判定", level=2)
+    block("agent", ("{{name}}", 3), ("判定：{{decision}}", 0), ("要約：{{summary}}", 0))
+    block("no_agents", ("今回の実行では、MAGIエージェントの詳細出力は取得できませんでした。", 0))
+
+    doc.add_heading("第3章 MAGI統合AIの結論・アクションプラン", level=2)
+    block("summary", ("【サマリー】", 0), ("{{summary}}", 0))
+    block("details", ("【詳細】", 0), ("{{details}}", 0))
+
+    block(
+        "swot",
+        ("第4章 SWOT分析", 2),
+        *[(f"{label}：{{{{{key}}}}}", 0) for key, label in SWOT_LABELS],
+    )
+    block("swot_empty", ("第4章 SWOT分析", 2), ("今回の実行では、SWOT分析は生成されませんでした。", 0))
+
+    doc.add_heading("付録：MAGI生テキスト", level=2)
+    doc.add_paragraph("{{raw_text}}")
+
+    buf = io.BytesIO()
+    doc.save(buf)
+    return buf.getvalue()
+
+
+# ======================================================
+# Markdown / HTML / JSON
+# ======================================================
+def render_markdown(data: Dict[str, Any]) -> str:
+    blocks = block_items(data)
+    lines = [f"# {data['title']}", "", "## 第1章 入力情報", "", f"- ユーザー質問：{data['user_question']}"]
+    for item in blocks["model"]:
+        lines.append(f"- 回答モデル：{item['answered_model']}")
+    for item in blocks["input"]:
+        lines += ["", f"### {item['label']}", "", item["body"]]
+
+    lines += ["", "## 第2章 各MAGIエージェントの要約と判定", ""]
+    for agent in blocks["agent"]:
+        lines += [f"### {agent['name']}", "", f"- 判定：{agent['decision']}", f"- 要約：{agent['summary']}", ""]
+    if blocks["no_agents"]:
+        lines += ["今回の実行では、MAGIエージェントの詳細出力は取得できませんでした。", ""]
+
+    lines += ["## 第3章 MAGI統合AIの結論・アクションプラン", ""]
+    for item in blocks["summary"]:
+        lines += ["**サマリー**", "", item["summary"], ""]
+    for item in blocks["details"]:
+        lines += ["**詳細**", "", item["details"], ""]
+
+    for item in blocks["swot"]:
+        lines += ["## 第4章 SWOT分析", ""]
+        lines += [f"- {label}：{item.get(key, '')}" for key, label in SWOT_LABELS] + [""]
+    if blocks["swot_empty"]:
+        lines += ["## 第4章 SWOT分析", "", "今回の実行では、SWOT分析は生成されませんでした。", ""]
+
+    lines += ["## 付録：MAGI生テキスト", "", "```", data["raw_text"], "```", ""]
+    return "\n".join(lines)
+
+
+def _html_text(text: str) -> str:
+    return html.escape(text or "").replace("\n", "<br>")
+
+
+def render_html(data: Dict[str, Any], image: Optional[bytes] = None, image_mime: str = "image/jpeg") -> str:
+    blocks = block_items(data, has_image=image is not None)
+    parts = [
+        "<!DOCTYPE html>",
+        '<html lang="ja"><head><meta charset="utf-8">',
+        f"<title>{html.escape(data['title'])}</title>",
+        "<style>body{font-family:sans-serif;max-width:48em;margin:2em auto;line-height:1.6}"
+        "h1{border-bottom:2px solid #333}pre{white-space:pre-wrap;background:#f6f6f6;padding:1em}</style>",
+        "</head><body>",
+        f"<h1>{html.escape(data['title'])}</h1>",
+        "<h2>第1章 入力情報</h2>",
+        f"<p>■ ユーザー質問：{_html_text(data['user_question'])}</p>",
+    ]
+    for item in blocks["model"]:
+        parts.append(f"<p>■ 回答モデル：{html.escape(item['answered_model'])}</p>")
+    for item in blocks["input"]:
+        parts.append(f"<p>■ {html.escape(item['label'])}：</p><p>{_html_text(item['body'])}</p>")
+    if image is not None:
+        encoded = base64.b64encode(image).decode("ascii")
+        parts.append(f'<p><img src="data:{image_mime};base64,{encoded}" style="max-width:18em"></p>')
+
+    parts.append("<h2>第2章 各MAGIエージェントの要約と判定</h2>")
+    for agent in blocks["agent"]:
+        parts.append(
+            f"<h3>{html.escape(agent['name'])}</h3>"
+            f"<p>判定：{html.escape(agent['decision'])}</p><p>要約：{_html_text(agent['summary'])}</p>"
+        )
+    if blocks["no_agents"]:
+        parts.append("<p>今回の実行では、MAGIエージェントの詳細出力は取得できませんでした。</p>")
+
+    parts.append("<h2>第3章 MAGI統合AIの結論・アクションプラン</h2>")
+    for item in blocks["summary"]:
+        parts.append(f"<p>【サマリー】</p><p>{_html_text(item['summary'])}</p>")
+    for item in blocks["details"]:
+        parts.append(f"<p>【詳細】</p><p>{_html_text(item['details'])}</p>")
+
+    for item in blocks["swot"]:
+        parts.append("<h2>第4章 SWOT分析</h2>")
+        parts += [f"<p>{label}：{_html_text(item.get(key, ''))}</p>" for key, label in SWOT_LABELS]
+    if blocks["swot_empty"]:
+        parts.append("<h2>第4章 SWOT分析</h2><p>今回の実行では、SWOT分析は生成されませんでした。</p>")
+
+    parts.append(f"<h2>付録：MAGI生テキスト</h2><pre>{html.escape(data['raw_text'])}</pre>")
+    parts.append("</body></html>")
+    return "\n".join(parts)
+
+
+def render_json(data: Dict[str, Any]) -> str:
+    return json.dumps(data, ensure_ascii=False, indent=2)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="MAGI レポートのテンプレートを扱う")
+    parser.add_argument("--write-template", metavar="PATH", help="既定の Word テンプレートを書き出す")
+    args = parser.parse_args(argv)
+    if not args.write_template:
+        parser.print_help()
+        return 2
+    with open(args.write_template, "wb") as f:
+        f.write(default_template_bytes())
+    print(
+        f"{args.write_template} を書き出しました。Word で書式を整えてから "
+        "MAGI_REPORT_TEMPLATE_PATH に指定してください。",
+        file=sys.stderr,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
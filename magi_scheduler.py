@@ -0,0 +1,232 @@
+"""
+Gemini 呼び出しのプロセス全体での順番待ち（公平スケジューラ）。
+
+- モデルごとに同時に実行できる呼び出し数（limit_for(model)）を制限する
+- 空きを待つ呼び出しは、優先度（interactive → batch）の順に、
+  同じ優先度の中ではセッションごとに1件ずつ順番に（ラウンドロビン）実行する
+  （1人が大量に投げても、他のセッションの呼び出しが後ろに回され続けない）
+- 待っている間は on_wait(model, 順番) で待ち順を知らせる（実行に移ると順番 0 で呼ぶ）
+- 待ち件数・待ち時間などを stats() で返す
+
+呼び出し元のセッション・優先度は set_scheduler_caller() で現在のコンテキストに設定する。
+"""
+import contextvars
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Deque, Dict, Iterator, Optional, Tuple
+
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BATCH = "batch"
+# 小さいほど先に実行する
+PRIORITIES = {PRIORITY_INTERACTIVE: 0, PRIORITY_BATCH: 1}
+
+WaitListener = Callable[[str, int], None]
+
+# (セッション, 優先度, on_wait)。スレッドには copy_context で引き継ぐ
+_caller: contextvars.ContextVar[Optional[Tuple[str, str, Optional[WaitListener]]]] = (
+    contextvars.ContextVar("magi_scheduler_caller", default=None)
+)
+
+
+def set_scheduler_caller(
+    session: str, priority: str = PRIORITY_INTERACTIVE, on_wait: Optional[WaitListener] = None
+) -> None:
+    """以降の呼び出しのセッション・優先度と、順番待ちの通知先を現在のコンテキストに設定する。"""
+    _caller.set((session or "", priority if priority in PRIORITIES else PRIORITY_INTERACTIVE, on_wait))
+
+
+def current_scheduler_caller() -> Optional[Tuple[str, str, Optional[WaitListener]]]:
+    return _caller.get()
+
+
+class SchedulerWaitTooLong(Exception):
+    """順番待ちが上限時間を超えたため、呼び出しを諦めたことを表す。"""
+
+    def __init__(self, model_name: str, wait_sec: float):
+        super().__init__(
+            f"client-side rate limit (concurrency queue) for {model_name}: waited {wait_sec:.1f}s"
+        )
+        self.model_name = model_name
+        self.wait_sec = wait_sec
+
+
+@dataclass(eq=False)
+class _Waiter:
+    model: str
+    session: str
+    priority: int
+    enqueued_at: float = field(default_factory=time.monotonic)
+    granted: bool = False
+
+
+class FairScheduler:
+    """
+    slot(model, session, priority) の with ブロックの間、そのモデルの実行枠を1つ使う。
+    limit_for(model) が 0 以下のモデルは制限しない（順番待ちもしない）。
+    """
+
+    def __init__(self, limit_for: Callable[[str], int], poll_sec: float = 0.5):
+        self.limit_for = limit_for
+        self.poll_sec = poll_sec
+        self._cond = threading.Condition()
+        self._running: Dict[str, int] = {}
+        # model → 優先度 → セッション → 待ち行列（セッションの並びがラウンドロビンの順）
+        self._queues: Dict[str, Dict[int, "OrderedDict[str, Deque[_Waiter]]"]] = {}
+        self._stats: Dict[str, Dict[str, float]] = {}
+
+    # --------------------------------------------------
+    # 待ち行列（すべて self._cond を持った状態で呼ぶ）
+    # --------------------------------------------------
+    def _stats_locked(self, model: str) -> Dict[str, float]:
+        return self._stats.setdefault(
+            model,
+            {"granted": 0, "queued": 0, "wait_sec": 0.0, "max_wait_sec": 0.0, "max_depth": 0, "timeouts": 0},
+        )
+
+    def _depth_locked(self, model: str) -> int:
+        return sum(
+            len(q) for sessions in self._queues.get(model, {}).values() for q in sessions.values()
+        )
+
+    def _enqueue_locked(self, waiter: _Waiter) -> None:
+        sessions = self._queues.setdefault(waiter.model, {}).setdefault(waiter.priority, OrderedDict())
+        sessions.setdefault(waiter.session, deque()).append(waiter)
+
+    def _remove_locked(self, waiter: _Waiter) -> None:
+        sessions = self._queues.get(waiter.model, {}).get(waiter.priority)
+        if sessions is None or waiter.session not in sessions:
+            return
+        queue = sessions[waiter.session]
+        if waiter in queue:
+            queue.remove(waiter)
+        if not queue:
+            del sessions[waiter.session]
+
+    def _next_locked(self, model: str) -> Optional[_Waiter]:
+        for priority in sorted(self._queues.get(model, {})):
+            sessions = self._queues[model][priority]
+            if not sessions:
+                continue
+            session, queue = sessions.popitem(last=False)
+            waiter = queue.popleft()
+            if queue:
+                # このセッションの残りは、他のセッションの後ろに回す
+                sessions[session] = queue
+            return waiter
+        return None
+
+    def _dispatch_locked(self, model: str) -> None:
+        limit = self.limit_for(model)
+        granted = False
+        while limit <= 0 or self._running.get(model, 0) < limit:
+            waiter = self._next_locked(model)
+            if waiter is None:
+                break
+            waiter.granted = True
+            self._running[model] = self._running.get(model, 0) + 1
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def _position_locked(self, waiter: _Waiter) -> int:
+        """waiter が何番目に実行されるか（1 始まり）。ラウンドロビンの順を再現して数える。"""
+        position = 0
+        for priority in sorted(self._queues.get(waiter.model, {})):
+            queues = [list(q) for q in self._queues[waiter.model][priority].values()]
+            for depth in range(max((len(q) for q in queues), default=0)):
+                for queue in queues:
+                    if depth < len(queue):
+                        position += 1
+                        if queue[depth] is waiter:
+                            return position
+        return position
+
+    def _release_locked(self, model: str) -> None:
+        self._running[model] = max(0, self._running.get(model, 0) - 1)
+        self._dispatch_locked(model)
+
+    # --------------------------------------------------
+    # 公開 API
+    # --------------------------------------------------
+    @contextmanager
+    def slot(
+        self,
+        model: str,
+        session: str = "",
+        priority: str = PRIORITY_INTERACTIVE,
+        on_wait: Optional[WaitListener] = None,
+        max_wait_sec: float = 0.0,
+    ) -> Iterator[float]:
+        """実行枠が空くまで待ち、待った秒数を返す。max_wait_sec（0 なら無制限）を超えたら SchedulerWaitTooLong。"""
+        waiter = _Waiter(model, session, PRIORITIES.get(priority, 0))
+        with self._cond:
+            self._enqueue_locked(waiter)
+            self._dispatch_locked(model)
+            queued = not waiter.granted
+            if queued:
+                stats = self._stats_locked(model)
+                stats["max_depth"] = max(stats["max_depth"], self._depth_locked(model))
+        notified = False
+        try:
+            last_position = 0
+            while True:
+                with self._cond:
+                    if waiter.granted:
+                        break
+                    position = self._position_locked(waiter)
+                if on_wait is not None and position != last_position:
+                    on_wait(model, position)
+                    last_position = position
+                    notified = True
+                with self._cond:
+                    if waiter.granted:
+                        break
+                    waited = time.monotonic() - waiter.enqueued_at
+                    if max_wait_sec > 0 and waited >= max_wait_sec:
+                        self._remove_locked(waiter)
+                        self._stats_locked(model)["timeouts"] += 1
+                        raise SchedulerWaitTooLong(model, waited)
+                    timeout = self.poll_sec
+                    if max_wait_sec > 0:
+                        timeout = min(timeout, max_wait_sec - waited)
+                    self._cond.wait(timeout)
+        except BaseException:
+            with self._cond:
+                if waiter.granted:
+                    self._release_locked(model)
+                else:
+                    self._remove_locked(waiter)
+            raise
+
+        waited = time.monotonic() - waiter.enqueued_at
+        with self._cond:
+            stats = self._stats_locked(model)
+            stats["granted"] += 1
+            stats["wait_sec"] += waited
+            stats["max_wait_sec"] = max(stats["max_wait_sec"], waited)
+            if queued:
+                stats["queued"] += 1
+        try:
+            if notified and on_wait is not None:
+                on_wait(model, 0)
+            yield waited
+        finally:
+            with self._cond:
+                self._release_locked(model)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """モデルごとの running（実行中）・waiting（待ち）・limit と、累計の granted・queued（待たされた数）・待ち時間。"""
+        with self._cond:
+            models = set(self._stats) | set(self._running)
+            return {
+                model: dict(
+                    self._stats_locked(model),
+                    running=self._running.get(model, 0),
+                    waiting=self._depth_locked(model),
+                    limit=self.limit_for(model),
+                )
+                for model in sorted(models)
+            }
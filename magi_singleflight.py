@@ -0,0 +1,89 @@
+"""
+同じ内容の呼び出しを1つにまとめる（single-flight）。
+
+複数のセッション・スレッドが同じキーで同時に呼び出したとき、最初の1つ（leader）だけが実際に処理し、
+処理中に来た残り（follower）はその完了を待って同じ結果を受け取る。
+Gemini の同じ問い合わせが重なったときに、クォータを二重に使わないためのもの。
+結果は保存しない（保存はキャッシュの役割。完了後に来た呼び出しは、また leader になる）。
+"""
+import threading
+from collections import defaultdict
+from typing import Any, Callable, Dict, Optional, Tuple, Type, TypeVar
+
+T = TypeVar("T")
+
+
+class _Flight:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.value: Any = None
+        self.error: Optional[BaseException] = None
+        self.followers = 0
+
+
+class SingleFlight:
+    """
+    do(key, fn) は fn() の結果と、他の呼び出しの結果を共有したかどうか（shared）を返す。
+    leader の fn が例外を投げた場合は、待っていた follower にも同じ例外を投げる。
+    follower が wait_timeout 秒待っても終わらなければ、待つのをやめて自分で fn() を呼ぶ。
+    leader だけの事情による例外（local_errors。取り消しなど）のときも、follower は自分で fn() を呼ぶ。
+    """
+
+    def __init__(
+        self,
+        wait_timeout: Optional[float] = None,
+        local_errors: Tuple[Type[BaseException], ...] = (),
+    ):
+        self.wait_timeout = wait_timeout
+        self.local_errors = local_errors
+        self._lock = threading.Lock()
+        self._flights: Dict[str, _Flight] = {}
+        self._stats: Dict[str, Dict[str, int]] = defaultdict(
+            lambda: {"calls": 0, "coalesced": 0, "errors": 0, "timeouts": 0}
+        )
+
+    def do(self, key: str, fn: Callable[[], T], group: str = "") -> Tuple[T, bool]:
+        with self._lock:
+            stats = self._stats[group]
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                stats["calls"] += 1
+                leader = True
+            else:
+                flight.followers += 1
+                stats["coalesced"] += 1
+                leader = False
+
+        if not leader:
+            if not flight.done.wait(self.wait_timeout):
+                with self._lock:
+                    stats["timeouts"] += 1
+                return fn(), False
+            if isinstance(flight.error, self.local_errors):
+                return fn(), False
+            if flight.error is not None:
+                raise flight.error
+            return flight.value, True
+
+        try:
+            flight.value = fn()
+        except BaseException as e:
+            flight.error = e
+            with self._lock:
+                stats["errors"] += 1
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+        return flight.value, False
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._flights)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """group ごとの calls（実際に処理した数）・coalesced（相乗りした数）・errors・timeouts。"""
+        with self._lock:
+            return {group: dict(stats) for group, stats in self._stats.items()}
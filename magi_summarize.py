@@ -0,0 +1,237 @@
+"""
+長文入力の map-reduce 要約。
+
+- split_into_chunks: 文・段落の区切りで、トークン予算に収まるチャンクに分ける
+- allocate_budgets: プロンプト全体の予算を、入力欄ごとの予算に配分する
+- map_reduce_summarize: チャンクを並列に要約し、予算に収まるまで要約の要約を繰り返す
+- summarize_chunk_stream: ファイルなどから順に読み出したチャンク列を、
+  同時に抱えるチャンク数を抑えながら要約する（1段目だけ。2段目以降は map_reduce_summarize）
+
+Gemini の呼び出しやキャッシュは呼び出し側（magi_core）が summarize_chunk として渡す。
+"""
+import contextvars
+import re
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# 文末・改行の直後で区切る（区切り文字はチャンク側に残す）
+_SENTENCE_BOUNDARY = re.compile(r"(?<=[。！？!?\n])")
+
+OMITTED_MARK = "\n…（長文のためここで省略）"
+
+
+def truncate_to_tokens(text: str, max_tokens: int, count_tokens: Callable[[str], int]) -> str:
+    tokens = count_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    # 文字数とトークン数の比から切る位置を決める（見積もりなので少し余裕を持たせる）
+    chars = max(0, int(len(text) * max_tokens / max(1, tokens)) - len(OMITTED_MARK))
+    return text[:chars] + OMITTED_MARK
+
+
+def split_into_chunks(
+    text: str, max_tokens: int, count_tokens: Callable[[str], int]
+) -> List[str]:
+    """
+    文単位で詰めていき、max_tokens を超える前に次のチャンクに移る。
+    1文だけで max_tokens を超える場合は、その文を文字数で機械的に分割する。
+    """
+    max_tokens = max(1, int(max_tokens))
+    chunks: List[str] = []
+    current = ""
+    for piece in _SENTENCE_BOUNDARY.split(text):
+        if not piece:
+            continue
+        if count_tokens(piece) > max_tokens:
+            if current:
+                chunks.append(current)
+                current = ""
+            step = max(1, int(len(piece) * max_tokens / count_tokens(piece)))
+            chunks.extend(piece[i : i + step] for i in range(0, len(piece), step))
+            continue
+        if current and count_tokens(current + piece) > max_tokens:
+            chunks.append(current)
+            current = piece
+        else:
+            current += piece
+    if current:
+        chunks.append(current)
+    return [c for c in chunks if c.strip()]
+
+
+def iter_chunks_from_blocks(
+    blocks: Iterable[str], max_tokens: int, count_tokens: Callable[[str], int]
+) -> Iterator[str]:
+    """
+    少しずつ読み出したテキスト blocks を、split_into_chunks と同じ規則でチャンクに分けて順に返す。
+    ブロック末尾の書きかけのチャンクは次のブロックに持ち越す。
+    """
+    carry = ""
+    for block in blocks:
+        chunks = split_into_chunks(carry + block, max_tokens, count_tokens)
+        if not chunks:
+            carry = ""
+            continue
+        carry = chunks.pop()
+        yield from chunks
+    if carry.strip():
+        yield carry
+
+
+def allocate_budgets(sizes: Dict[str, int], total: int) -> Dict[str, int]:
+    """
+    入力欄ごとのトークン数 sizes に対して、合計 total を配分する。
+    予算より短い欄はそのまま通し、余った分を長い欄で均等に分け合う。
+    """
+    budgets: Dict[str, int] = {}
+    remaining = max(0, int(total))
+    pending = {name: size for name, size in sizes.items() if size > 0}
+    while pending:
+        share = remaining // len(pending)
+        fits = {name: size for name, size in pending.items() if size <= share}
+        if not fits:
+            for name in pending:
+                budgets[name] = share
+            break
+        for name, size in fits.items():
+            budgets[name] = size
+            remaining -= size
+            del pending[name]
+    for name in sizes:
+        budgets.setdefault(name, 0)
+    return budgets
+
+
+def _chunk_target(
+    budget_tokens: int, n_chunks: int, chunk_tokens: int, min_summary_tokens: int
+) -> int:
+    # 1チャンクあたりの目標：全体で予算に収まる長さ。ただし短すぎる要約は作らない
+    return min(
+        max(budget_tokens // max(1, n_chunks), min_summary_tokens),
+        max(1, chunk_tokens // 2),
+    )
+
+
+def _summarize_level(
+    chunks: Iterable[str],
+    target: int,
+    summarize_chunk: Callable[[str, int], Optional[str]],
+    count_tokens: Callable[[str], int],
+    executor: ThreadPoolExecutor,
+    max_in_flight: int,
+    stats: Dict[str, Any],
+) -> str:
+    """
+    チャンクを並列に要約して、元の順序で連結する。
+    同時に抱えるチャンクは max_in_flight 件までなので、入力全体をメモリに載せなくてよい。
+    """
+    parts: List[str] = []
+    pending: Deque[Tuple[str, "Future[Optional[str]]"]] = deque()
+
+    def _collect() -> None:
+        chunk, fut = pending.popleft()
+        summary = fut.result()
+        if not summary:
+            stats["failed_chunks"] += 1
+            summary = truncate_to_tokens(chunk, target, count_tokens)
+        parts.append(summary.strip())
+
+    for chunk in chunks:
+        # 計測中のスパン一覧や使用量セッションをワーカースレッドにも引き継ぐ
+        pending.append(
+            (chunk, executor.submit(contextvars.copy_context().run, summarize_chunk, chunk, target))
+        )
+        stats["chunks"] += 1
+        if len(pending) >= max_in_flight:
+            _collect()
+    while pending:
+        _collect()
+    stats["levels"] += 1
+    return "\n".join(parts)
+
+
+def _new_stats(input_tokens: int) -> Dict[str, Any]:
+    return {
+        "input_tokens": input_tokens,
+        "output_tokens": 0,
+        "levels": 0,
+        "chunks": 0,
+        "failed_chunks": 0,
+    }
+
+
+def map_reduce_summarize(
+    text: str,
+    budget_tokens: int,
+    summarize_chunk: Callable[[str, int], Optional[str]],
+    count_tokens: Callable[[str], int],
+    chunk_tokens: int = 4000,
+    max_workers: int = 4,
+    max_levels: int = 3,
+    min_summary_tokens: int = 200,
+    stats: Optional[Dict[str, Any]] = None,
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    text が budget_tokens に収まるまで、
+    「チャンクに分割 → 各チャンクを並列に要約 → 要約を連結」を最大 max_levels 段繰り返す。
+    summarize_chunk(chunk, 目標トークン数) が None を返したチャンクは、機械的な切り詰めで代用する。
+    それでも収まらなければ最後に切り詰める。戻り値は (要約, 統計)。
+    """
+    if stats is None:
+        stats = _new_stats(count_tokens(text))
+    current = text
+    with ThreadPoolExecutor(
+        max_workers=max(1, max_workers), thread_name_prefix="magi-summary"
+    ) as executor:
+        while stats["levels"] < max_levels and count_tokens(current) > budget_tokens:
+            chunks = split_into_chunks(current, chunk_tokens, count_tokens)
+            target = _chunk_target(budget_tokens, len(chunks), chunk_tokens, min_summary_tokens)
+            reduced = _summarize_level(
+                chunks, target, summarize_chunk, count_tokens, executor, len(chunks), stats
+            )
+            if count_tokens(reduced) >= count_tokens(current):
+                # 要約しても短くならない（失敗続きなど）→ これ以上は繰り返さない
+                break
+            current = reduced
+
+    current = truncate_to_tokens(current, budget_tokens, count_tokens)
+    stats["output_tokens"] = count_tokens(current)
+    return current, stats
+
+
+def summarize_chunk_stream(
+    chunks: Iterable[str],
+    input_tokens: int,
+    budget_tokens: int,
+    summarize_chunk: Callable[[str, int], Optional[str]],
+    count_tokens: Callable[[str], int],
+    chunk_tokens: int = 4000,
+    max_workers: int = 4,
+    max_levels: int = 3,
+    min_summary_tokens: int = 200,
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    map_reduce_summarize の1段目を、順に読み出すチャンク列 chunks で行う版。
+    input_tokens（全体の見積もり）からチャンク数を見積もって目標の長さを決める。
+    """
+    stats = _new_stats(input_tokens)
+    n_chunks = -(-max(1, input_tokens) // max(1, chunk_tokens))
+    target = _chunk_target(budget_tokens, n_chunks, chunk_tokens, min_summary_tokens)
+    with ThreadPoolExecutor(
+        max_workers=max(1, max_workers), thread_name_prefix="magi-summary"
+    ) as executor:
+        reduced = _summarize_level(
+            chunks, target, summarize_chunk, count_tokens, executor, max(1, max_workers) * 2, stats
+        )
+    return map_reduce_summarize(
+        reduced,
+        budget_tokens,
+        summarize_chunk,
+        count_tokens,
+        chunk_tokens=chunk_tokens,
+        max_workers=max_workers,
+        max_levels=max_levels,
+        min_summary_tokens=min_summary_tokens,
+        stats=stats,
+    )
@@ -0,0 +1,208 @@
+"""
+トークン使用量の記録と見積もり。
+
+- UsageLedger: 呼び出しごとの入力／出力トークン（usage_metadata）と推定費用を SQLite に保存し、
+  呼び出し単位・セッション単位・日単位で集計する
+- TokenCountCache: count_tokens の結果を入力内容のハッシュごとに保持する（プロセス内 LRU）
+- estimate_cost: モデルごとの単価（USD / 100万トークン）から費用を見積もる
+"""
+import contextvars
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+# 公開価格を目安にした単価（入力, 出力）USD / 100万トークン。MAGI_PRICE_IN_<MODEL> などで上書きできる
+DEFAULT_PRICES_PER_MTOK = {
+    "gemini-2.0-flash": (0.10, 0.40),
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-2.5-pro": (1.25, 10.00),
+    "gemini-2.5-flash-lite": (0.10, 0.40),
+}
+FALLBACK_PRICE_PER_MTOK = (0.30, 2.50)
+
+# 現在の呼び出し元セッション（Streamlit のセッションやバッチの行）。スレッドには copy_context で引き継ぐ
+_usage_session: contextvars.ContextVar[str] = contextvars.ContextVar("magi_usage_session", default="")
+
+
+def set_usage_session(session_id: str) -> None:
+    _usage_session.set(session_id or "")
+
+
+def current_usage_session() -> str:
+    return _usage_session.get()
+
+
+def usage_from_response(resp: Any) -> Tuple[int, int]:
+    """応答の usage_metadata から (入力トークン, 出力トークン) を取り出す（無ければ 0, 0）。"""
+    usage = getattr(resp, "usage_metadata", None)
+    if usage is None:
+        return 0, 0
+    prompt = int(getattr(usage, "prompt_token_count", 0) or 0)
+    output = int(getattr(usage, "candidates_token_count", 0) or 0)
+    return prompt, output
+
+
+def estimate_cost(
+    prompt_tokens: int, output_tokens: int, prices: Tuple[float, float]
+) -> float:
+    price_in, price_out = prices
+    return (prompt_tokens * price_in + output_tokens * price_out) / 1_000_000
+
+
+class UsageLedger:
+    """
+    1呼び出し1行で使用量を保存する。retention_days より古い行は書き込み時に削除する。
+    """
+
+    def __init__(self, path: str, retention_days: int = 90):
+        self.path = path
+        self.retention_days = int(retention_days)
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS token_usage (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    ts REAL NOT NULL,
+                    day TEXT NOT NULL,
+                    session_id TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    purpose TEXT NOT NULL,
+                    prompt_tokens INTEGER NOT NULL,
+                    output_tokens INTEGER NOT NULL,
+                    cost_usd REAL NOT NULL
+                )
+                """
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_token_usage_day ON token_usage(day, model)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_token_usage_session ON token_usage(session_id)"
+            )
+
+    def record(
+        self,
+        model: str,
+        purpose: str,
+        prompt_tokens: int,
+        output_tokens: int,
+        cost_usd: float,
+        session_id: str = "",
+    ) -> Dict[str, Any]:
+        now = time.time()
+        row = {
+            "ts": now,
+            "day": time.strftime("%Y-%m-%d", time.localtime(now)),
+            "session_id": session_id,
+            "model": model,
+            "purpose": purpose,
+            "prompt_tokens": int(prompt_tokens),
+            "output_tokens": int(output_tokens),
+            "cost_usd": float(cost_usd),
+        }
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO token_usage "
+                "(ts, day, session_id, model, purpose, prompt_tokens, output_tokens, cost_usd) "
+                "VALUES (:ts, :day, :session_id, :model, :purpose, :prompt_tokens, :output_tokens, :cost_usd)",
+                row,
+            )
+            # 古い行の削除は1時間に1回まで
+            if self.retention_days > 0 and now - self._last_prune > 3600:
+                self._conn.execute(
+                    "DELETE FROM token_usage WHERE ts < ?",
+                    (now - self.retention_days * 86400,),
+                )
+                self._last_prune = now
+        return row
+
+    def totals(
+        self, day: Optional[str] = None, session_id: Optional[str] = None
+    ) -> Dict[str, Dict[str, float]]:
+        """モデルごとの {calls, prompt_tokens, output_tokens, cost_usd}。day / session_id で絞り込む。"""
+        where, params = [], []
+        if day is not None:
+            where.append("day = ?")
+            params.append(day)
+        if session_id is not None:
+            where.append("session_id = ?")
+            params.append(session_id)
+        sql = (
+            "SELECT model, COUNT(*), SUM(prompt_tokens), SUM(output_tokens), SUM(cost_usd) "
+            "FROM token_usage"
+            + (" WHERE " + " AND ".join(where) if where else "")
+            + " GROUP BY model"
+        )
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return {
+            model: {
+                "calls": calls,
+                "prompt_tokens": prompt or 0,
+                "output_tokens": output or 0,
+                "cost_usd": cost or 0.0,
+            }
+            for model, calls, prompt, output, cost in rows
+        }
+
+    def today(self) -> Dict[str, Dict[str, float]]:
+        return self.totals(day=time.strftime("%Y-%m-%d"))
+
+    def recent_calls(self, limit: int = 20, session_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        sql = (
+            "SELECT ts, model, purpose, prompt_tokens, output_tokens, cost_usd FROM token_usage"
+            + (" WHERE session_id = ?" if session_id is not None else "")
+            + " ORDER BY id DESC LIMIT ?"
+        )
+        params: List[Any] = [session_id] if session_id is not None else []
+        with self._lock:
+            rows = self._conn.execute(sql, params + [int(limit)]).fetchall()
+        return [
+            {
+                "ts": ts,
+                "model": model,
+                "purpose": purpose,
+                "prompt_tokens": prompt,
+                "output_tokens": output,
+                "cost_usd": cost,
+            }
+            for ts, model, purpose, prompt, output, cost in rows
+        ]
+
+
+class TokenCountCache:
+    """count_tokens の結果（整数）を保持するスレッドセーフな LRU。"""
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max(1, int(max_entries))
+        self._data: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[int]:
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: int) -> None:
+        with self._lock:
+            self._data[key] = int(value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)